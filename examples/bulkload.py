@@ -29,10 +29,8 @@ def testaction(kw, retval):
     starttime = datetime.now()
     try:
         if _LOAD:
-            f = open(_LOAD, 'r')
-            data = json.load(f)
-            datastore.add(data) # update is very slow for this use case
-            print "data loaded from", _LOAD
+            count = datastore.bulkLoad(_LOAD)
+            print count, "statements loaded from", _LOAD
         else:
             print "opening", _DUMP
             f = open(_DUMP, 'w')
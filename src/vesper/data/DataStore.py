@@ -6,22 +6,27 @@
     
     This module defined the high-level public interface to a data store.
 """
-import StringIO, os, os.path
+import StringIO, os, os.path, copy
 import logging
 import time
 
 from vesper.data import base, transactions
 from vesper.data.base import graph as graphmod # avoid aliasing some local vars
-from vesper.data.store.basic import MemStore, FileStore, IncrementalNTriplesFileStoreBase
-from vesper.utils import debugp, flatten, defaultattrdict
+from vesper.data.store.basic import MemStore, FileStore, IncrementalNTriplesFileStoreBase, loadFileStore, guessFileType
+from vesper.utils import debugp, flatten, defaultattrdict, attrdict
 from vesper.data.base.utils import OrderedModel
 from vesper.data.base.schema import defaultSchemaClass
 
 from vesper import pjson
+from vesper.backports import json
 
 class DataStoreError(Exception):
     '''Base DataStore error'''
 
+#: the actions that are passed the statements added in the transaction
+_ADDITION_TRIGGERS = ('before-add', 'before-commit', 'finalize-commit', 
+                                            'after-commit', 'after-abort')
+
 def _toStatements(contents, **kw):
     if not contents:
         return [], contents, []
@@ -34,6 +39,22 @@ def _toStatements(contents, **kw):
     stmts, emptyobjs = pjson.Parser(**kw).to_rdf(contents)
     return stmts, contents, emptyobjs
 
+def _iterPjsonObjects(doc):
+    '''
+    Yield the objects in a pjson document, preceded by its header (if it has 
+    one).
+    '''
+    if isinstance(doc, dict):
+        if 'pjson' not in doc:
+            yield doc
+            return
+        yield dict([(k, v) for (k, v) in doc.items() if k != 'data'])
+        doc = doc.get('data', [])
+        if isinstance(doc, dict):
+            doc = [doc]
+    for obj in doc:
+        yield obj
+
 class DataStore(transactions.TransactionParticipant): # XXX this base class can go away
     '''
     Abstract interface for DataStores
@@ -93,6 +114,17 @@ class BasicStore(DataStore):
     #by another embedded object remove the embedded object and recursively any 
     #other embedded embedded object.
     simpleEmbeddingSemantics = True
+
+    #: incremented whenever the schema is replaced so that prepared queries 
+    #: know to prepare themselves again
+    schemaVersion = 0
+    _schema = None
+
+    def _setSchema(self, schema):
+        self._schema = schema
+        self.schemaVersion += 1
+
+    schema = property(lambda self: self._schema, _setSchema)
     
     def __init__(self, requestProcessor, model_factory=None,
                  schemaFactory=defaultSchemaClass,
@@ -111,6 +143,7 @@ class BasicStore(DataStore):
                  replication_hosts=None,
                  replication_channel=None,
                  send_stomp_ack=True,
+                 query_result_cache=False,
                  **kw):
         '''
         model_factory is a base.Model class or factory function that takes
@@ -118,6 +151,7 @@ class BasicStore(DataStore):
           a location (usually a local file path) and iterator of Statements
           to initialize the model if it needs to be created
         '''
+        import vesper.query
         self.requestProcessor = requestProcessor
         self.model_factory = model_factory
         self.version_model_factory = version_model_factory
@@ -144,6 +178,10 @@ class BasicStore(DataStore):
                 
         self._txnparticipants = []
         self.model_options = model_options or {}
+        self.query_result_cache = query_result_cache
+        #: number of committed transactions that modified the store
+        self.writeCount = 0
+        self._resultCacheOwner = vesper.query.ResultCacheOwner()
 
     def load(self):
         requestProcessor = self.requestProcessor
@@ -293,6 +331,17 @@ class BasicStore(DataStore):
             return
         self.model.commit(**txnService.getInfo())
 
+    def finishTransaction(self, txnService, committed):
+        changed = getattr(txnService.state, 'changedProperties', {})
+        if not committed or self not in changed:
+            return
+        self.writeCount += 1
+        if self.query_result_cache:
+            import vesper.query
+            owner = self._resultCacheOwner
+            vesper.query.resultCache.invalidate(owner, changed[self])
+            owner.revision = self.getRevision()
+
     def abortTransaction(self, txnService):
         if self.is2PhaseTxn():
             return 
@@ -307,6 +356,16 @@ class BasicStore(DataStore):
         if self.graphManager:
             return self.graphManager.getTxnContext() #return a contextUri
         return None
+
+    def getRevision(self):
+        '''
+        Returns a value that changes whenever the store is modified: the 
+        current version if history is saved, otherwise the number of 
+        transactions that have modified the store in this process.
+        '''
+        if self.graphManager:
+            return self.graphManager.currentVersion
+        return self.writeCount
     
     def join(self, txnService, readOnly=False, setCurrentTxn=True):
         if not txnService.isActive():
@@ -319,6 +378,10 @@ class BasicStore(DataStore):
             #its local to this transaction so dont have worry about memory usage
             #or invalidating across transactions or processes
             txnService.state.queryCache = {}
+        if not hasattr(txnService.state, 'changedProperties'):
+            #store -> the set of properties modified by this transaction 
+            #(or None if unknown), used to invalidate cached query results
+            txnService.state.changedProperties = {}
 
         #getTransactionContext() can invoke store IO so for efficent don't do if readOnly
         if not readOnly and setCurrentTxn and hasattr(txnService.state, 'kw'):
@@ -358,6 +421,29 @@ class BasicStore(DataStore):
 "model(s) doesn't support updateAdvisory, unable to participate in 2phase commit")
             return model, historyModel
     
+    def _recordChanges(self, stmts):
+        '''
+        Invalidate the query caches for the properties of the given 
+        statements. If `stmts` is None, treat every property as changed.
+        '''
+        state = self.requestProcessor.txnSvc.state
+        state.queryCache = {}
+        changed = state.changedProperties
+        if stmts is None:
+            changed[self] = None
+            return
+        if self in changed and changed[self] is None:
+            return
+        properties = changed.setdefault(self, set())
+        bnodePrefix = self.model.bnodePrefix
+        for stmt in stmts:
+            if stmt[0].startswith(bnodePrefix):
+                #embedded objects and lists are included in the results of 
+                #queries that don't reference their properties
+                changed[self] = None
+                return
+            properties.add(stmt[1])
+
     def _isEmbedded(self, res, objectType = base.OBJECT_TYPE_RESOURCE):
         return (self.simpleEmbeddingSemantics 
                 and res.startswith(self.model.bnodePrefix+'j:e:') 
@@ -391,7 +477,7 @@ class BasicStore(DataStore):
         resources = set()
         newresources = []
         if stmts: #invalidate cache
-            self.requestProcessor.txnSvc.state.queryCache = {}
+            self._recordChanges(stmts)
         
         if mustBeNewResources or self.newResourceTrigger:
             def getSubjects():
@@ -423,6 +509,112 @@ class BasicStore(DataStore):
         '''
         return self._add(adds, True)
 
+    def bulkLoad(self, source, batchSize=10000, parallel=False):
+        '''
+        Adds a large amount of data to the store in one transaction (and so
+        one revision if history is saved). Returns the number of statements
+        loaded.
+
+        `source`: the path to a file (in any format `FileStore` can read) 
+        or an iterable of statements and/or pjson conforming dicts.
+        
+        Unlike `add`, the statements are parsed and passed to the model in 
+        batches of `batchSize`, the `addTrigger` and `newResourceTrigger` 
+        aren't invoked and pjson objects aren't modified to include their 
+        generated ids. Because the added statements aren't recorded, a 
+        `DataStoreError` is raised if actions that are passed them (e.g. 
+        "before-commit" or "after-commit") are configured.
+
+        NTriples files are read a line at a time, so a triple that appears
+        more than once in different scopes is added once for each scope.
+        pjson files are read whole but only turned into statements a batch 
+        at a time. Other formats are parsed before anything is added.
+        If `parallel` is True, files in line-oriented formats and pjson 
+        files are parsed by a pool of processes, which also parses the 
+        whole file first.
+        '''
+        actions = getattr(self.requestProcessor, 'actions', None) or {}
+        triggers = [trigger for trigger in _ADDITION_TRIGGERS 
+                                                    if actions.get(trigger)]
+        if triggers:
+            raise DataStoreError("bulkLoad can't be used with %s actions" 
+                                                        % ', '.join(triggers))
+
+        if not self.join(self.requestProcessor.txnSvc):
+            #not in a transaction, so call this inside one
+            func = lambda: self.bulkLoad(source, batchSize, parallel)
+            return self.requestProcessor.executeTransaction(func)
+
+        parseOptions = self.model_options.get('parseOptions', 
+                                    self.storage_template_options)
+        if not isinstance(source, (str, unicode)):
+            return self._bulkLoad(source, batchSize, parseOptions)
+        
+        path = source
+        if not os.path.exists(path):
+            raise DataStoreError("%s doesn't exist" % path)
+        format = guessFileType(path)
+        if parallel or format not in ('ntriples', 'ntjson', 'pjson'):
+            source = loadFileStore(path, parseOptions=dict(parseOptions), 
+                                                        parallel=parallel)[0]
+            return self._bulkLoad(source, batchSize, parseOptions)
+
+        f = open(path, 'rb')
+        try:
+            if format == 'pjson':
+                source = _iterPjsonObjects(json.load(f))
+            else:
+                from vesper.utils import Uri
+                source = base.iterNTriplesStatements(f, 
+                    baseuri=Uri.OsPathToUri(path), 
+                    charencoding=parseOptions.get('charencoding', 'utf8'))
+            return self._bulkLoad(source, batchSize, parseOptions)
+        finally:
+            f.close()
+
+    def _bulkLoad(self, source, batchSize, parseOptions):
+        count = 0
+        for stmts in self._iterBatches(source, batchSize, parseOptions):
+            if not count:
+                state = self.requestProcessor.txnSvc.state
+                #the addTrigger isn't called so mark the transaction as dirty
+                state.dbstates.setdefault(self, transactions.DbChanges())
+                #too many properties to track, invalidate every cached result
+                self._recordChanges(None)
+            self.model.addStatements(stmts)
+            count += len(stmts)
+        return count
+
+    def _iterBatches(self, source, batchSize, parseOptions):
+        '''
+        Yield lists of statements of about `batchSize` statements from an 
+        iterator of statements and pjson dicts.
+        '''
+        stmts = []
+        objs = []
+        header = []
+        for item in source:
+            if isinstance(item, dict):
+                if 'pjson' in item:
+                    #a pjson header applies to the objects that follow it
+                    header = [item]
+                objs.append(item)
+                if len(objs) < batchSize:
+                    continue
+                stmts.extend(pjson.Parser(**parseOptions).to_rdf(objs)[0])
+                objs = list(header)
+            elif isinstance(item, base.BaseStatement):
+                stmts.append(item)
+            else:
+                stmts.append(base.Statement(*item))
+            if len(stmts) >= batchSize:
+                yield stmts
+                stmts = []
+        if len(objs) > len(header):
+            stmts.extend(pjson.Parser(**parseOptions).to_rdf(objs)[0])
+        if stmts:
+            yield stmts
+
     def _removePropLists(self, stmts):
         removed = []
         if not self.model.canHandleStatementWithOrder:
@@ -433,6 +625,8 @@ class BasicStore(DataStore):
                     rowStmt = base.Statement(*row[:5])
                     self.model.removeStatement(rowStmt)
                     removed.append(rowStmt)
+        if removed:
+            self._recordChanges(removed)
         return removed
 
     def _getStatementsForResources(self, resources):
@@ -520,7 +714,7 @@ class BasicStore(DataStore):
     def _remove(self, removes, proplistremoves=[]):
         stmts, jsonrep, emptyobjs = self._toStatements(removes)
         if stmts: #invalidate cache
-            self.requestProcessor.txnSvc.state.queryCache = {}
+            self._recordChanges(stmts)
 
         if self.removeTrigger and stmts:
             self.removeTrigger(self, stmts+proplistremoves, jsonrep)
@@ -705,31 +899,88 @@ class BasicStore(DataStore):
 
     def query(self, query=None, bindvars=None, explain=None, debug=False, 
         forUpdate=False, captureErrors=False, contextShapes=None, useSerializer=True,
-        printast=False):
+        printast=False, stream=False):
         import vesper.query
         #XXX theorectically some queries might not be readonly, set flag as appropriate
         if not self.join(self.requestProcessor.txnSvc, readOnly=True):
             #not in a transaction, so call this inside one
             func = lambda: self.query(query, bindvars, explain,
-                        debug, forUpdate, captureErrors, contextShapes, useSerializer)
+                        debug, forUpdate, captureErrors, contextShapes, useSerializer,
+                        printast, stream)
             return self.requestProcessor.executeTransaction(func)
         
         if not contextShapes:
             contextShapes = {dict:defaultattrdict}
-        if useSerializer and isinstance(useSerializer, (bool, int, float)):            
-            pjsonOptions=self.model_options.get('serializeOptions',{}).get('pjson')
-            if pjsonOptions is not None:
-                useSerializer = pjsonOptions
+        useSerializer = self._getSerializerOptions(useSerializer)
+        
+        cacheKey = None
+        if (self.query_result_cache and not explain and not debug 
+                and not forUpdate and not printast and not stream):
+            start = time.clock()
+            cacheKey = self._getResultCacheKey(query, bindvars, contextShapes, 
+                                                                useSerializer)
+            if cacheKey is not None:
+                cachedResults = vesper.query.resultCache.get(cacheKey)
+                if cachedResults is not None:
+                    if captureErrors:
+                        #return what getResults() would have
+                        return attrdict(results=cachedResults, errors=[],
+                                            elapsed=time.clock() - start)
+                    return cachedResults
+                generation = self._resultCacheOwner.generation
                 
         cache = self.requestProcessor.txnSvc.state.queryCache
         results = vesper.query.getResults(query, self.model, bindvars, explain,
-          debug, forUpdate, captureErrors, contextShapes, useSerializer, printast, cache)
-        self.log.debug('%s elapsed for query %s', results.elapsed, query)
+          debug, forUpdate, captureErrors, contextShapes, useSerializer, printast, 
+          cache, stream)
+        if results.elapsed is not None:
+            self.log.debug('%s elapsed for query %s', results.elapsed, query)
+        if cacheKey is not None and not results.errors:
+            if isinstance(query, (str, unicode)):
+                ast = vesper.query.buildAST(query)[0]
+            else:
+                ast = query
+            vesper.query.resultCache.put(cacheKey, self._resultCacheOwner, 
+                generation, vesper.query.getQueryDependencies(ast), 
+                results.results)
         if not captureErrors and not explain and not debug:
             return results.results
         else:
             return results
 
+    def _getResultCacheKey(self, query, bindvars, contextShapes, useSerializer):
+        '''
+        Returns the key used to look up the query in the result cache or None 
+        if the results can't be cached.
+        '''
+        import vesper.query
+        state = self.requestProcessor.txnSvc.state
+        if self in getattr(state, 'changedProperties', {}):
+            #the results include the uncommitted changes
+            return None
+        owner = self._resultCacheOwner
+        revision = self.getRevision()
+        if owner.revision != revision:
+            #the store was modified outside of this process
+            vesper.query.resultCache.invalidate(owner)
+            owner.revision = revision
+        return vesper.query.resultCache.getKey(owner, query, bindvars, 
+                                                contextShapes, useSerializer)
+
+    def prepare(self, query):
+        '''
+        Parse the given query and return a `PreparedQuery` that can be 
+        executed repeatedly with different bindvars.
+        '''
+        return PreparedQuery(self, query)
+
+    def _getSerializerOptions(self, useSerializer=True):
+        if useSerializer and isinstance(useSerializer, (bool, int, float)):            
+            pjsonOptions=self.model_options.get('serializeOptions',{}).get('pjson')
+            if pjsonOptions is not None:
+                useSerializer = pjsonOptions
+        return useSerializer
+
     def merge(self,changeset): 
         if not self.join(self.requestProcessor.txnSvc, setCurrentTxn=False):
             #not in a transaction, so call this inside one
@@ -870,6 +1121,74 @@ class TwoPhaseTxnGraphManagerAdapter(transactions.TransactionParticipant):
         self.ctxStmts = None
         self.dirty = False
 
+class PreparedQuery(object):
+    '''
+    A query that has been parsed once (see `BasicStore.prepare`) and can be
+    executed many times with different bindvars. 
+    
+    The query plan (e.g. join order) is still chosen when the query is 
+    executed since it depends on the bindvars and the store's statistics.
+    The query is prepared again if the store's schema or serialization 
+    options change. Executing a PreparedQuery doesn't modify it (except to 
+    prepare it again) so it can be shared between threads.
+    '''
+    
+    def __init__(self, dataStore, query):
+        self.dataStore = dataStore
+        self.query = query
+        self._prepared = None
+        self._prepare()
+
+    def _prepare(self):
+        '''
+        Return the `(schemaVersion, ast, serializerOptions, serializer)` the 
+        query was prepared with, preparing it again if the store's schema or 
+        serialization options have changed since.
+        '''
+        import vesper.query
+        schemaVersion = self.dataStore.schemaVersion
+        options = self.dataStore._getSerializerOptions()
+        #read once since another thread could replace it
+        prepared = self._prepared
+        if prepared is not None and prepared[0] == schemaVersion:
+            if prepared[2] == options:
+                return prepared
+            ast = prepared[1]
+        else:
+            ast, errors = vesper.query.buildAST(self.query, 
+                                            useCache=prepared is None)
+            if ast is None:
+                raise vesper.query.QueryException('\n'.join(errors))
+        serializer = vesper.query.makeSerializer(ast, options)
+        prepared = (schemaVersion, ast, copy.deepcopy(options), serializer)
+        self._prepared = prepared
+        return prepared
+
+    ast = property(lambda self: self._prepare()[1])
+
+    def getSerializer(self):
+        '''
+        Return the serializer used to construct the results, creating a new 
+        one if the store's schema or serialization options have changed.
+        '''
+        return self._prepare()[3]
+
+    def execute(self, bindvars=None, explain=None, debug=False, 
+            forUpdate=False, captureErrors=False, contextShapes=None, 
+            useSerializer=True, stream=False):
+        '''
+        Execute the query, see `BasicStore.query` for the arguments and 
+        return value.
+        '''
+        schemaVersion, ast, options, serializer = self._prepare()
+        if useSerializer:
+            useSerializer = serializer
+        if bindvars:
+            bindvars = dict(bindvars) #evaluation rewrites the bindvars 
+        return self.dataStore.query(ast, bindvars, explain, debug, 
+            forUpdate, captureErrors, contextShapes, useSerializer, 
+            stream=stream)
+
 class ModelWrapper(base.Model):
 
     def __init__(self, model, adapter):
@@ -11,7 +11,7 @@ from vesper.backports import *
 from vesper import utils
 from vesper.data.base.utils import *
 
-import os.path, sys, time
+import os.path, sys, time, itertools, heapq, threading
 
 import logging 
 log = logging.getLogger("RxPath")
@@ -44,6 +44,8 @@ class Tupleset(object):
     Interface for representing a set of tuples
     '''
     columns = None
+    #: position of the column the rows are known to be (ascendingly) sorted by
+    orderedBy = None
 
     def findColumnPos(self, label, rowinfo=False, shallow=False, pos=(), count=1):
         if not self.columns:
@@ -113,6 +115,12 @@ class Tupleset(object):
     
 class Model(Tupleset):
     canHandleStatementWithOrder = False
+    #: if True getStatements() honors the 'subjectorder' hint by returning
+    #: an iterator that lazily yields the statements in subject order
+    canStreamBySubject = False
+    #: if True the query engine passes filters to `evaluateFilter()` so the 
+    #: model can evaluate them itself (e.g. by translating them into SQL)
+    canEvaluateFilter = False
     updateAdvisory = False    
     bnodePrefix = BNODE_BASE
     
@@ -139,7 +147,7 @@ class Model(Tupleset):
                     value = value.uri
                 kw[labels[key] ] = value
         kw['hints'] = hints
-        for stmt in self.getStatements(**kw):
+        for stmt in self.iterStatements(**kw):
             objectType = stmt[3]
             if objectType == OBJECT_TYPE_RESOURCE:
                 value = ResourceUri(stmt[2])
@@ -173,6 +181,15 @@ class Model(Tupleset):
         '''
         assert object is not None or objecttype
         raise NotImplementedError 
+
+    def iterStatements(self, subject = None, predicate = None, object=None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Like `getStatements()` but returns an iterator. Models that can 
+        yield their statements without building a list first override this.
+        '''
+        return iter(self.getStatements(subject, predicate, object, 
+                                    objecttype, context, asQuad, hints))
         
     def addStatement(self, statement):
         '''add the specified statement to the model'''
@@ -195,6 +212,43 @@ class Model(Tupleset):
         for s in statements:
             self.removeStatement(s)
 
+    def evaluateFilter(self, op, conditions, joins, engine, context, hints=None):
+        '''
+        Return a `Tupleset` of the rows (in the form returned by `filter()`) 
+        that match the given `jqlAST.Filter` or None to have the query engine 
+        evaluate the filter itself.
+
+        `conditions` is a list of position:value mappings derived from the 
+        filter's `Eq` and `In` predicates; each row must match one of them 
+        exactly. `joins` is a list of `(filter, conditions)` pairs for the 
+        other filters the filter is inner joined with on the subject; rows 
+        whose subject doesn't match every one of those can be omitted. 
+        The query engine applies the filter's remaining predicates to the 
+        rows that are returned, so the model may evaluate them too but 
+        doesn't have to.
+        '''
+        return None
+
+    def evaluateJoin(self, filters, engine, context):
+        '''
+        Evaluate the inner join on the subject of the given filters or return 
+        None to have the query engine evaluate the join itself.
+
+        `filters` is a list of `(filter, conditions)` pairs, like the `joins` 
+        passed to `evaluateFilter()`, for filters that only have `Eq` and 
+        `In` predicates. Returns a list with a `Tupleset` for each filter 
+        that contains its rows whose subject matches every filter, ordered by
+        subject.
+        '''
+        return None
+
+    def getStatistics(self):
+        '''
+        Return the `ModelStatistics` maintained by this model or None if the 
+        model doesn't maintain statistics.
+        '''
+        return None
+
     reifiedIDs = None
     def findStatementIDs(self, stmt):        
         if self.reifiedIDs is None:
@@ -202,6 +256,300 @@ class Model(Tupleset):
         triple = (stmt.subject, stmt.predicate, stmt.object, stmt.objectType)
         return self.reifiedIDs.get(triple)
 
+#: the number of distinct values a `_ValueSample` counts exactly before it 
+#: starts sampling them
+_MAX_SAMPLE = 32
+#: the number of buckets in a predicate's object histogram
+_HISTOGRAM_BUCKETS = 32
+
+class _ValueSample(object):
+    '''
+    A bounded, distinct sample of the values in one position of a 
+    predicate's statements. Values whose hash has its lowest `level` bits 
+    set to 0 are counted exactly; every time the sample grows too large the
+    level goes up by one, which drops about half of the values. So about 1
+    in 2**level distinct values is in the sample, and whether a value is
+    in the sample doesn't depend on how often it occurs.
+    '''
+    __slots__ = ('level', 'counts')
+
+    def __init__(self):
+        self.level = 0
+        self.counts = {}
+
+    def add(self, value):
+        if hash(value) & ((1 << self.level) - 1):
+            return
+        counts = self.counts
+        counts[value] = counts.get(value, 0) + 1
+        if len(counts) > _MAX_SAMPLE:
+            self.level += 1
+            mask = (1 << self.level) - 1
+            for value in counts.keys():
+                if hash(value) & mask:
+                    del counts[value]
+
+    def remove(self, value):
+        counts = self.counts
+        count = counts.get(value)
+        if count is None:
+            return
+        if count > 1:
+            counts[value] = count - 1
+        else:
+            del counts[value]
+
+    def get(self, value):
+        '''
+        Return the number of times the value occurs or None if the value 
+        isn't one that the sample counts.
+        '''
+        if hash(value) & ((1 << self.level) - 1):
+            return None
+        return self.counts.get(value, 0)
+
+    def distinct(self):
+        return len(self.counts) << self.level
+
+def _distinctUnion(samples):
+    '''
+    Estimate the number of distinct values in the union of the samples.
+    '''
+    level = max([sample.level for sample in samples])
+    mask = (1 << level) - 1
+    values = set()
+    for sample in samples:
+        values.update([value for value in sample.counts 
+                                        if not hash(value) & mask])
+    return len(values) << level
+
+class _PredicateStatistics(object):
+    '''
+    The statistics for one predicate: the number of statements, samples of
+    its subjects and objects and a histogram of its objects, bucketed by 
+    hash.
+    '''
+    __slots__ = ('count', 'subjects', 'objects', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.subjects = _ValueSample()
+        self.objects = _ValueSample() #of (object, objecttype)
+        self.histogram = [0] * _HISTOGRAM_BUCKETS
+
+    def add(self, stmt):
+        self.count += 1
+        self.subjects.add(stmt[0])
+        object = (stmt[2], stmt[3])
+        self.objects.add(object)
+        self.histogram[(hash(object) >> 8) % _HISTOGRAM_BUCKETS] += 1
+
+    def remove(self, stmt):
+        self.count -= 1
+        self.subjects.remove(stmt[0])
+        object = (stmt[2], stmt[3])
+        self.objects.remove(object)
+        self.histogram[(hash(object) >> 8) % _HISTOGRAM_BUCKETS] -= 1
+
+    def estimateSubject(self, subject):
+        count = self.subjects.get(subject)
+        if count is None:
+            #not sampled, assume it's average
+            return self.count / float(max(self.subjects.distinct(), 1))
+        return float(count)
+
+    def estimateObject(self, object, objecttype):
+        if objecttype is None:
+            #the average literal
+            return self.count / float(max(self.objects.distinct(), 1))
+        object = (object, objecttype)
+        count = self.objects.get(object)
+        if count is not None:
+            return float(count)
+        inBucket = self.histogram[(hash(object) >> 8) % _HISTOGRAM_BUCKETS]
+        if not inBucket:
+            return 0.0
+        #a frequent value stands out from the average bucket
+        others = (self.count - inBucket) / float(_HISTOGRAM_BUCKETS - 1)
+        average = self.count / float(max(self.objects.distinct(), 1))
+        return min(inBucket, max(inBucket - others, average))
+
+class ModelStatistics(object):
+    '''
+    Cardinality statistics that a model maintains incrementally as statements
+    are added and removed. For each predicate this tracks the number of 
+    statements, estimates of the number of distinct subjects and objects 
+    and a histogram of the object values. Their size doesn't depend on the 
+    size of the model.
+    The query engine uses these to estimate the cost of filters.
+    '''
+    
+    def __init__(self, stmts=()):
+        self.count = 0
+        self.predicates = {}
+        for stmt in stmts:
+            self.add(stmt)
+
+    def add(self, stmt):
+        predstats = self.predicates.get(stmt[1])
+        if predstats is None:
+            predstats = self.predicates[stmt[1]] = _PredicateStatistics()
+        predstats.add(stmt)
+        self.count += 1
+
+    def remove(self, stmt):
+        predstats = self.predicates.get(stmt[1])
+        if predstats is None:
+            return
+        if predstats.count <= 1:
+            del self.predicates[stmt[1]]
+        else:
+            predstats.remove(stmt)
+        self.count -= 1
+
+    def getPredicateStatistics(self, predicate):
+        '''
+        Return the statistics for the predicate or None if no statement 
+        has the predicate.
+        '''
+        return self.predicates.get(predicate)
+
+    def _allPredicateStatistics(self):
+        return self.predicates.values()
+
+    def predicateCount(self, predicate):
+        predstats = self.getPredicateStatistics(predicate)
+        return predstats and predstats.count or 0
+
+    def distinctSubjects(self, predicate):
+        predstats = self.getPredicateStatistics(predicate)
+        return predstats and predstats.subjects.distinct() or 0
+
+    def distinctObjects(self, predicate):
+        predstats = self.getPredicateStatistics(predicate)
+        return predstats and predstats.objects.distinct() or 0
+
+    def _estimateForPredicate(self, predstats, subject, object, objecttype):
+        if not predstats.count:
+            return 0.0
+        if object is not None:
+            objcount = predstats.estimateObject(object, objecttype)
+            if subject is None:
+                return objcount
+            #assume the subject and object are independent
+            return (predstats.estimateSubject(subject) * objcount 
+                                                    / predstats.count)
+        elif subject is not None:
+            return predstats.estimateSubject(subject)
+        return float(predstats.count)
+    
+    def estimate(self, subject=None, predicate=None, object=None, objecttype=None):
+        '''
+        Estimate the number of statements that match the given pattern.
+        This only returns 0 if no statement matches.
+        '''
+        if isinstance(subject, ResourceUri):
+            subject = subject.uri
+        if isinstance(object, ResourceUri):
+            object = object.uri
+            objecttype = OBJECT_TYPE_RESOURCE
+        if predicate is not None:
+            predstats = self.getPredicateStatistics(predicate)
+            if predstats is None:
+                return 0.0
+            return self._estimateForPredicate(predstats, subject, object, objecttype)
+        if subject is None and object is None:
+            return float(self.count)
+        return sum([self._estimateForPredicate(predstats, subject, object, objecttype)
+                                for predstats in self._allPredicateStatistics()])
+
+    def selectivity(self, predicate, test):
+        '''
+        Return the fraction of the statements with the given predicate whose 
+        object value satisfies `test` (a function that takes a json value), 
+        or None if that can't be determined. This is estimated from the 
+        sample of object values.
+        '''
+        from vesper import pjson
+        predstats = self.getPredicateStatistics(predicate)
+        if predstats is None or not predstats.count:
+            return 0.0
+        matches = 0
+        for (object, objecttype), count in predstats.objects.counts.iteritems():
+            if objecttype == OBJECT_TYPE_RESOURCE:
+                value = ResourceUri(object)
+            else:
+                value = pjson.toJsonValue(object, objecttype)
+            if test(value):
+                matches += count
+        #each sampled value stands for 2**level values
+        matches <<= predstats.objects.level
+        return min(matches / float(predstats.count), 1.0)
+
+class LazyModelStatistics(ModelStatistics):
+    '''
+    Statistics for models that are too large to scan when they're opened.
+    The statistics for a predicate are built the first time they're needed
+    and kept up-to-date after that.
+
+    `countStatements()` returns the number of statements in the model, 
+    `listPredicates()` returns its predicates and `scanPredicate(predicate, 
+    add)` calls `add(stmt)` for each statement with that predicate (only 
+    the statement's subject, predicate, object and object type are used).
+    '''
+
+    def __init__(self, countStatements, listPredicates, scanPredicate):
+        self.countStatements = countStatements
+        self.listPredicates = listPredicates
+        self.scanPredicate = scanPredicate
+        self._count = None
+        self.predicates = {}
+
+    def _getCount(self):
+        if self._count is None:
+            self._count = self.countStatements()
+        return self._count
+    count = property(_getCount)
+
+    def add(self, stmt):
+        if self._count is not None:
+            self._count += 1
+        predstats = self.predicates.get(stmt[1])
+        if predstats is not None:
+            predstats.add(stmt)
+
+    def remove(self, stmt):
+        if self._count is not None:
+            self._count -= 1
+        predstats = self.predicates.get(stmt[1])
+        if predstats is not None:
+            predstats.remove(stmt)
+
+    def invalidate(self, predicates):
+        '''
+        Forget the statistics for the given predicates (and the number of 
+        statements), e.g. after statements were added without being passed 
+        to `add()`.
+        '''
+        self._count = None
+        for predicate in predicates:
+            self.predicates.pop(predicate, None)
+
+    def getPredicateStatistics(self, predicate):
+        predstats = self.predicates.get(predicate)
+        if predstats is None:
+            predstats = _PredicateStatistics()
+            self.scanPredicate(predicate, predstats.add)
+            self.predicates[predicate] = predstats
+        if not predstats.count:
+            return None
+        return predstats
+
+    def _allPredicateStatistics(self):
+        stats = [self.getPredicateStatistics(predicate) 
+                                    for predicate in self.listPredicates()]
+        return [predstats for predstats in stats if predstats is not None]
+
 class TxnState(object):
     BEGIN = 'BEGIN'
     READ = 'READ'
@@ -247,6 +595,98 @@ def removeDupStatementsFromSortedList(aList, asQuad=True, pred=None,
         aList = aList[:limit]
     return aList
 
+def removeDupStatementsFromSortedIterator(stmts, asQuad=True, limit=None, 
+                                                                offset=None):
+    '''
+    Lazy version of `removeDupStatementsFromSortedList` for an iterator 
+    that yields statements in sorted order.
+    '''
+    def removeDups(stmts):
+        last = None
+        for stmt in stmts:
+            if (last is None or (asQuad and last != stmt) 
+                    or (not asQuad and last[:4] != stmt[:4])):
+                yield stmt
+                last = stmt
+    stmts = removeDups(stmts)
+    if limit is None and not offset:
+        return stmts
+    start = offset or 0
+    if limit is not None:
+        stop = start + limit
+    else:
+        stop = None
+    return itertools.islice(stmts, start, stop)
+
+def _mergeSorted(left, right):
+    '''
+    Merge two iterators that yield items in sorted order.
+    '''
+    left, right = iter(left), iter(right)
+    try:
+        l = left.next()
+    except StopIteration:
+        for r in right:
+            yield r
+        return
+    try:
+        r = right.next()
+    except StopIteration:
+        yield l
+        for l in left:
+            yield l
+        return
+    while 1:
+        if l <= r:
+            yield l
+            try:
+                l = left.next()
+            except StopIteration:
+                yield r
+                for r in right:
+                    yield r
+                return
+        else:
+            yield r
+            try:
+                r = right.next()
+            except StopIteration:
+                yield l
+                for l in left:
+                    yield l
+                return
+
+def _mergeAll(iterators):
+    '''
+    Merge any number of iterators that yield items in sorted order.
+    '''
+    heap = []
+    for i, items in enumerate(iterators):
+        items = iter(items)
+        for item in items:
+            #i breaks ties so the iterators themselves are never compared
+            heap.append( (item, i, items) )
+            break
+    heapq.heapify(heap)
+    while heap:
+        item, i, items = heap[0]
+        yield item
+        for item in items:
+            heapq.heapreplace(heap, (item, i, items))
+            break
+        else:
+            heapq.heappop(heap)
+
+def _peek(stmts):
+    '''
+    Return an iterator equivalent to `stmts` or None if it is empty.
+    '''
+    try:
+        first = stmts.next()
+    except StopIteration:
+        return None
+    return itertools.chain([first], stmts)
+
 class MultiModel(Model):
     '''
     This allows one writable model and multiple read-only models.
@@ -254,8 +694,16 @@ class MultiModel(Model):
     Useful for allowing static information in the model, for example representations of the application.    
     '''
     
+    #: skip the read-only models whose statistics show they can't match
+    useStatistics = True
+
     def __init__(self, writableModel, *readonlyModels):
         self.models = (writableModel,) + readonlyModels        
+
+    def getStatistics(self):
+        #the read-only models are usually small (e.g. application data)
+        #so just use the writable model's statistics
+        return self.models[0].getStatistics()
         
     autocommit = property(lambda self: self.models[0].autocommit,
                  lambda self, set: setattr(self.models[0], 'autocommit', set))
@@ -268,48 +716,61 @@ class MultiModel(Model):
     def rollback(self):
         self.models[0].rollback()        
 
-    def _handleHints(self, hints, currentcount):
-        return {}
-        #XXX we can do this if know order isn't important       
-        if not hints:
-            return hints
-        limit = hints.get('limit')
-        if limit is not None:
-            limit -= currentcount
-            if limit < 1:
-                return 'done'
-            hints['limit'] = limit
-
-        offset = hints.get('offset')
-        if offset is not None:
-            offset -= currentcount
-            hints['offset'] = offset
+    def _canMatch(self, model, subject, predicate, object, objecttype):
+        '''
+        Return False if the model's statistics show it has no statements that
+        match the pattern.
+        '''
+        stats = model.getStatistics()
+        if stats is None:
+            return True
+        return stats.estimate(subject, predicate, object, objecttype) > 0
     
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
         ''' Return all the statements in the model that match the given arguments.
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.'''
-        statements = []
-        changed = 0
+        return list(MultiModel.iterStatements(self, subject, predicate, object,
+                                    objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Streams a merge of each model's (sorted) statements. A limit is 
+        passed on to each model (as offset + limit) and read-only models whose
+        statistics show they have no matching statements aren't queried.
+        '''
+        limit = offset = None
         _hints = hints and hints.copy() or {}
-        for model in self.models:
-            _hints = self._handleHints(_hints, len(statements))
-            if _hints == 'done':
-                break
-            
-            moreStatements = model.getStatements(subject, predicate,object,
-                                              objecttype,context, asQuad, _hints)
-            if moreStatements:
-                changed += 1
-                statements.extend(moreStatements)
-
-        if changed > 1 or hints:        
-            statements.sort()
-            return removeDupStatementsFromSortedList(statements, asQuad, 
-                                                            **(hints or {}))
+        if hints:
+            limit = _hints.get('limit')
+            offset = _hints.pop('offset', None)
+            if limit is not None:
+                #each model only needs to return enough statements to 
+                #fill the page after the offset is skipped
+                _hints['limit'] = limit + (offset or 0)
+        iterators = []
+        for i, model in enumerate(self.models):
+            #the read-only models' statistics are always up-to-date
+            if i and self.useStatistics and not self._canMatch(model, subject, predicate, object, 
+                                                                objecttype):
+                continue
+            moreStatements = _peek(model.iterStatements(subject, predicate,
+                                object, objecttype, context, asQuad, _hints))
+            if moreStatements is not None:
+                iterators.append(moreStatements)
+
+        if not iterators:
+            return iter(())
+        elif len(iterators) == 1:
+            if not hints:
+                return iterators[0]
+            statements = iterators[0]
         else:
-            return statements            
+            statements = _mergeAll(iterators)
+        return removeDupStatementsFromSortedIterator(statements, asQuad,
+                                                            limit, offset)
                      
     def addStatement(self, statement ):
         '''add the specified statement to the model'''
@@ -348,7 +809,12 @@ class MirrorModel(Model):
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
         return self.models[0].getStatements(subject, predicate, object,
-                                            objecttype,context, asQuad)
+                                            objecttype,context, asQuad, hints)
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        return self.models[0].iterStatements(subject, predicate, object,
+                                            objecttype,context, asQuad, hints)
                      
     def addStatement(self, statement ):
         retval = False
@@ -390,6 +856,193 @@ class ViewModel(MirrorModel):
     def rollback(self):
         raise RuntimeError("invalid operation for ViewModel")
                 
+def _statementsSize(stmts):
+    '''
+    Approximate the number of bytes used by the given statements.
+    '''
+    #a rough allowance for the tuple and string object headers
+    size = 0
+    for stmt in stmts:
+        size += 120 + len(stmt[0]) + len(stmt[1]) + len(stmt[2]) \
+                                    + len(stmt[3]) + len(stmt[4])
+    return size
+
+class CachingModel(Model):
+    '''
+    Wraps a model and caches the results of lookups by subject, predicate or 
+    object in a bounded LRU cache, for models where each lookup is expensive
+    (e.g. network or disk based stores). Lookups without any of those are
+    just passed to the model.
+
+    `capacity` is the (approximate) number of bytes of statements to cache
+    and lookups with results larger than `maxResultSize` aren't cached.
+    Adding or removing a statement only invalidates the lookups that could 
+    match it: the ones on its subject, the ones on its predicate without a 
+    subject and the ones on its object without a subject or predicate. 
+    All changes have to be made through the CachingModel for the cache to 
+    be accurate.
+
+    `hits` and `misses` count cache lookups.
+    '''
+
+    def __init__(self, model, capacity=10*1024*1024, maxResultSize=None):
+        from vesper.utils import MRUCache
+        self.model = model
+        self.cache = MRUCache.MRUCache(capacity, 
+                        capacityCalc=lambda key, value: _statementsSize(value),
+                        maxValueSize=maxResultSize or capacity / 10)
+        self.lock = threading.Lock()
+        #: incremented each time the cache is invalidated
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    autocommit = property(lambda self: self.model.autocommit,
+                 lambda self, set: setattr(self.model, 'autocommit', set))
+    
+    updateAdvisory = property(lambda self: self.model.updateAdvisory)
+
+    canStreamBySubject = property(lambda self: self.model.canStreamBySubject)
+
+    canEvaluateFilter = property(lambda self: self.model.canEvaluateFilter)
+
+    def getStatistics(self):
+        return self.model.getStatistics()
+
+    def evaluateFilter(self, *args, **kw):
+        return self.model.evaluateFilter(*args, **kw)
+
+    def evaluateJoin(self, *args, **kw):
+        return self.model.evaluateJoin(*args, **kw)
+
+    def commit(self, **kw):
+        self.model.commit(**kw)
+
+    def rollback(self):
+        self.model.rollback()
+        #lookups may have included the changes that were rolled back
+        self.clear()
+
+    def close(self):
+        self.model.close()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.cache.clear()
+        finally:
+            self.lock.release()
+
+    def _getKey(self, subject, predicate, object, objecttype, context, 
+                                                            asQuad, hints):
+        from vesper.utils.MRUCache import InvalidationKey
+        if isinstance(object, ResourceUri):
+            object = object.uri
+            objecttype = OBJECT_TYPE_RESOURCE
+        #the key includes the field that changes will be checked against
+        if subject is not None:
+            field = ('s', subject)
+        elif predicate is not None:
+            field = ('p', predicate)
+        elif object is not None:
+            field = ('o', object)
+        else:
+            return None
+        if hints:
+            hints = hints.items()
+            hints.sort()
+            hints = tuple(hints)
+        key = (InvalidationKey(field), subject, predicate, object, objecttype,
+                                                    context, asQuad, hints)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def getStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        key = self._getKey(subject, predicate, object, objecttype, context,
+                                                                asQuad, hints)
+        if key is None:
+            return self.model.getStatements(subject, predicate, object,
+                                        objecttype, context, asQuad, hints)
+        cache = self.cache
+        self.lock.acquire()
+        try:
+            generation = self.generation
+            if key in cache.nodeDict:
+                self.hits += 1
+                #this just updates the entry's position in the LRU list
+                return list(cache.getOrCalcValue(None, key, 
+                                                hashCalc=lambda key: key))
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        stmts = tuple(self.model.getStatements(subject, predicate, object,
+                                        objecttype, context, asQuad, hints))
+        self.lock.acquire()
+        try:
+            #don't add the results if there was a change while getting them
+            if self.generation == generation:
+                cache.getOrCalcValue(lambda key: stmts, key, 
+                                                    hashCalc=lambda key: key)
+        finally:
+            self.lock.release()
+        return list(stmts)
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        if (subject is None and predicate is None and object is None):
+            #not cached, so stream it
+            return self.model.iterStatements(subject, predicate, object,
+                                        objecttype, context, asQuad, hints)
+        return iter(CachingModel.getStatements(self, subject, predicate, 
+                                object, objecttype, context, asQuad, hints))
+
+    def _invalidate(self, stmts):
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            for stmt in stmts:
+                self.cache.invalidate( ('s', stmt[0]) )
+                self.cache.invalidate( ('p', stmt[1]) )
+                self.cache.invalidate( ('o', stmt[2]) )
+        finally:
+            self.lock.release()
+
+    def addStatement(self, statement ):
+        '''add the specified statement to the model'''
+        try:
+            return self.model.addStatement(statement)
+        finally:
+            self._invalidate( (statement,) )
+
+    def addStatements(self, statements):
+        '''add the specified statements to the model'''
+        statements = list(statements)
+        try:
+            return self.model.addStatements(statements)
+        finally:
+            self._invalidate(statements)
+        
+    def removeStatement(self, statement ):
+        '''removes the statement'''
+        try:
+            return self.model.removeStatement(statement)
+        finally:
+            self._invalidate( (statement,) )
+
+    def removeStatements(self, statements):
+        '''removes the statements'''
+        statements = list(statements)
+        try:
+            return self.model.removeStatements(statements)
+        finally:
+            self._invalidate(statements)
+
 class TransactionModel(object):
     '''
     Provides transaction functionality for models that don't already have that.
@@ -402,15 +1055,79 @@ class TransactionModel(object):
         
     TransactionalMyModel(TransactionModel, MyModel): pass
     '''
-    queue = None 
     updateAdvisory = False
     
     def __init__(self, *args, **kw):
+        self.queue = None
         #don't create a transaction for the initial statements
         self.autocommit = True 
         super(TransactionModel, self).__init__(*args, **kw)
         self.autocommit = False
 
+    def _getQueue(self):
+        if self._cancelled:
+            #drop the changes that were cancelled out
+            self._log = [change for change in self._log if change is not None]
+            self._positions = dict([(tuple(change[-1][:5]), i)
+                                    for i, change in enumerate(self._log)])
+            self._cancelled = 0
+        return self._log
+
+    def _setQueue(self, queue):
+        #: the pending changes in the order they were made: 
+        #: (stmt,) or (Removed, stmt), None if cancelled by a later change
+        self._log = []
+        #: statement key => position in _log
+        self._positions = {}
+        self._cancelled = 0
+        #: pending adds and removes, statement key => statement
+        self._added = {}
+        self._removed = {}
+        #: pending adds by subject, predicate and object
+        self._addedIndexes = ({}, {}, {})
+        for change in queue or ():
+            if change[0] is Removed:
+                self._queueRemove(change[1])
+            else:
+                self._queueAdd(change[0])
+
+    queue = property(_getQueue, _setQueue, doc='''
+        The list of pending changes in the order they were made, each either 
+        (stmt,) or (Removed, stmt)''')
+
+    def _cancel(self, key):
+        self._log[self._positions.pop(key)] = None
+        self._cancelled += 1
+
+    def _queueAdd(self, stmt):
+        key = tuple(stmt[:5])
+        if key in self._removed:
+            #cancels the pending remove
+            del self._removed[key]
+            self._cancel(key)
+        elif key not in self._added:
+            self._added[key] = stmt
+            for i, index in enumerate(self._addedIndexes):
+                index.setdefault(key[i], {})[key] = stmt
+            self._positions[key] = len(self._log)
+            self._log.append( (stmt,) )
+
+    def _queueRemove(self, stmt):
+        key = tuple(stmt[:5])
+        if key in self._added:
+            #cancels the pending add
+            del self._added[key]
+            for i, index in enumerate(self._addedIndexes):
+                stmts = index[key[i]]
+                del stmts[key]
+                if not stmts:
+                    del index[key[i]]
+            self._cancel(key)
+        elif key not in self._removed:
+            self._removed[key] = stmt
+            self._positions[key] = len(self._log)
+            self._log.append( (Removed, stmt) )
+
     def commit(self, **kw):    
         if not self.queue:
             self.txnState = TxnState.BEGIN
@@ -460,38 +1177,65 @@ class TransactionModel(object):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
-        statements = super(TransactionModel, self).getStatements(subject,
-                                predicate, object,objecttype,context, asQuad,hints)
-        if not self.queue: 
-            return statements
+        return list(TransactionModel.iterStatements(self, subject, predicate,
+                                object, objecttype, context, asQuad, hints))
 
+    def _iterStoreStatements(self, *args):
+        store = super(TransactionModel, self)
+        if store.iterStatements.im_func is Model.iterStatements.im_func:
+            #the default implementation would call our getStatements
+            return iter(store.getStatements(*args))
+        return store.iterStatements(*args)
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Merges the queued changes into the store's (sorted) statements as they 
+        are streamed.
+        '''
         #avoid phantom reads, etc.
-        changed = False
-        for stmt in self.queue:
-            if stmt[0] is Removed:
-                stmt = stmt[1] 
-                if self._match(stmt, subject, predicate, object,
-                                               objecttype,context):
-                    try:                        
-                        i = 0
-                        while 1:
-                            i = statements.index(stmt, i)                            
-                            del statements[i]
-                            changed = True
-                            i+=1
-                    except ValueError:
-                        pass
+        added = self._getAdded(subject, predicate, object, objecttype, context)
+        removed = self._removed
+        if not added and not removed:
+            return self._iterStoreStatements(subject, predicate, object,
+                                        objecttype, context, asQuad, hints)
+
+        #get every context's statements, a removed statement can't hide
+        #another context's statement when the store removes duplicates
+        statements = self._iterStoreStatements(subject, predicate, object,
+                                                objecttype, context, True)
+        if added:
+            statements = _mergeSorted(statements, added)
+        if removed:
+            #removes aren't indexed, the store's statements are just checked
+            statements = (stmt for stmt in statements 
+                                    if tuple(stmt[:5]) not in removed)
+        hints = hints or {}
+        return removeDupStatementsFromSortedIterator(statements, asQuad, 
+                                    hints.get('limit'), hints.get('offset'))
+
+    def _getAdded(self, subject, predicate, object, objecttype, context):
+        '''
+        Return the pending adds that match, sorted.
+        '''
+        if not self._added:
+            return []
+        if subject is not None:
+            candidates = self._addedIndexes[0].get(subject, {})
+        elif predicate is not None:
+            candidates = self._addedIndexes[1].get(predicate, {})
+        elif object is not None:
+            if isinstance(object, ResourceUri):
+                candidates = self._addedIndexes[2].get(object.uri, {})
             else:
-                if self._match(stmt[0], subject, predicate, object,
-                                               objecttype,context):
-                    changed = True
-                    statements.append( stmt[0] )
-
-        if changed:        
-            statements.sort()
-            return removeDupStatementsFromSortedList(statements, asQuad, **(hints or {}))
+                candidates = self._addedIndexes[2].get(object, {})
         else:
-            return statements
+            candidates = self._added
+        added = [stmt for stmt in candidates.itervalues() 
+                    if self._match(stmt, subject, predicate, object,
+                                                    objecttype, context)]
+        added.sort()
+        return added
 
     def addStatement(self, statement ):
         '''add the specified statement to the model'''        
@@ -499,15 +1243,7 @@ class TransactionModel(object):
             return super(TransactionModel, self).addStatement(statement)
         else:
             self.txnState = TxnState.DIRTY
-        
-        if self.queue is None: 
-            self.queue = []        
-        try:
-            i = self.queue.index( (Removed, statement))
-            del self.queue[i]            
-        except ValueError:
-            #print 'addingtoqueue'
-            self.queue.append( (statement,) )            
+        self._queueAdd(statement)
         
     def removeStatement(self, statement ):
         '''removes the statement'''        
@@ -515,13 +1251,6 @@ class TransactionModel(object):
             return super(TransactionModel, self).removeStatement(statement)
         else:
             self.txnState = TxnState.DIRTY
-        
-        if self.queue is None: 
-            self.queue = []
-        try:
-            i = self.queue.index((statement,))
-            del self.queue[i]
-        except ValueError:
-            self.queue.append( (Removed, statement) )
+        self._queueRemove(statement)
 
 
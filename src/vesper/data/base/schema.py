@@ -59,6 +59,9 @@ class RDFSSchema(BaseSchema, base.MultiModel):
     inTransaction = False
     
     findCompatibleStatements = True
+    #the entailment model isn't read-only, its statistics don't include
+    #uncommitted entailments
+    useStatistics = False
     
     addEntailmentCallBack = None
     removeEntailmentCallBack = None
@@ -615,6 +618,14 @@ class RDFSSchema(BaseSchema, base.MultiModel):
         self.model.removeStatement(stmt)
         self.entailments.removeStatement(stmt)
 
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        if not self.findCompatibleStatements:
+            return super(RDFSSchema, self).iterStatements(subject,
+                        predicate,object,objecttype,context, asQuad, hints)
+        return iter(self.getStatements(subject, predicate, object,
+                                        objecttype, context, asQuad, hints))
+
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
         
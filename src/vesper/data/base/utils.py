@@ -62,7 +62,9 @@ class BaseStatement(object):
     LIST_POS = 5
 
 class Statement(tuple, BaseStatement):
-    #__slots__ = ('listpos', )
+    #no per-instance __dict__, subclasses that need attributes (like 
+    #StatementWithOrder's listpos) will get one
+    __slots__ = ()
 
     def __new__(cls, subject, predicate, object,
              objectType=OBJECT_TYPE_LITERAL, scope=''):
@@ -227,6 +229,22 @@ def NTriples2Statements(stream, defaultScope='', baseuri=None,
         yield Statement(stmt[0], stmt[1], stmt[2],stmt[3],
                                  scope or defaultScope)
                                  
+def iterNTriplesStatements(stream, defaultScope='', baseuri=None,
+                                                    charencoding='utf8'):
+    '''
+    Like `NTriples2Statements` but yields each statement as soon as it is 
+    parsed instead of after the whole stream has been read. So a triple that
+    appears more than once (e.g. in different scopes) is yielded each time
+    and "#!remove" directives aren't supported.
+    '''
+    makebNode = lambda bNode: BNODE_BASE + bNode
+    for stmt in parseTriples(stream, makebNode, charencoding=charencoding, 
+                                                            baseuri=baseuri):
+        if stmt[0] is Removed:
+            raise ParseException('"#!remove" can not be used here')
+        yield Statement(stmt[0], stmt[1], stmt[2], stmt[3], 
+                                                    stmt[4] or defaultScope)
+
 def _parseRDFJSON(jsonstring, defaultScope=None):
     '''
     Parses JSON that follows this format:
@@ -507,6 +525,136 @@ def parseRDFFromURI(uri, type='unknown', modelbaseuri=None, scope=None,
     stream.close()
     return parseRDFFromString(contents.decode('utf8'), modelbaseuri, type, scope, options, getType)
 
+def _splitLines(contents, chunkSize):
+    '''
+    Split NTriples into chunks of about `chunkSize` bytes at line boundaries,
+    keeping "#!" directives with the statement that follows them.
+    '''
+    chunks = []
+    start = 0
+    size = len(contents)
+    while start < size:
+        end = contents.find('\n', start + chunkSize)
+        if end == -1:
+            chunks.append(contents[start:])
+            break
+        end += 1
+        while contents.startswith('#!', 
+                        max(contents.rfind('\n', start, end-1) + 1, start)):
+            end = contents.find('\n', end)
+            if end == -1:
+                end = size
+                break
+            end += 1
+        chunks.append(contents[start:end])
+        start = end
+    return chunks
+
+def _initParseWorker():
+    #forked workers start with the parent's session id and bnode counter
+    #so give each one its own to keep generated bnodes unique
+    global _sessionBNodeUUID
+    _sessionBNodeUUID = 'x'+ uuid.uuid4().hex
+
+def _parseChunk(args):
+    type, chunk, baseuri = args
+    try:
+        if type == 'pjson':
+            from vesper import pjson
+            return [(stmt[:5], stmt.listpos) for stmt in 
+                pjson.tostatements(chunk, scope='', generateBnode='uuid')], None
+        else:
+            return [stmt[:5] for stmt in 
+                NTriples2Statements(StringIO.StringIO(chunk), '', baseuri)], None
+    except:
+        #the exception might not survive being pickled, so send its traceback
+        import traceback
+        return None, traceback.format_exc()
+
+def parseRDFInParallel(contents, baseuri, type, scope=None, processes=None,
+                                                    chunkSize=1024*1024):
+    '''
+    Parse NTriples ("ntriples" or "ntjson") or pjson using a pool of 
+    `processes` worker processes (by default, one per CPU). NTriples is split 
+    into chunks of about `chunkSize` bytes and the top-level list of a pjson
+    document into about 4 chunks per process.
+
+    Returns a list of Statements, or None if the contents can't be split 
+    (e.g. it's another format, the NTriples has "#!remove" lines or the 
+    multiprocessing module isn't available); parse it serially instead. 
+    '''
+    try:
+        import multiprocessing
+    except ImportError:
+        return None
+    if scope is None: 
+        scope = ''
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf8')
+    processes = processes or multiprocessing.cpu_count()
+
+    if type in ('ntriples', 'ntjson'):
+        if contents.find('#!remove') != -1:
+            return None #removals depend on the order of the whole file
+        #the parser stops at the first blank line
+        blank = re.search(r'^[ \t\r]*$', contents, re.M)
+        if blank:
+            contents = contents[:blank.start()]
+        chunks = _splitLines(contents, chunkSize)
+        if contents.startswith('#!json'):
+            chunks[1:] = ['#!json\n' + chunk for chunk in chunks[1:]]
+        chunks = [(type, chunk, baseuri) for chunk in chunks]
+    elif type == 'pjson':
+        doc = json.loads(contents)
+        header = None
+        if isinstance(doc, dict) and 'pjson' in doc:
+            header = doc
+            doc = doc.get('data', [])
+        if not isinstance(doc, list):
+            return None
+        for obj in doc:
+            if not isinstance(obj, dict) or 'pjson' in obj:
+                return None #a nested header applies to the rest of the list
+        step = len(doc) // (processes * 4) + 1
+        chunks = []
+        for i in xrange(0, len(doc), step):
+            chunk = doc[i:i+step]
+            if header is not None:
+                chunk = dict(header, data=chunk)
+            chunks.append(('pjson', chunk, baseuri))
+    else:
+        return None
+
+    pool = multiprocessing.Pool(processes, _initParseWorker)
+    try:
+        stmts = []
+        if type == 'pjson':
+            for results, error in pool.imap(_parseChunk, chunks):
+                if error is not None:
+                    raise ParseException("error parsing pjson: " + error)
+                for stmt, listpos in results:
+                    if listpos:
+                        stmts.append(StatementWithOrder(stmt[0], stmt[1], 
+                            stmt[2], stmt[3], stmt[4] or scope, listpos))
+                    else:
+                        stmts.append(Statement(stmt[0], stmt[1], stmt[2], 
+                                            stmt[3], stmt[4] or scope))
+        else:
+            #like NTriples2Statements, the last statement for a triple wins
+            stmtset = {}
+            for results, error in pool.imap(_parseChunk, chunks):
+                if error is not None:
+                    raise ParseException("error parsing NTriples: " + error)
+                for stmt in results:
+                    stmtset[stmt[:4]] = stmt[4]
+            for stmt, stmtscope in stmtset.iteritems():
+                stmts.append(Statement(stmt[0], stmt[1], stmt[2], stmt[3],
+                                                    stmtscope or scope))
+    finally:
+        pool.terminate()
+        pool.join()
+    return stmts
+
 def _serializeRDFXMLWithRdflib(stream, statements, uri2prefixMap, format='xml'):
     #note: using format "xml" instead of "pretty-xml" because that latter is buggier
     #(e.g. run RDFStaticTestCase.testSerialize with "pretty-xml")
@@ -7,7 +7,10 @@ __all__ = ['get_factory']
 _proto_map = { # XXX don't hardcode this
     'tyrant':'vesper.data.store.tyrant.TransactionTyrantStore',
     'file':'vesper.data.store.basic.FileStore',
+    'logfile':'vesper.data.store.basic.LogFileStore',
     'mem':'vesper.data.store.basic.MemStore',
+    'snapshot':'vesper.data.store.snapshot.SnapshotStore',
+    'sharded':'vesper.data.store.sharded.ShardedModel',
     'bdb':'vesper.data.store.bdb.TransactionBdbStore',
     'sqlite':'vesper.data.store.sqlite.TransactionSqliteStore'
 }
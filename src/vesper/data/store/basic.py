@@ -1,25 +1,230 @@
 #:copyright: Copyright 2009-2010 by the Vesper team, see AUTHORS.
 #:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
 from vesper.data.base import * # XXX
+import bisect, itertools, threading, logging
+
+log = logging.getLogger("store")
+
+def _iterSlice(stmts, asQuad, limit, offset):
+    '''
+    Apply the limit and offset hints to the given sorted iterator of unique
+    statements, removing statements that only differ by context unless 
+    `asQuad` is True.
+    '''
+    def removeDups(stmts):
+        last = None
+        for stmt in stmts:
+            if last is None or last[:4] != stmt[:4]:
+                yield stmt
+                last = stmt
+    if not asQuad:
+        stmts = removeDups(stmts)
+    if limit is None and not offset:
+        return stmts
+    start = offset or 0
+    if limit is not None:
+        stop = start + limit
+    else:
+        stop = None
+    return itertools.islice(stmts, start, stop)
+
+#buckets with more statements than this are kept in a `_SortedBucket` so
+#adding or removing a statement doesn't move the whole bucket, smaller ones
+#are plain sorted lists
+_MAX_LIST_BUCKET = 32
+#the number of pending changes a `_SortedBucket` always allows
+_MIN_PENDING = 64
+
+class _SortedBucket(object):
+    '''
+    A large index bucket: a sorted list of statements plus the statements
+    added to and removed from it since the list was last merged. Merging
+    creates a new list, so a list returned by `ordered()` never changes.
+    (Also used by `MemStore` to keep its subjects in order.)
+    '''
+    __slots__ = ('items', 'added', 'removed')
+
+    def __init__(self, items):
+        self.items = items
+        self.added = []
+        #a set once something is removed
+        self.removed = ()
+
+    def __len__(self):
+        return len(self.items) + len(self.added) - len(self.removed)
+
+    def __contains__(self, stmt):
+        if self.removed and stmt in self.removed:
+            return False
+        if len(self.added) > _MIN_PENDING:
+            self._merge()
+        items = self.items
+        i = bisect.bisect_left(items, stmt)
+        if i < len(items) and items[i] == stmt:
+            return True
+        return stmt in self.added
+
+    def first(self):
+        '''
+        Return one of the statements that the bucket holds or has held
+        since it was last merged.
+        '''
+        if self.items:
+            return self.items[0]
+        return self.added[0]
+
+    def add(self, stmt):
+        #the statement isn't in the bucket
+        if self.removed and stmt in self.removed:
+            #it's still in the list or in added
+            self.removed.remove(stmt)
+            return
+        #added statements are only sorted when they're needed in order
+        self.added.append(stmt)
+
+    def remove(self, stmt):
+        #the statement is in the bucket
+        removed = self.removed
+        if not removed:
+            removed = self.removed = set()
+        removed.add(stmt)
+        #the set uses more memory than the list so don't let it grow
+        if len(removed) > _MIN_PENDING and len(removed) > len(self.items) >> 4:
+            self._merge()
+
+    def _merge(self):
+        items = self.items
+        added = self.added
+        removed = self.removed
+        if removed:
+            if added:
+                #statements that were added and removed since the last merge
+                added = [stmt for stmt in added if stmt not in removed]
+                removed = removed.difference(self.added)
+            items = _splice(items, sorted(removed), False)
+        if len(added) > len(items) >> 4:
+            #sort() finds the sorted runs and merges them
+            items = items + added
+            items.sort()
+        elif added:
+            added.sort()
+            items = _splice(items, added, True)
+        self.items = items
+        self.added = []
+        self.removed = ()
+
+    def ordered(self):
+        '''
+        Return the statements as a sorted list that mustn't be modified.
+        '''
+        if self.added or self.removed:
+            self._merge()
+        return self.items
+
+def _splice(items, stmts, insert):
+    '''
+    Return a new sorted list of `items` with the sorted `stmts` inserted 
+    into it, or removed from it if `insert` is False.
+    '''
+    merged = []
+    start = 0
+    for stmt in stmts:
+        i = bisect.bisect_left(items, stmt, start)
+        merged.extend(items[start:i])
+        if insert:
+            merged.append(stmt)
+            start = i
+        else:
+            start = i + 1
+    merged.extend(items[start:])
+    return merged
+
+def _addToBucket(index, key, stmt):
+    '''
+    Add the statement (which isn't in the index yet) to the index. 
+    Returns True if this created a new bucket.
+    '''
+    bucket = index.get(key)
+    if bucket is None:
+        index[key] = [stmt]
+        return True
+    elif isinstance(bucket, list):
+        if len(bucket) < _MAX_LIST_BUCKET:
+            bisect.insort(bucket, stmt)
+        else:
+            bucket = index[key] = _SortedBucket(bucket)
+            bucket.add(stmt)
+    else:
+        bucket.add(stmt)
+    return False
+
+def _removeFromBucket(index, key, stmt):
+    '''
+    Remove the statement (which is in the index) from the index. Returns 
+    True if its bucket is now gone.
+    '''
+    bucket = index[key]
+    if isinstance(bucket, list):
+        del bucket[bisect.bisect_left(bucket, stmt)]
+    else:
+        bucket.remove(stmt)
+    if not bucket:
+        del index[key]
+        return True
+    return False
+
+def _ordered(bucket):
+    '''
+    Return the statements in the bucket in sorted order as a sequence that 
+    won't change if the bucket does.
+    '''
+    if isinstance(bucket, _SortedBucket):
+        return bucket.ordered()
+    return tuple(bucket)
+
+def _findShared(value, index, pos):
+    '''
+    Return the instance of `value` that the statements in the given index 
+    bucket already refer to, or None if there isn't one.
+    '''
+    bucket = index.get(value)
+    if not bucket:
+        return None
+    if isinstance(bucket, list):
+        return bucket[0][pos]
+    return bucket.first()[pos]
 
 class MemStore(Model):
     '''
     simple in-memory module
+
+    Statements are indexed by subject, predicate and object and each 
+    context maps to the number of statements each subject has in it. 
+    Statements share the strings they have in common with the statements 
+    already in the store.
     '''
     updateAdvisory = True
+    canStreamBySubject = True
     
     def __init__(self,defaultStatements=None, **kw):
         self.by_s = {}
         self.by_p = {}
         self.by_o = {}
         self.by_c = {}
+        self.names = {} #object types and contexts
+        #sorted subjects, by context (None for all the subjects), once needed
+        self.sortedSubjects = {}
+        self.statistics = ModelStatistics()
         if defaultStatements:
             for stmt in defaultStatements:
                 MemStore.addStatement(self, stmt)
 
     def size(self):
         return len(self.by_s)
-            
+
+    def getStatistics(self):
+        return self.statistics
+
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
         ''' 
@@ -27,6 +232,19 @@ class MemStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''        
+        stmts = MemStore.iterStatements(self, subject, predicate, object,
+                                    objecttype, context, asQuad, hints)
+        if hints and hints.get('subjectorder'):
+            return stmts
+        return list(stmts)
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Lazily yield the statements that match the given arguments in sorted
+        order. The indexes are already sorted so this never sorts the 
+        statements it returns.
+        '''
         fs = subject is not None
         fp = predicate is not None
         fo = object is not None
@@ -44,80 +262,129 @@ class MemStore(Model):
             elif not fot:
                 checkLiteral = True
 
-        if not fc:
-            if fs:                
-                stmts = self.by_s.get(subject,[])            
-            elif fo:
-                stmts = self.by_o.get(object, [])
-            elif fp:
-                stmts = self.by_p.get(predicate, [])
+        if fc:
+            subjects = self.by_c.get(context)
+            if not subjects:
+                return iter(())
+            if fs:
+                if subject not in subjects:
+                    return iter(())
+                stmts = _ordered(self.by_s[subject])
             else:
-                #get all
-                stmts = utils.flattenSeq(self.by_s.itervalues(), 1)
-                if fot:
-                    stmts = [s for s in stmts if s.objectType == objecttype]
-                else:
-                    stmts = list(stmts)
-                stmts.sort()
-                return removeDupStatementsFromSortedList(stmts,asQuad,
-                                                    limit=limit,offset=offset)
-        else:            
-            by_cAnds = self.by_c.get(context)
-            if not by_cAnds:
-                return []
-            if fs:                
-                stmts = by_cAnds.get(subject,[])
-            else:
-                stmts = utils.flattenSeq(by_cAnds.itervalues(), 1)
-                
-        stmts = [s for s in stmts 
-                    if (not fs or s.subject == subject)
-                    and (not fp or s.predicate == predicate)
+                stmts = self._iterSubjects(context)
+        elif fs:
+            stmts = _ordered(self.by_s.get(subject, ()))
+        elif fo:
+            stmts = _ordered(self.by_o.get(object, ()))
+        elif fp:
+            stmts = _ordered(self.by_p.get(predicate, ()))
+        else:
+            stmts = self._iterSubjects(None)
+
+        if fp or fo or fot or fc:
+            stmts = (s for s in stmts 
+                    if (not fp or s.predicate == predicate)
                     and (not fo or s.object == object)
                     and (not fot or s.objectType == objecttype)
                     and (not checkLiteral or s.objectType != OBJECT_TYPE_RESOURCE)
-                    and (not fc or s.scope == context)]
-        stmts.sort()
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
-                                            limit=limit, offset=offset)
-        return stmts
+                    and (not fc or s.scope == context))
+        return iter(_iterSlice(stmts, asQuad, limit, offset))
+
+    def _iterSubjects(self, context):
+        '''
+        Yield the statements of every subject (that appears in the given 
+        context), subject by subject.
+        '''
+        subjects = self.sortedSubjects.get(context)
+        if subjects is None:
+            if context is None:
+                subjects = self.by_s
+            else:
+                subjects = self.by_c[context]
+            subjects = self.sortedSubjects[context] = _SortedBucket(
+                                                            sorted(subjects))
+        by_s = self.by_s
+        for subject in subjects.ordered():
+            for stmt in _ordered(by_s.get(subject, ())):
+                yield stmt
+
+    def _subjectChanged(self, context, subject, added):
+        '''
+        Keep the sorted subjects of the given context up to date.
+        '''
+        subjects = self.sortedSubjects.get(context)
+        if subjects is not None:
+            if added:
+                subjects.add(subject)
+            else:
+                subjects.remove(subject)
+
+    def _shareStrings(self, stmt):
+        '''
+        Return a statement equal to `stmt` that refers to the same string 
+        instances as the statements already in the store.
+        '''
+        by_s, by_o = self.by_s, self.by_o
+        subject = (_findShared(stmt[0], by_s, 0) 
+                    or _findShared(stmt[0], by_o, 2) or stmt[0])
+        predicate = _findShared(stmt[1], self.by_p, 1) or stmt[1]
+        object = _findShared(stmt[2], by_o, 2)
+        if object is None and stmt[3] == OBJECT_TYPE_RESOURCE:
+            object = _findShared(stmt[2], by_s, 0)
+        if object is None:
+            object = stmt[2]
+        names = self.names
+        objectType = names.setdefault(stmt[3], stmt[3])
+        scope = names.setdefault(stmt[4], stmt[4])
+        if stmt.listpos:
+            return StatementWithOrder(subject, predicate, object, objectType,
+                                                        scope, stmt.listpos)
+        return Statement(subject, predicate, object, objectType, scope)
                      
     def addStatement(self, stmt ):
         '''add the specified statement to the model'''            
         if not isinstance(stmt, BaseStatement):
             stmt = Statement(*stmt)
         assert isinstance(stmt.object, (str, unicode)), 'bad object %r, objectType %s' % (stmt.object, stmt.objectType)
-        if stmt in self.by_c.get(stmt[4], {}).get(stmt[0], []):
+        stmts = self.by_s.get(stmt[0])
+        if stmts is not None and tuple(stmt[:5]) in stmts:
             return False#statement already in
-        self.by_s.setdefault(stmt[0], []).append(stmt)
-        self.by_p.setdefault(stmt[1], []).append(stmt)
-        self.by_o.setdefault(stmt[2], []).append(stmt)
-        self.by_c.setdefault(stmt[4], {}).setdefault(stmt[0], []).append(stmt)
+        stmt = self._shareStrings(stmt)
+        if _addToBucket(self.by_s, stmt[0], stmt):
+            self._subjectChanged(None, stmt[0], True)
+        _addToBucket(self.by_p, stmt[1], stmt)
+        _addToBucket(self.by_o, stmt[2], stmt)
+        subjects = self.by_c.setdefault(stmt[4], {})
+        count = subjects.get(stmt[0], 0)
+        if not count:
+            self._subjectChanged(stmt[4], stmt[0], True)
+        subjects[stmt[0]] = count + 1
+        self.statistics.add(stmt)
         return True
         
     def removeStatement(self, stmt ):
         '''removes the statement'''
         stmts = self.by_s.get(stmt[0])
-        if not stmts:
+        #compare as a plain tuple, some statement classes ignore the scope
+        stmt = tuple(stmt[:5])
+        if not stmts or stmt not in stmts:
             return False
-        try:
-            stmts.remove(stmt)
-        except ValueError:
-            return False  
-        self.by_p[stmt[1]].remove(stmt)
-        self.by_o[stmt[2]].remove(stmt)
-        try:
-            self.by_c[stmt[4]][stmt[0]].remove(stmt)
-        except (ValueError,KeyError):
-            #this can happen since scope isn't part of the stmt's key
-            for subjectDict in self.by_c.values():
-                stmts = subjectDict.get(stmt[0],[])
-                try:
-                    stmts.remove(stmt)
-                except ValueError:
-                    pass
-                else:
-                    return True
+        if _removeFromBucket(self.by_s, stmt[0], stmt):
+            self._subjectChanged(None, stmt[0], False)
+        _removeFromBucket(self.by_p, stmt[1], stmt)
+        _removeFromBucket(self.by_o, stmt[2], stmt)
+        subjects = self.by_c[stmt[4]]
+        count = subjects[stmt[0]] - 1
+        if count:
+            subjects[stmt[0]] = count
+        else:
+            del subjects[stmt[0]]
+            if subjects:
+                self._subjectChanged(stmt[4], stmt[0], False)
+            else:
+                del self.by_c[stmt[4]]
+                self.sortedSubjects.pop(stmt[4], None)
+        self.statistics.remove(stmt)
         return True
 
 class TransactionMemStore(TransactionModel, MemStore): pass
@@ -130,8 +397,9 @@ class FileStore(MemStore):
     
     def __init__(self, source, defaultStatements=(), context='',
            incrementHook=None, serializeOptions=None, parseOptions=None, 
-           checkForExternalChanges=True, **kw):
+           checkForExternalChanges=True, parallelParse=False, **kw):
         self.initialContext = context
+        self.parallelParse = parallelParse
         self.defaultStatements = defaultStatements
         self.checkForExternalChanges = checkForExternalChanges
         serializeOptions = serializeOptions or {}
@@ -155,7 +423,7 @@ class FileStore(MemStore):
             raise RuntimeError('failed to create FileStore: missing path')
         
         stmts, format, fsize, mtime = loadFileStore(source, context, 
-                                        incrementHook, parseOptions)
+                            incrementHook, parseOptions, parallelParse)
         if stmts is None:
             stmts = defaultStatements
         if self.canWriteFormat(format):
@@ -195,6 +463,12 @@ class FileStore(MemStore):
         return super(FileStore, self).getStatements(subject, predicate, object, 
                                         objecttype,context, asQuad, hints)
 
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        self._checkTxnState()
+        return super(FileStore, self).iterStatements(subject, predicate, object, 
+                                        objecttype,context, asQuad, hints)
+
     def addStatement(self, stmt):
         self._checkTxnState()
         self.txnState = TxnState.DIRTY
@@ -250,7 +524,7 @@ class FileStore(MemStore):
         '''reload from file'''
         if self.path:
             stmts, format, self.fileSize, self.mtime = loadFileStore(self.path,
-                                                            self.initialContext)
+                        self.initialContext, parallel=self.parallelParse)
             if stmts is None:
                 stmts = self.defaultStatements
         else:
@@ -298,35 +572,41 @@ class IncrementalNTriplesFileStoreBase(FileStore):
 
     def commit(self, **kw): 
         if os.path.exists(self.path):
-            originalsize = os.path.getsize(self.path)
-            outputfile = file(self.path, "a+")
-            changelist = self._getChangeList()
-            def unmapQueue():
-                for stmt in changelist:
-                    if stmt[0] is Removed:
-                        yield Removed, stmt[1]
-                    else:
-                        yield stmt[0]
-                        
-            comment = kw.get('source','') or ''
-            if isinstance(comment, (list, tuple)):                
-                comment = comment and comment[0] or ''
-            if getattr(comment, 'getAttributeNS', None):
-                comment = comment.getAttributeNS(RDF_MS_BASE, 'about')
-            try:
-                outputfile.write("#begin " + comment + "\n")            
-                writeTriples( unmapQueue(), outputfile)            
-                outputfile.write("#end " + time.asctime() + ' ' + comment + "\n")
-            except:
-                outputfile.truncate(originalsize)
-                outputfile.close()
-                raise
-            else:
-                outputfile.close()
+            self._appendChanges(self.path, self._getChangeList(), kw)
         else: #first time
             super(IncrementalNTriplesFileStoreBase, self).commit()
         self.changelist = []
 
+    def _appendChanges(self, path, changelist, kw):
+        '''
+        Append the changelist to the log at `path` as a "#begin" ... "#end" 
+        block. If writing fails the log is truncated back to its original size.
+        '''
+        originalsize = os.path.getsize(path)
+        outputfile = file(path, "a+")
+        def unmapQueue():
+            for stmt in changelist:
+                if stmt[0] is Removed:
+                    yield Removed, stmt[1]
+                else:
+                    yield stmt[0]
+                    
+        comment = kw.get('source','') or ''
+        if isinstance(comment, (list, tuple)):                
+            comment = comment and comment[0] or ''
+        if getattr(comment, 'getAttributeNS', None):
+            comment = comment.getAttributeNS(RDF_MS_BASE, 'about')
+        try:
+            outputfile.write("#begin " + comment + "\n")            
+            writeTriples( unmapQueue(), outputfile)            
+            outputfile.write("#end " + time.asctime() + ' ' + comment + "\n")
+        except:
+            outputfile.truncate(originalsize)
+            outputfile.close()
+            raise
+        else:
+            outputfile.close()
+
     def rollback(self):        
         self.changelist = []
         super(IncrementalNTriplesFileStoreBase, self).rollback()
@@ -336,6 +616,225 @@ class IncrementalNTriplesFileStore(TransactionModel, IncrementalNTriplesFileStor
     def _getChangeList(self):
         return self.queue
 
+class LogFileStore(IncrementalNTriplesFileStoreBase):
+    '''
+    Keeps the store as a snapshot file (in any format FileStore can write) 
+    plus an append-only NTriples log of the transactions committed since the
+    snapshot was written. Commits only append their changes to the log; once
+    the log grows past `compactionRatio` times the size of the snapshot 
+    (and at least `minCompactionSize` bytes) a new snapshot is written, by 
+    default in a background thread, and the transactions it includes are 
+    dropped from the log. Loading reads the snapshot then replays the log.
+    '''
+    
+    def __init__(self, source, defaultStatements=(), context='', logPath=None,
+            compactionRatio=1.0, minCompactionSize=1024*1024, 
+            backgroundCompaction=True, **kw):
+        #: guards the file statistics and the log against the compactor thread
+        self._lock = threading.Lock()
+        self._compactor = None
+        self.compactionRatio = compactionRatio
+        self.minCompactionSize = minCompactionSize
+        self.backgroundCompaction = backgroundCompaction
+        super(LogFileStore, self).__init__(source, defaultStatements, 
+                                                            context, **kw)
+        self.logPath = logPath or self.path + '.log'
+        self._replayLog()
+
+    def canWriteFormat(self, format):
+        #the snapshot can be any format, the log is always NTriples
+        return canWriteFormat(format)
+
+    def _replayLog(self):
+        '''
+        Apply the transactions in the log to the statements loaded from the 
+        snapshot. A transaction whose "#end" line wasn't written (e.g. the 
+        process died while appending it) is ignored and truncated from the log.
+        '''
+        if os.path.exists(self.logPath):
+            logfile = open(self.logPath, 'rb')
+            try:
+                contents = logfile.read()
+            finally:
+                logfile.close()
+            complete = 0
+            pos = 0
+            for line in contents.splitlines(True):
+                pos += len(line)
+                if line.startswith('#end') and line.endswith('\n'):
+                    complete = pos
+            if complete < len(contents):
+                logfile = open(self.logPath, 'r+b')
+                try:
+                    logfile.truncate(complete)
+                finally:
+                    logfile.close()
+                contents = contents[:complete]
+
+            makebNode = lambda bNode: BNODE_BASE + bNode
+            for stmt in parseTriples(contents.splitlines(), makebNode):
+                if stmt[0] is Removed:
+                    stmt = stmt[1]
+                    MemStore.removeStatement(self, Statement(stmt[0], stmt[1],
+                        stmt[2], stmt[3], stmt[4] or self.initialContext))
+                else:
+                    MemStore.addStatement(self, Statement(stmt[0], stmt[1], 
+                        stmt[2], stmt[3], stmt[4] or self.initialContext))
+        self._updateLogStats()
+
+    def _updateLogStats(self):
+        try:
+            stat = os.stat(self.logPath)
+        except (OSError, IOError):
+            self.logMtime = 0
+            self.logSize = 0
+        else:
+            self.logMtime = stat.st_mtime
+            self.logSize = stat.st_size
+
+    def wasModifiedSinceLastWrite(self):
+        self._lock.acquire()
+        try:
+            if super(LogFileStore, self).wasModifiedSinceLastWrite():
+                return True
+            try:
+                stat = os.stat(self.logPath)
+            except (OSError, IOError):
+                return False
+            return self.logMtime < stat.st_mtime or self.logSize != stat.st_size
+        finally:
+            self._lock.release()
+
+    def commit(self, **kw):
+        if self.txnState != TxnState.DIRTY:
+            self.txnState = TxnState.BEGIN
+            self.changelist = []
+            return
+
+        if not os.path.exists(self.path):
+            #first time: write the initial snapshot, it supersedes the log
+            FileStore.commit(self)
+            if os.path.exists(self.logPath):
+                os.remove(self.logPath)
+            self._updateLogStats()
+            self.changelist = []
+            return
+
+        if self.checkForExternalChanges and self.wasModifiedSinceLastWrite():
+            raise RuntimeError('error saving to "%s", file was '
+                        'modified by another process' % self.logPath)
+        changelist = self._getChangeList()
+        if changelist:
+            self._lock.acquire()
+            try:
+                if not os.path.exists(self.logPath):
+                    file(self.logPath, 'wb').close()
+                self._appendChanges(self.logPath, changelist, kw)
+                self._updateLogStats()
+            finally:
+                self._lock.release()
+        self.changelist = []
+        self.txnState = TxnState.BEGIN
+
+        compactor = self._compactor
+        if (self.logSize > max(self.minCompactionSize, 
+                                self.compactionRatio * self.fileSize)
+                and not (compactor and compactor.isAlive())):
+            try:
+                self.compact(not self.backgroundCompaction)
+            except:
+                #the transaction is already in the log so it still committed
+                log.exception('compacting "%s" failed' % self.logPath)
+
+    def compact(self, wait=True):
+        '''
+        Write a new snapshot of the committed statements and remove the 
+        transactions it includes from the log. If `wait` is False the snapshot
+        is written by a background thread, use `waitForCompaction()` to block
+        until it is done.
+        '''
+        if self.txnState == TxnState.DIRTY:
+            raise RuntimeError('can not compact "%s" with uncommitted changes'
+                                                                % self.path)
+        self.waitForCompaction()
+        logSize = self.logSize
+        if not logSize:
+            return
+        #copying the list is cheap compared to serializing it and lets the
+        #store change while the compactor thread is writing the snapshot
+        stmts = MemStore.getStatements(self)
+        if wait:
+            self._compact(stmts, logSize)
+        else:
+            compactor = threading.Thread(target=self._backgroundCompact, 
+                                                    args=(stmts, logSize))
+            compactor.setDaemon(True)
+            self._compactor = compactor
+            compactor.start()
+
+    def waitForCompaction(self):
+        compactor = self._compactor
+        if compactor:
+            compactor.join()
+            self._compactor = None
+
+    def _backgroundCompact(self, stmts, logSize):
+        try:
+            self._compact(stmts, logSize)
+        except:
+            #the log still has every transaction so nothing is lost
+            log.exception(
+                            'compacting "%s" failed' % self.logPath)
+
+    def _compact(self, stmts, logSize):
+        from vesper.data.transactions import TxnFileFactory
+        tff = TxnFileFactory(self.path)
+        try:
+            outputfile = tff.create('t')
+            serializeRDF_Stream(stmts, outputfile, self.format, 
+                                            options=self.serializeOptions)
+            outputfile.close()
+        except:
+            tff.abortTransaction(None)
+            tff.finishTransaction(None, False)
+            raise
+
+        self._lock.acquire()
+        try:
+            #replace the snapshot before truncating the log; if we die in 
+            #between, replaying the whole log over the new snapshot still
+            #yields the same statements since adds and removes are idempotent
+            tff.commitTransaction(None)
+            tff.finishTransaction(None, True)
+            stat = os.stat(self.path)
+            self.mtime = stat.st_mtime
+            self.fileSize = stat.st_size
+
+            #keep the transactions committed while the snapshot was written
+            logfile = open(self.logPath, 'rb')
+            try:
+                logfile.seek(logSize)
+                tail = logfile.read()
+            finally:
+                logfile.close()
+            logtff = TxnFileFactory(self.logPath)
+            outputfile = logtff.create('b')
+            outputfile.write(tail)
+            outputfile.close()
+            logtff.commitTransaction(None)
+            logtff.finishTransaction(None, True)
+            self._updateLogStats()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        '''reload from the snapshot and log'''
+        self.waitForCompaction()
+        super(LogFileStore, self).reload()
+        self._replayLog()
+
+class TransactionLogFileStore(TransactionModel, LogFileStore): pass
+
 def guessFileType(path):
   extmap = { '.nt' : 'ntriples',
     '.nj' : 'ntjson', 
@@ -348,10 +847,14 @@ def guessFileType(path):
   base, ext = os.path.splitext(path)
   return extmap.get(ext)
   
-def loadFileStore(path, context='', incrementHook=None, parseOptions=None):
+def loadFileStore(path, context='', incrementHook=None, parseOptions=None,
+                                                            parallel=False):
     '''
     If location doesn't exist create a new model and initialize it
     with the statements specified in defaultModel
+
+    If `parallel` is True, NTriples and pjson files are parsed by a pool of 
+    processes (see `parseRDFInParallel`).
     '''
     format = guessFileType(path) or 'unknown'
 
@@ -365,7 +868,16 @@ def loadFileStore(path, context='', incrementHook=None, parseOptions=None):
         if incrementHook:
             options['incrementHook']=incrementHook
         
-        stmts, format = parseRDFFromURI(uri, type=format, scope=context,
+        stmts = None
+        if parallel and not options:
+            f = open(path, 'rb')
+            try:
+                contents = f.read()
+            finally:
+                f.close()
+            stmts = parseRDFInParallel(contents, uri, format, context)
+        if stmts is None:
+            stmts, format = parseRDFFromURI(uri, type=format, scope=context,
                                 options=options, getType=True)
     else:
         mtime = 0
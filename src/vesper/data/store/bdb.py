@@ -65,7 +65,8 @@ def _btopen(env, file, flag='c', mode=0666,
             btflags=0, cachesize=None, maxkeypage=None, minkeypage=None,
             pgsize=None, lorder=None):
 
-    flags = bsddb.db.DB_CREATE # bsddb._checkflag(flag, file)
+    #DB_AUTO_COMMIT so writes can be grouped into a transaction
+    flags = bsddb.db.DB_CREATE | bsddb.db.DB_AUTO_COMMIT # bsddb._checkflag(flag, file)
     d = bsddb.db.DB(env)
     if pgsize is not None: d.set_pagesize(pgsize)
     if lorder is not None: d.set_lorder(lorder)
@@ -79,12 +80,16 @@ class BdbStore(Model):
     '''
     datastore using Berkeley DB using Python's bsddb module
     
-    two b-tree databases with sorted duplicates
+    four b-tree databases with sorted duplicates
 
     p o t => c s
     
     s => p o t c 
 
+    o t => s p c
+
+    c => s p o t
+
     where
         
     s subject
@@ -99,6 +104,11 @@ class BdbStore(Model):
     
     debug=0
     updateAdvisory = True
+    statistics = None
+    #number of statements written per bdb transaction when building indexes
+    batchSize = 10000
+    #number of records read from a cursor at a time by streamed lookups
+    scanSize = 100
      
     def __init__(self, source, defaultStatements=None, **kw):
         if source is not None:
@@ -111,13 +121,18 @@ class BdbStore(Model):
             
             pPath = os.path.join(source, 'pred_db')
             sPath = os.path.join(source, 'subj_db')
+            oPath = os.path.join(source, 'obj_db')
+            cPath = os.path.join(source, 'context_db')
             newdb = not os.path.exists(pPath)
+            #databases created before the object and context indexes existed
+            missingIndexes = not newdb and not os.path.exists(oPath)
         else:
             newdb = True
-            pPath = sPath = None
+            missingIndexes = False
+            pPath = sPath = oPath = cPath = None
             
-        log.debug("pPath:" + pPath)
-        log.debug("sPath:" + sPath)
+        log.debug("pPath:" + str(pPath))
+        log.debug("sPath:" + str(sPath))
         log.debug("is new:" + str(newdb))
 
         db = bsddb.db
@@ -129,15 +144,117 @@ class BdbStore(Model):
         self.pDb.db.set_get_returns_none(2)
         self.sDb = _btopen(self.env, sPath, btflags=bsddb.db.DB_DUPSORT)         
         self.sDb.db.set_get_returns_none(2)
+        self.oDb = _btopen(self.env, oPath, btflags=bsddb.db.DB_DUPSORT)
+        self.oDb.db.set_get_returns_none(2)
+        self.cDb = _btopen(self.env, cPath, btflags=bsddb.db.DB_DUPSORT)
+        self.cDb.db.set_get_returns_none(2)
+        #idle cursors that can be reused by later lookups, by database
+        self._cursors = {}
         
+        if missingIndexes:
+            self._buildIndexes()
         if newdb and defaultStatements:            
             self.addStatements(defaultStatements)
             
     def close(self):
         log.debug("closing db")
+        self._closeCursors()
         self.pDb.close()
         self.sDb.close()
+        self.oDb.close()
+        self.cDb.close()
         self.env.close()
+
+    def _buildIndexes(self):
+        log.info("building object and context indexes")
+        scursor = self.sDb.db.cursor()
+        try:
+            stmts = []
+            rec = scursor.first()
+            while rec:
+                s, value = rec
+                p, o, t, c = value.split('\0')
+                stmts.append( (s, p, o, t, c) )
+                rec = scursor.next()
+        finally:
+            scursor.close()
+        for start in range(0, len(stmts), self.batchSize):
+            txn = self.env.txn_begin()
+            try:
+                for stmt in stmts[start:start+self.batchSize]:
+                    self._putIndexes(stmt, txn)
+            except:
+                txn.abort()
+                raise
+            txn.commit()
+
+    def _getCursor(self, db):
+        '''
+        Return an idle cursor on the given database, opening one if needed.
+        Cursors are released with `_releaseCursor()` and kept open until the
+        next write or the end of the transaction so that the lookups in a
+        request don't each open a new one.
+        '''
+        idle = self._cursors.get(db)
+        if idle:
+            return idle.pop()
+        return db.db.cursor()
+
+    def _releaseCursor(self, db, cursor):
+        self._cursors.setdefault(db, []).append(cursor)
+
+    def _closeCursors(self):
+        cursors = self._cursors
+        self._cursors = {}
+        for idle in cursors.values():
+            for cursor in idle:
+                cursor.close()
+
+    def _scan(self, db, first, dups=False):
+        '''
+        Yield the records of `db` starting at the record `first(cursor)` 
+        positions the cursor at, followed by the next records (or just the
+        next duplicates of that key if `dups` is True).
+        The records are read in chunks of `scanSize` and the cursor is 
+        released between chunks, so a scan that is abandoned part way 
+        doesn't leave a cursor open.
+        '''
+        last = None
+        while True:
+            cursor = self._getCursor(db)
+            try:
+                if last is None:
+                    rec = first(cursor)
+                else:
+                    #continue after the last record we read
+                    rec = cursor.get(last[0], last[1], 
+                                        bsddb.db.DB_GET_BOTH_RANGE)
+                    if rec == last:
+                        rec = self._nextRecord(cursor, dups)
+                    elif rec is None and not dups:
+                        #keys can't contain \0 so this is the next key
+                        rec = cursor.set_range(last[0] + '\0')
+                chunk = []
+                while rec and len(chunk) < self.scanSize:
+                    chunk.append(rec)
+                    rec = self._nextRecord(cursor, dups)
+            finally:
+                self._releaseCursor(db, cursor)
+            for last in chunk:
+                yield last
+            if not rec:
+                return
+
+    def _nextRecord(self, cursor, dups):
+        if dups:
+            return cursor.next_dup()
+        return cursor.next()
+
+    def commit(self, **kw):
+        self._closeCursors()
+
+    def rollback(self):
+        self._closeCursors()
         
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
@@ -146,10 +263,23 @@ class BdbStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
+        return list(BdbStore.iterStatements(self, subject, predicate, object,
+                                        objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Lookups by subject, context and scans of the whole store are streamed
+        from a cursor on the subject or context index, which are in statement
+        order, as are lookups by object and object type.
+        Lookups by predicate use the predicate index, which isn't, so those
+        statements are sorted first (as are lookups by object alone).
+        '''
         #if subject is specified, use subject index, 
         #  with/get_both if predicate is specified 
         #if predicate, use property index
-        #if only object or scope is specified, get all and search manually
+        #if object, use object index
+        #if only scope is specified, use context index
         #else: get all: use subject index, regenerate json_seq stmts
         #do a manual scan if subject list bnode
         fs = subject is not None
@@ -160,6 +290,7 @@ class BdbStore(Model):
         hints = hints or {}
         limit=hints.get('limit')
         offset=hints.get('offset')
+        checkLiteral = False
 
         if fo:
             if isinstance(object, ResourceUri):
@@ -167,141 +298,283 @@ class BdbStore(Model):
                 fot = True
                 objecttype = OBJECT_TYPE_RESOURCE
             elif not fot:
-                objecttype = OBJECT_TYPE_LITERAL
+                #match any kind of literal
+                checkLiteral = True
 
-        stmts = []
         if fs: 
             subject = _to_safe_str(subject)
-            #if subject is specified, use subject index            
-            scursor = self.sDb.db.cursor()
-            if fp:
-                val = _to_safe_str(predicate)
-                if fo:
-                    val += '\0'+ _to_safe_str(object)
-                    if fot: 
-                        val += '\0'+ _to_safe_str(objecttype)
-                        if fc:
-                            val += '\0'+_to_safe_str(context)
-                #duplicates are sorted so we can position the cursor at the
-                #first value we're interested
-                rec = scursor.get(subject, val, bsddb.db.DB_GET_BOTH_RANGE)
-            else:
-                rec = scursor.set(subject)
-            while rec:
-                #s => p o t c 
-                s, value = rec
-                assert s == subject
-                p, o, t, c = value.split('\0')                
+            def iterSubject():
+                #if subject is specified, use subject index            
                 if fp:
-                    #since dups are sorted we can break
-                    if p != predicate:
-                        break
+                    val = _to_safe_str(predicate)
                     if fo:
-                        if o != object:
+                        val += '\0'+ _to_safe_str(object)
+                        if fot: 
+                            val += '\0'+ _to_safe_str(objecttype)
+                            if fc:
+                                val += '\0'+_to_safe_str(context)
+                    #duplicates are sorted so we can position the cursor at the
+                    #first value we're interested
+                    first = lambda scursor: scursor.get(subject, val, 
+                                                bsddb.db.DB_GET_BOTH_RANGE)
+                else:
+                    first = lambda scursor: scursor.set(subject)
+                for s, value in self._scan(self.sDb, first, True):
+                    #s => p o t c 
+                    assert s == subject
+                    p, o, t, c = value.split('\0')                
+                    if fp:
+                        #since dups are sorted we can break
+                        if p != predicate:
                             break
-                        if fot:
-                            if t != objecttype:
+                        if fo:
+                            if o != object:
                                 break
-                            if fc:
-                                if c != context:
-                                    break      
-                
-                if ((not fo or o == object)
-                    and (not fot or t == objecttype)
-                    and (not fc or c == context)):            
-                    stmts.append( Statement(s, p, o, t, c) )            
-                rec = scursor.next_dup()
+                            if fot:
+                                if t != objecttype:
+                                    break
+                                if fc:
+                                    if c != context:
+                                        break      
+                    
+                    if ((not fo or o == object)
+                        and (not fot or t == objecttype)
+                        and (not fc or c == context)):            
+                        yield Statement(s, p, o, t, c)
+            stmts = iterSubject()
                 
         elif fp:
-            pcursor = self.pDb.db.cursor()            
-            key = _to_safe_str(predicate)
-            val = None
-            if fo:
-                key += '\0'+_to_safe_str(object)
-                if fot: 
-                    key += '\0'+_to_safe_str(objecttype)
-                    if fc:
-                        val = _to_safe_str(context)
-                        rec = pcursor.get(key, val, bsddb.db.DB_GET_BOTH_RANGE)
-            if val is None:
-                rec = pcursor.set_range(key)                
+            pcursor = self._getCursor(self.pDb)
+            try:
+                key = _to_safe_str(predicate)
+                val = None
+                if fo:
+                    key += '\0'+_to_safe_str(object)
+                    if fot: 
+                        key += '\0'+_to_safe_str(objecttype)
+                        if fc:
+                            val = _to_safe_str(context)
+                            rec = pcursor.get(key, val, bsddb.db.DB_GET_BOTH_RANGE)
+                if val is None:
+                    rec = pcursor.set_range(key)                
                         
-            while rec:                
-                key, value = rec
-                p, o, t = key.split('\0')                
-                if p != predicate or (fo and o != object) or (fot and t != objecttype):
-                    break  #we're finished with the range of the key we're interested in               
-                c, s = value.split('\0')                            
-                if not fc or c == context:                     
-                    stmts.append( Statement(s, p, o, t, c) )                
-                rec = pcursor.next()
+                stmts = []
+                while rec:                
+                    key, value = rec
+                    p, o, t = key.split('\0')                
+                    if p != predicate or (fo and o != object) or (fot and t != objecttype):
+                        break  #we're finished with the range of the key we're interested in               
+                    c, s = value.split('\0')                            
+                    if not fc or c == context:                     
+                        stmts.append( Statement(s, p, o, t, c) )                
+                    rec = pcursor.next()
+            finally:
+                self._releaseCursor(self.pDb, pcursor)
+            stmts.sort()
+
+        elif fo:
+            ocursor = self._getCursor(self.oDb)
+            try:
+                key = _to_safe_str(object)
+                if fot:
+                    key += '\0'+_to_safe_str(objecttype)
+                    rec = ocursor.set(key)
+                else:
+                    rec = ocursor.set_range(key + '\0')
+                stmts = []
+                while rec:
+                    #o t => s p c
+                    key, value = rec
+                    o, t = key.split('\0')
+                    if o != object or (fot and t != objecttype):
+                        break
+                    s, p, c = value.split('\0')
+                    if not fc or c == context:
+                        stmts.append( Statement(s, p, o, t, c) )
+                    rec = ocursor.next()
+            finally:
+                self._releaseCursor(self.oDb, ocursor)
+            if not fot:
+                #each object type's statements are sorted but not all of them
+                stmts.sort()
+
+        elif fc:
+            context = _to_safe_str(context)
+            def iterContext():
+                first = lambda ccursor: ccursor.set(context)
+                for c, value in self._scan(self.cDb, first, True):
+                    #c => s p o t
+                    s, p, o, t = value.split('\0')
+                    yield Statement(s, p, o, t, c)
+            stmts = iterContext()
                             
         else:            
-            #get all            
-            scursor = self.sDb.db.cursor()
-            rec = scursor.first()
-            while rec:
-                s, value = rec
-                p, o, t, c = value.split('\0')
-                if ((not fo or o == object)
-                    and (not fot or t == objecttype)
-                    and (not fc or c == context)):
-                    stmts.append( Statement(s, p, o, t, c) )
-                rec = scursor.next()
+            def iterAll():
+                #get all            
+                first = lambda scursor: scursor.first()
+                for s, value in self._scan(self.sDb, first):
+                    p, o, t, c = value.split('\0')
+                    yield Statement(s, p, o, t, c)
+            stmts = iterAll()
 
-        stmts.sort()        
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
+        if checkLiteral:
+            stmts = (stmt for stmt in stmts 
+                        if stmt.objectType != OBJECT_TYPE_RESOURCE)
+        return removeDupStatementsFromSortedIterator(stmts, asQuad, 
                                             limit=limit, offset=offset)
-        return stmts
 
-    def addStatements(self, stmts):
-        lists = {}
-        for stmt in stmts:
-            if stmt[0].startswith('bnode:jlist:') or stmt[0].startswith('_:l'):
-                if stmt[1].startswith('rdf:_'):
-                    pos = stmt.predicate[:1]
-                    lists.setdefault(stmt[0], _ListInfo() ).setPosition(stmt[2], stmt[3], pos)
-                #elif stmt[1] == JSON_SEQ_PROP:
-                #    lists.setdefault(stmt[0], _ListInfo()).prop = stmt[2]
-            #elif stmt[1] == JSON_LIST_PROP:
-            #    continue #exclude
-            else:
-                self.addStatement(stmt)
-        #positions are indexed for each value
-        for key, listinfo in lists.items():
-            listinfo.positions.sort(key=int)
-            ls = Statement(subject, '!list', '%s,%s' % (key, listinfo))
-            #only add to subject index
-                
-    def addStatement(self, stmt):
-        '''add the specified statement to the model'''
-        #print 'add', stmt
+    def getStatistics(self):
+        #statistics aren't persisted; the statistics for a predicate are
+        #built by scanning its range of the predicate index the first time 
+        #they're needed
+        if self.statistics is None:
+            self.statistics = LazyModelStatistics(self._countStatements,
+                                self._listPredicates, self._scanPredicate)
+        return self.statistics
+
+    def _countStatements(self):
+        return self.pDb.db.stat()['ndata']
+
+    def _listPredicates(self):
+        predicates = []
+        pcursor = self.pDb.db.cursor()
+        try:
+            rec = pcursor.first()
+            while rec:
+                predicate = rec[0].split('\0', 1)[0]
+                predicates.append(predicate)
+                #skip to the first key after this predicate's keys
+                rec = pcursor.set_range(predicate + '\x01')
+        finally:
+            pcursor.close()
+        return predicates
+
+    def _scanPredicate(self, predicate, add):
+        pcursor = self.pDb.db.cursor()
+        try:
+            predicate = _to_safe_str(predicate)
+            rec = pcursor.set_range(predicate + '\0')
+            while rec:
+                #p o t => c s
+                key, value = rec
+                p, o, t = key.split('\0')
+                if p != predicate:
+                    break
+                add( (value.split('\0')[1], p, o, t) )
+                rec = pcursor.next()
+        finally:
+            pcursor.close()
+
+    def _putIndexes(self, stmt, txn=None):
+        #o t => s p c
+        self.oDb.db.put(_encodeValues(stmt[2], stmt[3]), _encodeValues(stmt[0], stmt[1], stmt[4]), txn=txn, flags=bsddb.db.DB_NODUPDATA)
+        #c => s p o t
+        self.cDb.db.put(_to_safe_str(stmt[4]), _encodeValues(stmt[0], stmt[1], stmt[2], stmt[3]), txn=txn, flags=bsddb.db.DB_NODUPDATA)
+
+    def _addStatement(self, stmt, txn=None):
         try:
             #p o t => c s        
-            self.pDb.db.put(_encodeValues(stmt[1], stmt[2], stmt[3]), _encodeValues(stmt[4], stmt[0]), flags=bsddb.db.DB_NODUPDATA)
+            self.pDb.db.put(_encodeValues(stmt[1], stmt[2], stmt[3]), _encodeValues(stmt[4], stmt[0]), txn=txn, flags=bsddb.db.DB_NODUPDATA)
             
             #s => p o t c
-            self.sDb.db.put(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]), flags=bsddb.db.DB_NODUPDATA)
-            
-            return True
+            self.sDb.db.put(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]), txn=txn, flags=bsddb.db.DB_NODUPDATA)
+
+            self._putIndexes(stmt, txn)
         except bsddb.db.DBKeyExistError:
             return False
-        
-    def removeStatement(self, stmt):
-        '''removes the statement'''
-        #p o t => c s
-        pcursor = self.pDb.db.cursor()
-        if pcursor.set_both(_encodeValues(stmt[1], stmt[2], stmt[3]), _encodeValues(stmt[4], stmt[0])):
-            pcursor.delete()
+        return True
+
+    def _deleteIndex(self, db, key, value, txn):
+        cursor = db.db.cursor(txn)
+        try:
+            found = cursor.set_both(key, value)
+            if found:
+                cursor.delete()
+        finally:
+            #cursors have to be closed before their transaction ends
+            cursor.close()
+        return found
 
+    def _removeStatement(self, stmt, txn):
+        #p o t => c s
+        self._deleteIndex(self.pDb, _encodeValues(stmt[1], stmt[2], stmt[3]), 
+                            _encodeValues(stmt[4], stmt[0]), txn)
+        #o t => s p c
+        self._deleteIndex(self.oDb, _encodeValues(stmt[2], stmt[3]), 
+                            _encodeValues(stmt[0], stmt[1], stmt[4]), txn)
+        #c => s p o t
+        self._deleteIndex(self.cDb, _to_safe_str(stmt[4]), 
+                    _encodeValues(stmt[0], stmt[1], stmt[2], stmt[3]), txn)
         #s => p o t c
-        scursor = self.sDb.db.cursor()
-        if scursor.set_both(_to_safe_str(stmt[0]), _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]) ):
-            scursor.delete()
-            return True
-        return False
+        return self._deleteIndex(self.sDb, _to_safe_str(stmt[0]), 
+                    _encodeValues(stmt[1], stmt[2], stmt[3], stmt[4]), txn)
+
+    def _writeChanges(self, changes):
+        '''
+        Make the changes, each either (stmt,) or (Removed, stmt), in one bdb
+        transaction so that either all or none of them are written, and then
+        update the statistics. Returns the number of statements that were 
+        actually added or removed.
+        '''
+        self._closeCursors()
+        txn = self.env.txn_begin()
+        made = []
+        try:
+            for change in changes:
+                if change[0] is Removed:
+                    changed = self._removeStatement(change[1], txn)
+                else:
+                    changed = self._addStatement(change[0], txn)
+                if changed:
+                    made.append(change)
+        except:
+            txn.abort()
+            raise
+        txn.commit()
+        if self.statistics is not None:
+            for change in made:
+                if change[0] is Removed:
+                    self.statistics.remove(change[1])
+                else:
+                    self.statistics.add(change[0])
+        return len(made)
+
+    def addStatements(self, stmts):
+        self._writeChanges([(stmt,) for stmt in stmts])
+                
+    def addStatement(self, stmt):
+        '''add the specified statement to the model'''
+        #print 'add', stmt
+        return self._writeChanges([(stmt,)]) > 0
+
+    def removeStatements(self, stmts):
+        '''removes the statements'''
+        self._writeChanges([(Removed, stmt) for stmt in stmts])
+
+    def removeStatement(self, stmt):
+        '''removes the statement'''
+        return self._writeChanges([(Removed, stmt)]) > 0
 
 class TransactionBdbStore(TransactionModel, BdbStore):
     '''
     Provides in-memory transactions to BdbStore
     '''
+
+    def addStatements(self, stmts):
+        if self.autocommit:
+            return BdbStore.addStatements(self, stmts)
+        return Model.addStatements(self, stmts)
+
+    def removeStatements(self, stmts):
+        if self.autocommit:
+            return BdbStore.removeStatements(self, stmts)
+        return Model.removeStatements(self, stmts)
+
+    def commit(self, **kw):
+        if not self.queue:
+            self.txnState = TxnState.BEGIN
+            return
+        #write all the changes in one bdb transaction
+        self._writeChanges(self.queue)
+        BdbStore.commit(self, **kw)
+        self.queue = []
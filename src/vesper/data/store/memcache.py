@@ -65,6 +65,15 @@ class MemCacheStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''        
+        return list(MemCacheStore.iterStatements(self, subject, predicate, 
+                                    object, objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        When scanning the whole store only one subject's statements are 
+        fetched from memcached at a time.
+        '''
         fs = subject is not None
         fp = predicate is not None
         fo = object is not None
@@ -84,16 +93,17 @@ class MemCacheStore(Model):
             #get all            
             resources = self.mc.get(self.prefix+'!all')
             if not resources:
-                return []
-            stmts = []
-            for subject in resources.split('||'):
-                for stmt in self.by_s.get(subject):
-                    if not fot or stmt.objectType == objecttype:
-                        if not fc or stmt.scope == context:
-                            stmts.append(stmt)
-            stmts.sort()
-            return removeDupStatementsFromSortedList(stmts,asQuad,
-                                                limit=limit,offset=offset)                
+                return iter(())
+            def iterAll():
+                for subject in sorted(resources.split('||')):
+                    stmts = [stmt for stmt in self.by_s.get(subject)
+                        if (not fot or stmt.objectType == objecttype)
+                            and (not fc or stmt.scope == context)]
+                    stmts.sort()
+                    for stmt in stmts:
+                        yield stmt
+            return removeDupStatementsFromSortedIterator(iterAll(), asQuad,
+                                                limit=limit,offset=offset)
         if fo:
             if isinstance(object, ResourceUri):
                 object = object.uri
@@ -109,9 +119,8 @@ class MemCacheStore(Model):
                     and (not fot or s.objectType == objecttype)
                     and (not fc or s.scope == context)]
         stmts.sort()
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
+        return removeDupStatementsFromSortedIterator(stmts, asQuad, 
                                             limit=limit, offset=offset)
-        return stmts
                      
     def addStatement(self, stmt):
         '''add the specified statement to the model'''            
@@ -0,0 +1,338 @@
+#:copyright: Copyright 2009-2011 by the Vesper team, see AUTHORS.
+#:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
+'''
+A model that partitions its statements across several stores by a hash of
+their subject.
+'''
+__all__ = ['ShardedModel']
+
+import os.path, sys, zlib
+import threading, Queue
+import logging
+
+from vesper.backports import *
+from vesper.data.base import * # XXX
+from vesper.data.base._base import _mergeAll, _distinctUnion
+from vesper.data import transactions
+from vesper.data.store.basic import MemStore, FileStore
+from vesper.data.store._store import get_factory
+
+log = logging.getLogger("store")
+
+def shardSource(source, i):
+    '''
+    Return the source of the i'th shard of a store at `source`, e.g.
+    "store.bdb" => "store.0.bdb" (the extension is kept so stores that look
+    at it, like FileStore, still work).
+    '''
+    if not source:
+        return source
+    root, ext = os.path.splitext(source)
+    return '%s.%d%s' % (root, i, ext)
+
+class _ThreadPool(object):
+    '''
+    A fixed number of daemon threads that run the functions passed to `map`
+    until `shutdown` is called.
+    '''
+    #queued once for each thread to make it exit
+    _shutdown = None
+
+    def __init__(self, size):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is self._shutdown:
+                return
+            func, args, i, results = task
+            try:
+                results.put( (i, True, func(*args)) )
+            except:
+                results.put( (i, False, sys.exc_info()) )
+
+    def map(self, func, argsList):
+        '''
+        Call `func` with each tuple of arguments in `argsList` and return a
+        list of the results. If a call raises an exception the first one is
+        re-raised.
+        '''
+        results = Queue.Queue()
+        for i, args in enumerate(argsList):
+            self.tasks.put( (func, args, i, results) )
+        values = [None] * len(argsList)
+        error = None
+        for i in range(len(argsList)):
+            i, ok, value = results.get()
+            if ok:
+                values[i] = value
+            elif error is None:
+                error = value
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return values
+
+    def shutdown(self):
+        '''
+        Stop the threads once they've finished the tasks already queued.
+        '''
+        threads = self.threads
+        self.threads = []
+        for thread in threads:
+            self.tasks.put(self._shutdown)
+        for thread in threads:
+            thread.join()
+
+class _CommitInfo(object):
+    '''
+    Provides the `getInfo()` the transaction participants expect from the
+    transaction service.
+    '''
+    def __init__(self, info):
+        self.info = info
+
+    def getInfo(self):
+        return self.info
+
+class _ShardParticipant(transactions.TransactionParticipant):
+    '''
+    Commits and rolls back a shard that doesn't support updateAdvisory, so
+    its changes can't be undone once it has committed.
+    '''
+    def __init__(self, model):
+        self.model = model
+
+    def voteForCommit(self, txnService):
+        self.model.commit(**txnService.getInfo())
+
+    def abortTransaction(self, txnService):
+        self.model.rollback()
+
+class _ShardedStatistics(object):
+    '''
+    Combines the statistics of each shard.
+    '''
+    def __init__(self, shardStats):
+        self.shardStats = shardStats
+
+    count = property(lambda self: sum([s.count for s in self.shardStats]))
+
+    def distinctSubjects(self, predicate):
+        #a subject's statements are all in one shard
+        return sum([stats.distinctSubjects(predicate)
+                                            for stats in self.shardStats])
+
+    def distinctObjects(self, predicate):
+        #an object can be in more than one shard
+        samples = []
+        for stats in self.shardStats:
+            predstats = stats.getPredicateStatistics(predicate)
+            if predstats is not None:
+                samples.append(predstats.objects)
+        if not samples:
+            return 0
+        return _distinctUnion(samples)
+
+    def estimate(self, subject=None, predicate=None, object=None,
+                                                            objecttype=None):
+        return sum([stats.estimate(subject, predicate, object, objecttype)
+                                            for stats in self.shardStats])
+
+    def selectivity(self, predicate, test):
+        matches = total = 0.0
+        for stats in self.shardStats:
+            predstats = stats.getPredicateStatistics(predicate)
+            if predstats is None:
+                continue
+            selectivity = stats.selectivity(predicate, test)
+            if selectivity is None:
+                return None
+            matches += selectivity * predstats.count
+            total += predstats.count
+        if not total:
+            return 0.0
+        return matches / total
+
+class ShardedModel(Model):
+    '''
+    Partitions statements across `shards` stores by a hash of their subject.
+    Lookups with a subject go to the one shard that has that subject, other
+    lookups query each shard on a thread pool and merge their (sorted)
+    results.
+
+    Each shard is created with `shard_factory` (a `Model` class, factory
+    function or the name of a store type, e.g. "bdb"), `shard_options` and
+    a source derived from `source` (see `shardSource`). The number of shards
+    can't change once the shards have been created.
+
+    Commits are coordinated with a `TwoPhaseTxnModelAdapter` for each shard:
+    if a shard fails to commit, the shards that already committed have their
+    changes undone. (Shards that don't support updateAdvisory are just
+    committed in turn.)
+    '''
+
+    def __init__(self, source=None, defaultStatements=(), shards=4,
+                shard_factory=None, shard_options=None, threads=None, **kw):
+        from vesper.data.DataStore import TwoPhaseTxnModelAdapter, ModelWrapper
+        if isinstance(shard_factory, (str, unicode)):
+            shard_factory = get_factory(shard_factory)
+        elif shard_factory is None:
+            if not source:
+                shard_factory = MemStore
+            else:
+                shard_factory = FileStore
+        shard_options = shard_options or {}
+
+        defaults = [[] for i in range(shards)]
+        for stmt in defaultStatements or ():
+            defaults[self._shardFor(stmt[0], shards)].append(stmt)
+
+        #: the shards' models
+        self.stores = []
+        #: the shards as written to: wrapped to record undo information
+        self.shards = []
+        #: a transaction participant for each shard
+        self.participants = []
+        for i in range(shards):
+            store = shard_factory(source=shardSource(source, i),
+                            defaultStatements=defaults[i], **shard_options)
+            self.stores.append(store)
+            if store.updateAdvisory:
+                participant = TwoPhaseTxnModelAdapter(store)
+                self.shards.append(ModelWrapper(store, participant))
+            else:
+                participant = _ShardParticipant(store)
+                self.shards.append(store)
+            self.participants.append(participant)
+
+        if threads is None:
+            threads = shards
+        if threads > 1:
+            self.threadPool = _ThreadPool(threads)
+        else:
+            self.threadPool = None
+
+    #autocommit is false if any shard has autocommit == false
+    autocommit = property(
+        lambda self: reduce(lambda x,y: x and y, [m.autocommit for m in self.stores]),
+        lambda self, set: [setattr(m, 'autocommit', set) for m in self.stores] and None
+        )
+
+    #true if true for all shards
+    updateAdvisory = property(lambda self: all(m.updateAdvisory for m in self.stores))
+
+    def _shardFor(subject, count):
+        if isinstance(subject, ResourceUri):
+            subject = subject.uri
+        if isinstance(subject, unicode):
+            subject = subject.encode('utf8')
+        #crc32 (unlike hash()) is the same on every platform and python version
+        return (zlib.crc32(subject) & 0xffffffffL) % count
+    _shardFor = staticmethod(_shardFor)
+
+    def getShard(self, subject):
+        '''
+        Return the shard that has the statements with the given subject.
+        '''
+        return self.shards[self._shardFor(subject, len(self.shards))]
+
+    def close(self):
+        if self.threadPool:
+            self.threadPool.shutdown()
+            #any later lookups query the shards one at a time
+            self.threadPool = None
+        for store in self.stores:
+            if hasattr(store, 'close'):
+                store.close()
+
+    def getStatistics(self):
+        shardStats = [store.getStatistics() for store in self.stores]
+        if None in shardStats:
+            return None
+        return _ShardedStatistics(shardStats)
+
+    def commit(self, **kw):
+        info = _CommitInfo(kw)
+        try:
+            for participant in self.participants:
+                participant.voteForCommit(info)
+        except:
+            #undo the shards that already committed and roll back the rest
+            self._abort(info)
+            raise
+        for participant in self.participants:
+            participant.commitTransaction(info)
+
+    def _abort(self, info):
+        for participant in self.participants:
+            try:
+                participant.abortTransaction(info)
+            except:
+                log.exception("error rolling back shard")
+
+    def rollback(self):
+        self._abort(_CommitInfo({}))
+
+    def getStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        return list(ShardedModel.iterStatements(self, subject, predicate,
+                            object, objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        '''
+        Lookups by subject are passed to its shard. Otherwise each shard is
+        queried (in parallel if there's a thread pool) and the results are
+        merged.
+        '''
+        if subject is not None:
+            return self.getShard(subject).iterStatements(subject, predicate,
+                                object, objecttype, context, asQuad, hints)
+
+        limit = offset = None
+        _hints = hints and hints.copy() or {}
+        if hints:
+            limit = _hints.get('limit')
+            offset = _hints.pop('offset', None)
+            if limit is not None:
+                #each shard only needs to return enough statements to
+                #fill the page after the offset is skipped
+                _hints['limit'] = limit + (offset or 0)
+        args = [(store, predicate, object, objecttype, context, asQuad,
+                                            _hints) for store in self.stores]
+        if self.threadPool:
+            results = self.threadPool.map(self._getShardStatements, args)
+        else:
+            results = [self._getShardStatements(*a) for a in args]
+        return removeDupStatementsFromSortedIterator(_mergeAll(results),
+                                                    asQuad, limit, offset)
+
+    def _getShardStatements(store, predicate, object, objecttype, context,
+                                                            asQuad, hints):
+        return store.getStatements(None, predicate, object, objecttype,
+                                                    context, asQuad, hints)
+    _getShardStatements = staticmethod(_getShardStatements)
+
+    def addStatement(self, statement):
+        '''add the specified statement to the model'''
+        return self.getShard(statement[0]).addStatement(statement)
+
+    def addStatements(self, statements):
+        '''add the specified statements to the model'''
+        batches = [[] for shard in self.shards]
+        for stmt in statements:
+            batches[self._shardFor(stmt[0], len(batches))].append(stmt)
+        for shard, batch in zip(self.shards, batches):
+            if batch:
+                shard.addStatements(batch)
+
+    def removeStatement(self, statement):
+        '''removes the statement'''
+        return self.getShard(statement[0]).removeStatement(statement)
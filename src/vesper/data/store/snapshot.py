@@ -0,0 +1,361 @@
+#:copyright: Copyright 2009-2011 by the Vesper team, see AUTHORS.
+#:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
+'''
+A compact binary snapshot format for statements that can be opened with
+`mmap` so a store can be loaded without parsing or indexing its statements.
+
+The file starts with a header followed by these sections:
+
+* the string table: the offsets of each string followed by the string data.
+  Every subject, predicate, object, object type and context is stored once
+  (utf8 encoded) and the strings are sorted so comparing two string ids
+  gives the same result as comparing the strings.
+* the statements: 5 string ids per statement, sorted (so this doubles as
+  the subject index).
+* the predicate, object and context indexes: arrays of statement numbers
+  sorted by the statement's predicate, object and context respectively.
+
+All the numbers are unsigned 32-bit little-endian integers.
+'''
+__all__ = ['SnapshotStore', 'writeSnapshot']
+
+import os, os.path, sys
+import mmap, struct, array
+
+from vesper.data.base import * # XXX
+from vesper.data.base._base import _mergeSorted
+from vesper.data.store.basic import MemStore
+
+_MAGIC = 'VSNAPSH1'
+#magic, string count, statement count, size of the string data
+_HEADER = '<8sIII'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+for _TYPECODE in ('I', 'L'):
+    if array.array(_TYPECODE).itemsize == 4:
+        break
+_BIGENDIAN = sys.byteorder == 'big'
+
+def _toArray(data):
+    a = array.array(_TYPECODE)
+    a.fromstring(data)
+    if _BIGENDIAN:
+        a.byteswap()
+    return a
+
+def _toString(a):
+    if _BIGENDIAN:
+        a = array.array(_TYPECODE, a)
+        a.byteswap()
+    return a.tostring()
+
+def _toUnicode(s):
+    if isinstance(s, str):
+        return s.decode('utf8')
+    return s
+
+def writeSnapshot(source, path):
+    '''
+    Write the statements in `source` (a `Model` or an iterable of statements)
+    to a snapshot file at `path`. The file is replaced atomically.
+    '''
+    if isinstance(source, Model):
+        source = source.iterStatements()
+    names = {}
+    rows = set()
+    for stmt in source:
+        rows.add(tuple([names.setdefault(v, v)
+                            for v in [_toUnicode(v) for v in stmt[:5]]]))
+    table = names.keys()
+    table.sort()
+    del names
+    ids = {}
+    for i, s in enumerate(table):
+        ids[s] = i
+    rows = [(ids[s], ids[p], ids[o], ids[ot], ids[c])
+                                    for (s, p, o, ot, c) in rows]
+    rows.sort()
+    del ids
+
+    offsets = array.array(_TYPECODE, [0])
+    data = []
+    size = 0
+    for s in table:
+        s = s.encode('utf8')
+        data.append(s)
+        size += len(s)
+        if size > 0xffffffffL:
+            raise RuntimeError('string table too large for snapshot')
+        offsets.append(size)
+    data = ''.join(data)
+    data += '\0' * (-len(data) % 4)
+
+    flat = array.array(_TYPECODE)
+    for row in rows:
+        flat.extend(row)
+    indexes = []
+    for pos in (1, 2, 4):
+        index = range(len(rows))
+        #sort is stable so each key's statements stay sorted
+        index.sort(key=lambda i: rows[i][pos])
+        indexes.append(array.array(_TYPECODE, index))
+
+    from vesper.data.transactions import TxnFileFactory
+    tff = TxnFileFactory(path)
+    try:
+        outputfile = tff.create('b')
+        outputfile.write(struct.pack(_HEADER, _MAGIC, len(table), len(rows),
+                                                                len(data)))
+        outputfile.write(_toString(offsets))
+        outputfile.write(data)
+        outputfile.write(_toString(flat))
+        for index in indexes:
+            outputfile.write(_toString(index))
+        outputfile.close()
+    except:
+        tff.abortTransaction(None)
+        tff.finishTransaction(None, False)
+        raise
+    else:
+        tff.commitTransaction(None)
+        tff.finishTransaction(None, True)
+
+class SnapshotStore(Model):
+    '''
+    A read-mostly store that maps a snapshot file (see `writeSnapshot`) into
+    memory. Opening it only reads the header, statements and strings are
+    decoded on demand. Changes are kept in memory until `commit()`, which
+    writes a new snapshot, so this is best suited to data that rarely
+    changes.
+    '''
+    canStreamBySubject = True
+    autocommit = False
+    #: the maximum number of decoded strings that are kept
+    stringCacheSize = 10000
+
+    def __init__(self, source, defaultStatements=(), **kw):
+        self.path = source
+        if not os.path.exists(source):
+            writeSnapshot(defaultStatements or (), source)
+        self._open()
+        self.rollback()
+
+    def _open(self):
+        f = open(self.path, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, self.stringCount, self.statementCount, datasize = \
+                        struct.unpack(_HEADER, self._map[:_HEADER_SIZE])
+        if magic != _MAGIC:
+            raise RuntimeError('%s is not a snapshot file' % self.path)
+        self._offsetsStart = _HEADER_SIZE
+        self._dataStart = self._offsetsStart + (self.stringCount + 1) * 4
+        self._rowsStart = self._dataStart + datasize
+        indexSize = self.statementCount * 4
+        indexStart = self._rowsStart + indexSize * 5
+        #statement position => start of the index sorted on it
+        self._indexStarts = { 1 : indexStart, 2 : indexStart + indexSize,
+                                                4 : indexStart + indexSize*2 }
+        #decoded strings, by id
+        self._strings = {}
+        self._resourceId = self._lookup(OBJECT_TYPE_RESOURCE)
+
+    def close(self):
+        self._map.close()
+
+    def _int(self, start, i):
+        start += i * 4
+        return _toArray(self._map[start:start+4])[0]
+
+    def _decode(self, id):
+        offsets = _toArray(self._map[self._offsetsStart + id*4 :
+                                     self._offsetsStart + id*4 + 8])
+        return self._map[self._dataStart + offsets[0]:
+                            self._dataStart + offsets[1]].decode('utf8')
+
+    def _string(self, id):
+        s = self._strings.get(id)
+        if s is None:
+            s = self._decode(id)
+            if len(self._strings) >= self.stringCacheSize:
+                #start over instead of tracking which strings are used most,
+                #the ones used by every lookup are soon decoded again
+                self._strings.clear()
+            self._strings[id] = s
+        return s
+
+    def _lookup(self, value):
+        '''
+        Return the id of the given string or None if isn't in the snapshot.
+        '''
+        value = _toUnicode(value)
+        lo, hi = 0, self.stringCount
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(mid) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.stringCount and self._string(lo) == value:
+            return lo
+        return None
+
+    def _row(self, n):
+        start = self._rowsStart + n * 20
+        return tuple(_toArray(self._map[start:start+20]))
+
+    def _range(self, pos, id):
+        '''
+        Return the range of positions in the index on the given statement
+        position whose statements have `id` at that position.
+        '''
+        if pos == 0:
+            key = lambda i: self._int(self._rowsStart, i*5)
+        else:
+            start = self._indexStarts[pos]
+            key = lambda i: self._int(self._rowsStart,
+                                            self._int(start, i)*5 + pos)
+        lo, hi = 0, self.statementCount
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) < id:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = lo
+        hi = self.statementCount
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(mid) <= id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return first, lo
+
+    def _rows(self, pos, id):
+        '''
+        Yield the rows of string ids that have `id` at the given position or
+        every row if `pos` is None.
+        '''
+        if pos is None:
+            first, last = 0, self.statementCount
+        else:
+            first, last = self._range(pos, id)
+        if pos is None or pos == 0:
+            #read the rows in chunks
+            for chunk in xrange(first, last, 1024):
+                rows = _toArray(self._map[self._rowsStart + chunk*20 :
+                            self._rowsStart + min(chunk + 1024, last)*20])
+                for i in xrange(0, len(rows), 5):
+                    yield tuple(rows[i:i+5])
+        else:
+            start = self._indexStarts[pos]
+            for n in _toArray(self._map[start + first*4 : start + last*4]):
+                yield self._row(n)
+
+    def _iterSnapshot(self, subject, predicate, object, objecttype, context,
+                                                                checkLiteral):
+        '''
+        Yield the statements in the snapshot that match in sorted order.
+        '''
+        ids = []
+        for value in (subject, predicate, object, objecttype, context):
+            if value is None:
+                ids.append(None)
+            else:
+                id = self._lookup(value)
+                if id is None:
+                    return
+                ids.append(id)
+        #pick the most selective index
+        pos = key = None
+        for i in (0, 2, 1, 4):
+            if ids[i] is not None:
+                pos, key = i, ids[i]
+                break
+        resourceId = self._resourceId
+        if pos is None:
+            #don't let a scan of every statement replace the cached strings
+            string = self._decode
+        else:
+            string = self._string
+        for row in self._rows(pos, key):
+            for i in (0, 1, 2, 3, 4):
+                if ids[i] is not None and row[i] != ids[i]:
+                    break
+            else:
+                if checkLiteral and row[3] == resourceId:
+                    continue
+                yield Statement(string(row[0]), string(row[1]),
+                        string(row[2]), string(row[3]), string(row[4]))
+
+    def getStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        stmts = SnapshotStore.iterStatements(self, subject, predicate, object,
+                                    objecttype, context, asQuad, hints)
+        if hints and hints.get('subjectorder'):
+            return stmts
+        return list(stmts)
+
+    def iterStatements(self, subject = None, predicate = None, object = None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        checkLiteral = False
+        if object is not None:
+            if isinstance(object, ResourceUri):
+                object = object.uri
+                objecttype = OBJECT_TYPE_RESOURCE
+            elif objecttype is None:
+                checkLiteral = True
+        stmts = self._iterSnapshot(subject, predicate, object, objecttype,
+                                                        context, checkLiteral)
+        if self.removed:
+            removed = self.removed
+            stmts = (stmt for stmt in stmts if tuple(stmt) not in removed)
+        if self.added.by_s:
+            stmts = _mergeSorted(stmts, self.added.iterStatements(subject,
+                            predicate, object, objecttype, context))
+        hints = hints or {}
+        return removeDupStatementsFromSortedIterator(stmts, asQuad,
+                                    hints.get('limit'), hints.get('offset'))
+
+    def _inSnapshot(self, stmt):
+        for match in self._iterSnapshot(stmt[0], stmt[1], stmt[2], stmt[3],
+                                                            stmt[4], False):
+            return True
+        return False
+
+    def addStatement(self, stmt):
+        '''add the specified statement to the model'''
+        key = tuple([_toUnicode(v) for v in stmt[:5]])
+        if key in self.removed:
+            self.removed.remove(key)
+            return True
+        if self._inSnapshot(key):
+            return False
+        return self.added.addStatement(stmt)
+
+    def removeStatement(self, stmt):
+        '''removes the statement'''
+        if self.added.removeStatement(stmt):
+            return True
+        key = tuple([_toUnicode(v) for v in stmt[:5]])
+        if key in self.removed or not self._inSnapshot(key):
+            return False
+        self.removed.add(key)
+        return True
+
+    def commit(self, **kw):
+        if not self.added.by_s and not self.removed:
+            return
+        writeSnapshot(self.iterStatements(), self.path)
+        self.close()
+        self._open()
+        self.rollback()
+
+    def rollback(self):
+        #uncommitted changes: statements added and the keys of the
+        #snapshot's statements that were removed
+        self.added = MemStore()
+        self.removed = set()
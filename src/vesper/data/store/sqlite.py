@@ -4,56 +4,192 @@ __all__ = ['SqliteStore', 'TransactionSqliteStore']
 
 import os, os.path
 import logging
+import threading
 
 import sqlite3
 
 from vesper.backports import *
 from vesper.data.base import * # XXX
 
+log = logging.getLogger("sqlite")
+
+_SCHEMA = [
+'''CREATE TABLE statements (
+  subject TEXT NOT NULL,
+  predicate TEXT NOT NULL,
+  object TEXT NOT NULL,
+  objecttype TEXT NOT NULL,
+  context TEXT NOT NULL,
+  UNIQUE (subject, predicate, object, objecttype, context)
+)''',
+#the unique constraint's index covers subject lookups
+'CREATE INDEX statements_pred ON statements (predicate, object, objecttype, context, subject)',
+'CREATE INDEX statements_obj ON statements (object, objecttype)',
+'CREATE INDEX statements_ctx ON statements (context)',
+]
+
+_COLUMNS = ('subject', 'predicate', 'object', 'objecttype', 'context')
+
+def _to_text(s):
+    "sqlite3 only accepts ascii 'str' types so convert everything to unicode"
+    if isinstance(s, str):
+        return s.decode('utf-8')
+    elif not isinstance(s, unicode):
+        return unicode(s)
+    return s
+
+def _to_row(stmt):
+    return tuple([_to_text(v) for v in stmt[:5]])
+
+_XSD = 'http://www.w3.org/2001/XMLSchema#'
+#how to cast the object of the numeric types json values are stored as
+_NUMERIC_CASTS = ((_XSD+'integer', 'INTEGER'), (_XSD+'double', 'REAL'))
+#for each comparison operator, the comparison that rules out a row
+_CMP_FAILS = { '<' : '>=', '<=' : '>', '>' : '<=', '>=' : '<' }
+_CMP_REVERSED = { '<' : '>', '<=' : '>=', '>' : '<', '>=' : '<=' }
+
+def _conditionsToSql(alias, conditions):
+    '''
+    Return a SQL expression and its parameters that matches any of the given 
+    position:value mappings or None if it can't be translated.
+    '''
+    alternatives = []
+    params = []
+    for condition in conditions:
+        clauses = []
+        for pos, value in sorted(condition.items()):
+            if not 0 <= pos < len(_COLUMNS):
+                return None
+            clauses.append('%s.%s = ?' % (alias, _COLUMNS[pos]))
+            params.append(_to_text(getattr(value, 'uri', value)))
+        alternatives.append(' AND '.join(clauses) or '1')
+    if not alternatives: #no value can match
+        return '0', params
+    return '(' + ') OR ('.join(alternatives) + ')', params
+
+def _rowToStatement(row):
+    '''
+    Convert a (subject, predicate, object, objecttype, context) row of the
+    statements table to a row in the form returned by `filter()`.
+    '''
+    from vesper import pjson
+    objectType = row[3]
+    if objectType == OBJECT_TYPE_RESOURCE:
+        value = ResourceUri(row[2])
+    else:
+        value = pjson.toJsonValue(row[2], objectType)
+    return (ResourceUri(row[0]), row[1], value, row[3], row[4], None)
+
+def _comparisonsToSql(alias, op, engine, context):
+    '''
+    Return SQL expressions and their parameters that rule out the rows whose 
+    object is a number that fails one of the filter's comparisons with a 
+    number. This doesn't attempt to reproduce how Python compares other 
+    types, the query engine will still apply the comparisons to every row.
+    '''
+    from vesper.query import jqlAST, OBJECT
+    clauses = []
+    params = []
+    for pred in op.args:
+        if (not isinstance(pred, jqlAST.Cmp) or len(pred.args) != 2 
+                or pred.saveValue or pred.op not in _CMP_FAILS):
+            continue
+        cmpop = pred.op
+        proj, other = pred.args
+        if not isinstance(proj, jqlAST.Project):
+            proj, other = other, proj
+            cmpop = _CMP_REVERSED[cmpop]
+        if (not isinstance(proj, jqlAST.Project) or not proj.isPosition()
+                or proj.name != OBJECT or not other.isIndependent()):
+            continue
+        value = other.evaluate(engine, context)
+        if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+            continue
+        for objecttype, cast in _NUMERIC_CASTS:
+            #CAST is only exact for finite numbers ('inf' and 'nan' have an 'n')
+            clauses.append("NOT (%s.objecttype = ? AND %s.object NOT LIKE '%%n%%'"
+                " AND CAST(%s.object AS %s) %s ?)" % (alias, alias, alias, cast,
+                                                        _CMP_FAILS[cmpop]))
+            params.extend([objecttype, value])
+    return clauses, params
+
 class SqliteStore(Model):
     '''
     datastore using SQLite DB using Python's sqlite3 module
-    
+
     create table statements (
-      text subject (index)
-      text predicate (index)
+      text subject
+      text predicate
       text object value
       text objecttype
       text context
     )
 
+    with a unique index on (subject, predicate, object, objecttype, context)
+    and indexes on (predicate, object, objecttype, context, subject),
+    (object, objecttype) and (context).
+
+    Changes are made inside a SQLite transaction that is committed or
+    rolled back by `commit()` and `rollback()`.
     '''
-     
-    def __init__(self, db_path=None, defaultStatements=None, **kw):
-        if db_path is None:
-            self.conn = sqlite3.connect(":memory:")
-            self.cursor = self.conn.cursor()
+
+    updateAdvisory = True
+    canEvaluateFilter = True
+    autocommit = False
+    statistics = None
+
+    def __init__(self, source=None, defaultStatements=None, **kw):
+        if not source:
+            source = ":memory:"
         else:
-            if not os.path.exists(db_path):
-                self.conn = sqlite3.connect(db_path)
-                self.cursor = self.conn.cursor()
-                if defaultStatements:            
-                    self.addStatements(defaultStatements)
-            
+            source = os.path.abspath(source)
+        log.debug("opening db at:" + source)
+        #the connection is guarded by self.lock so it can be shared by threads
+        self.conn = sqlite3.connect(source, check_same_thread=False)
+        self.lock = threading.RLock()
+        newdb = not self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='statements'"
+            ).fetchone()
+        if newdb:
+            for sql in _SCHEMA:
+                self.conn.execute(sql)
+            if defaultStatements:
+                self.addStatements(defaultStatements)
+            self.conn.commit()
+
     def close(self):
-        # are we committed?
+        log.debug("closing db")
         self.conn.close()
-        
+
+    def commit(self, **kw):
+        self.lock.acquire()
+        try:
+            self.conn.commit()
+        finally:
+            self.lock.release()
+
+    def rollback(self):
+        self.lock.acquire()
+        try:
+            self.conn.rollback()
+            #the rolled back changes were counted so recalculate on next use
+            self.statistics = None
+        finally:
+            self.lock.release()
+
     def getStatements(self, subject = None, predicate = None, object = None,
                       objecttype=None,context=None, asQuad=True, hints=None):
-        ''' 
+        '''
         Return all the statements in the model that match the given arguments.
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         '''
-        fs = subject is not None
-        fp = predicate is not None
         fo = object is not None
         fot = objecttype is not None
-        fc = context is not None
         hints = hints or {}
         limit=hints.get('limit')
         offset=hints.get('offset')
+        checkLiteral = False
 
         if fo:
             if isinstance(object, ResourceUri):
@@ -61,29 +197,271 @@ class SqliteStore(Model):
                 fot = True
                 objecttype = OBJECT_TYPE_RESOURCE
             elif not fot:
-                objecttype = OBJECT_TYPE_LITERAL
+                #match any kind of literal
+                checkLiteral = True
+
+        where = []
+        params = []
+        for column, value in zip(_COLUMNS,
+                            (subject, predicate, object, objecttype, context)):
+            if value is not None:
+                where.append(column + ' = ?')
+                params.append(_to_text(value))
+        if checkLiteral:
+            where.append('objecttype != ?')
+            params.append(OBJECT_TYPE_RESOURCE)
+        sql = 'SELECT subject, predicate, object, objecttype, context FROM statements'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY subject, predicate, object, objecttype, context'
+        if asQuad and (limit is not None or offset is not None):
+            #no duplicates to remove so the database can apply the hints
+            sql += ' LIMIT ? OFFSET ?'
+            if limit is None:
+                limit = -1
+            params.extend([limit, offset or 0])
+            limit = offset = None
 
-        stmts = []
-        stmts.sort()        
-        stmts = removeDupStatementsFromSortedList(stmts, asQuad, 
+        self.lock.acquire()
+        try:
+            stmts = [Statement(*row) for row in self.conn.execute(sql, params)]
+        finally:
+            self.lock.release()
+        if not asQuad or limit is not None or offset is not None:
+            stmts = removeDupStatementsFromSortedList(stmts, asQuad,
                                             limit=limit, offset=offset)
         return stmts
 
+    def evaluateFilter(self, op, conditions, joins, engine, context, hints=None):
+        '''
+        Evaluate the filter with a single SQL query: its conditions and 
+        numeric comparisons become the WHERE clause and the filters it is 
+        joined with become EXISTS subqueries on the subject.
+        '''
+        from vesper.query.operations import SimpleTupleset
+
+        where = []
+        params = []
+        filters = [('t0', op, conditions)]
+        for i, (joinop, joinconditions) in enumerate(joins):
+            filters.append( ('t%d' % (i+1), joinop, joinconditions) )
+        for alias, filterop, filterconditions in filters:
+            sqlconditions = _conditionsToSql(alias, filterconditions)
+            if sqlconditions is None:
+                if filterop is op:
+                    return None
+                continue #just don't narrow by this join
+            clauses = [sqlconditions[0]]
+            clauseparams = sqlconditions[1]
+            moreclauses, moreparams = _comparisonsToSql(alias, filterop, 
+                                                            engine, context)
+            clauses.extend(moreclauses)
+            clauseparams.extend(moreparams)
+            if filterop is not op:
+                clauses.insert(0, '%s.subject = t0.subject' % alias)
+                clauses = ['EXISTS (SELECT 1 FROM statements %s WHERE %s)' 
+                                        % (alias, ' AND '.join(clauses))]
+            where.extend(clauses)
+            params.extend(clauseparams)
+
+        sql = ('SELECT t0.subject, t0.predicate, t0.object, t0.objecttype, '
+            't0.context FROM statements t0 WHERE ' + ' AND '.join(where) +
+            ' ORDER BY t0.subject, t0.predicate, t0.object, t0.objecttype, '
+            't0.context')
+
+        def getRows():
+            self.lock.acquire()
+            try:
+                rows = self.conn.execute(sql, params).fetchall()
+            finally:
+                self.lock.release()
+            for row in rows:
+                yield _rowToStatement(row)
+
+        return SimpleTupleset(getRows, columns=self.columns, hint=self,
+                                    op='sqlite filter: ' + sql)
+
+    def evaluateJoin(self, filters, engine, context):
+        '''
+        Evaluate the inner join on the subject of the filters with a single 
+        SQL query: the join becomes a subquery that selects the subjects 
+        that match every filter and the rows of each filter are selected 
+        from those subjects.
+        '''
+        from vesper.query.operations import SimpleTupleset
+
+        joinfrom = []
+        joinwhere = []
+        joinparams = []
+        for i, (filterop, conditions) in enumerate(filters):
+            alias = 't%d' % i
+            sqlconditions = _conditionsToSql(alias, conditions)
+            if sqlconditions is None:
+                return None
+            joinfrom.append('statements ' + alias)
+            if i:
+                joinwhere.append('%s.subject = t0.subject' % alias)
+            joinwhere.append(sqlconditions[0])
+            joinparams.extend(sqlconditions[1])
+        join = 'SELECT t0.subject FROM %s WHERE %s' % (', '.join(joinfrom), 
+                                                    ' AND '.join(joinwhere))
+
+        selects = []
+        params = []
+        for i, (filterop, conditions) in enumerate(filters):
+            sqlconditions = _conditionsToSql('t', conditions)
+            selects.append('SELECT %d, t.subject, t.predicate, t.object, '
+                't.objecttype, t.context FROM statements t WHERE %s AND '
+                't.subject IN (%s)' % (i, sqlconditions[0], join))
+            params.extend(sqlconditions[1])
+            params.extend(joinparams)
+        sql = ' UNION ALL '.join(selects) + ' ORDER BY 1, 2, 3, 4, 5, 6'
+
+        results = []
+        def getRows(i):
+            if not results:
+                self.lock.acquire()
+                try:
+                    rows = self.conn.execute(sql, params).fetchall()
+                finally:
+                    self.lock.release()
+                results.extend([[] for filter in filters])
+                for row in rows:
+                    results[row[0]].append(row[1:])
+            for row in results[i]:
+                yield _rowToStatement(row)
+
+        return [SimpleTupleset(lambda i=i: getRows(i), columns=self.columns,
+                    hint=self, op='sqlite join: ' + sql) 
+                                            for i in range(len(filters))]
+
+    def getStatistics(self):
+        #statistics aren't persisted; the statistics for a predicate are
+        #built with a query the first time they're needed
+        if self.statistics is None:
+            self.statistics = LazyModelStatistics(self._countStatements,
+                                self._listPredicates, self._scanPredicate)
+        return self.statistics
+
+    def _countStatements(self):
+        self.lock.acquire()
+        try:
+            return self.conn.execute(
+                        'SELECT count(*) FROM statements').fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def _listPredicates(self):
+        self.lock.acquire()
+        try:
+            return [row[0] for row in self.conn.execute(
+                                'SELECT DISTINCT predicate FROM statements')]
+        finally:
+            self.lock.release()
+
+    def _scanPredicate(self, predicate, add):
+        self.lock.acquire()
+        try:
+            for row in self.conn.execute('SELECT subject, object, objecttype '
+                'FROM statements WHERE predicate = ?', (_to_text(predicate),)):
+                add( (row[0], predicate, row[1], row[2]) )
+        finally:
+            self.lock.release()
+
     def addStatements(self, stmts):
-        return True
+        if self.statistics is not None:
+            #statistics for the predicates are rebuilt on next use
+            stmts = list(stmts)
+            self.statistics.invalidate(set([stmt[1] for stmt in stmts]))
+        self.lock.acquire()
+        try:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO statements VALUES (?, ?, ?, ?, ?)',
+                                        (_to_row(stmt) for stmt in stmts))
+        finally:
+            self.lock.release()
 
     def addStatement(self, stmt):
         '''add the specified statement to the model'''
-        return True
-        
+        self.lock.acquire()
+        try:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO statements VALUES (?, ?, ?, ?, ?)',
+                                                            _to_row(stmt))
+            added = cursor.rowcount > 0
+        finally:
+            self.lock.release()
+        if added and self.statistics is not None:
+            self.statistics.add(stmt)
+        return added
+
+    def removeStatements(self, stmts):
+        if self.statistics is not None:
+            stmts = list(stmts)
+            self.statistics.invalidate(set([stmt[1] for stmt in stmts]))
+        self.lock.acquire()
+        try:
+            self.conn.executemany('DELETE FROM statements WHERE subject = ? '
+                'AND predicate = ? AND object = ? AND objecttype = ? '
+                'AND context = ?', (_to_row(stmt) for stmt in stmts))
+        finally:
+            self.lock.release()
+
     def removeStatement(self, stmt):
         '''removes the statement'''
-        #p o t => c s
-        #s => p o t c
-        return True
+        self.lock.acquire()
+        try:
+            cursor = self.conn.execute('DELETE FROM statements WHERE subject = ? '
+                'AND predicate = ? AND object = ? AND objecttype = ? '
+                'AND context = ?', _to_row(stmt))
+            removed = cursor.rowcount > 0
+        finally:
+            self.lock.release()
+        if removed and self.statistics is not None:
+            self.statistics.remove(stmt)
+        return removed
 
 class TransactionSqliteStore(TransactionModel, SqliteStore):
     '''
-    Provides in-memory transactions to BdbStore
-
+    Provides in-memory transactions to SqliteStore
     '''
+
+    def addStatements(self, stmts):
+        if self.autocommit:
+            return SqliteStore.addStatements(self, stmts)
+        return Model.addStatements(self, stmts)
+
+    def removeStatements(self, stmts):
+        if self.autocommit:
+            return SqliteStore.removeStatements(self, stmts)
+        return Model.removeStatements(self, stmts)
+
+    def evaluateFilter(self, *args, **kw):
+        if self.queue:
+            #the database doesn't have the queued changes yet
+            return None
+        return SqliteStore.evaluateFilter(self, *args, **kw)
+
+    def evaluateJoin(self, *args, **kw):
+        if self.queue:
+            return None
+        return SqliteStore.evaluateJoin(self, *args, **kw)
+
+    def commit(self, **kw):
+        if not self.queue:
+            self.txnState = TxnState.BEGIN
+            return
+        #write consecutive adds or removes as one batch
+        batch = []
+        for stmt in self.queue + [None]:
+            if batch and (stmt is None 
+                    or (stmt[0] is Removed) != (batch[0][0] is Removed)):
+                if batch[0][0] is Removed:
+                    SqliteStore.removeStatements(self, [s[1] for s in batch])
+                else:
+                    SqliteStore.addStatements(self, [s[0] for s in batch])
+                batch = []
+            if stmt is not None:
+                batch.append(stmt)
+        SqliteStore.commit(self, **kw)
+        self.queue = []
@@ -69,6 +69,15 @@ class TyrantStore(Model):
         Any combination of subject and predicate can be None, and any None slot is
         treated as a wildcard that matches any value in the model.
         """
+        return list(TyrantStore.iterStatements(self, subject, predicate, 
+                                    object, objecttype, context, asQuad, hints))
+
+    def iterStatements(self, subject=None, predicate=None, object=None,
+                      objecttype=None,context=None, asQuad=True, hints=None):
+        """
+        Table queries can only be ordered by one column so the matching 
+        statements are still sorted here before they are streamed.
+        """
         q = {}
         if subject is not None:
             q['subj__streq'] = to_str(subject)
@@ -119,7 +128,7 @@ class TyrantStore(Model):
             results.conditions.append(tmp)
         
         if len(results) == 0:
-            return []
+            return iter(())
         else:
             results = results.items()
             
@@ -134,9 +143,10 @@ class TyrantStore(Model):
 
         stmts.sort() # XXX make tokyo tyrant do this
         if not asQuad: # XXX should go away!
-            return removeDupStatementsFromSortedList(stmts, asQuad, **(hints or {}))
+            #the query already applied the limit and offset
+            return removeDupStatementsFromSortedIterator(stmts, asQuad)
         else:
-            return stmts
+            return iter(stmts)
     
 
     def addStatement(self, statement):
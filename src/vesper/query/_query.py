@@ -48,9 +48,11 @@ We could give the propery different names just as can "SELECT foo AS fob FROM ta
 from vesper.backports import *
 from vesper.data.base import Tupleset, ColumnInfo, EMPTY_NAMESPACE, ResourceUri
 from vesper import utils, pjson
-import StringIO
+from vesper.utils import MRUCache
+import StringIO, copy
 import vesper.utils._utils
 import time
+import threading
 
 SUBJECT = 0
 PROPERTY = 1
@@ -77,18 +79,39 @@ def runQuery(query, model):
     (ast, err) = buildAST(query)
     return evalAST(ast, model)
 
+def _captureErrors(results, errors):
+    '''
+    Yield the results, stopping and appending the error to `errors` if 
+    constructing one raises an exception.
+    '''
+    results = iter(results)
+    while True:
+        try:
+            result = results.next()
+        except StopIteration:
+            return
+        except QueryException, qe:
+            errors.append('error: %s' % qe.message)
+            return
+        except Exception:
+            import traceback
+            errors.append("unexpected exception: %s" % traceback.format_exc())
+            return
+        yield result
+
 def getResults(query, model, bindvars=None, explain=None, debug=False,
     forUpdate=False, captureErrors=False, contextShapes=None, useSerializer=True,
-    printast=False, queryCache=None):
+    printast=False, queryCache=None, stream=False):
     '''
     Returns a dict with the following keys:
         
     - `results`: the result of the query (either a list or None if the query failed)
+      or an iterator if `stream` is True
     - `errors`: An error string if the query failed or an empty list if it succeeded.
     
     :Parameters:
      query
-       the query
+       the query (either a string or an AST returned by `buildAST`)
      model
        the store upon which to execute the query
     bindvars
@@ -110,7 +133,13 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     useSerializer
        If value is a boolean, indicates whether pjson serialization is used or 
        not (default: True). If value is a dict it is passed as keyword arguments
-       to the `pjson.Serializer` constructor.
+       to the `pjson.Serializer` constructor. It can also be a 
+       `pjson.Serializer` (see `makeSerializer`).
+    stream
+       If True, `results` will be an iterator that constructs each result 
+       object as it is needed instead of a list and `elapsed` will be None. 
+       If `captureErrors` is also True, an exception raised while iterating 
+       ends the iteration and is appended to `errors`.
     '''
     #XXX? add option to include `resources` in the result,
     # a list describing the resources (used for track changes)
@@ -118,8 +147,12 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     response = utils.attrdict()
     errors = []
     
-    (ast, parseErrors) = buildAST(query)
-    errors.extend(parseErrors)
+    from vesper.query import jqlAST
+    if isinstance(query, jqlAST.QueryOp): #already parsed
+        ast = query
+    else:
+        (ast, parseErrors) = buildAST(query)
+        errors.extend(parseErrors)
     
     response['results'] = []
     
@@ -131,8 +164,12 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     
     if ast != None:        
         try:
-            results = list(evalAST(ast, model, bindvars, explain, debug, 
-                    forUpdate, contextShapes, useSerializer, queryCache))
+            results = evalAST(ast, model, bindvars, explain, debug, 
+                    forUpdate, contextShapes, useSerializer, queryCache)
+            if not stream:
+                results = list(results)
+            elif captureErrors:
+                results = _captureErrors(results, errors)
             #XXX: if forUpdate add a pjson header including namemap
             #this we have a enough info to reconstruct refs and datatypes without guessing
             #if forUpdate: 
@@ -151,7 +188,11 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
             else:
                 raise
     
-    response['elapsed'] = time.clock() - start
+    if stream:
+        #the results haven't been constructed yet
+        response['elapsed'] = None
+    else:
+        response['elapsed'] = time.clock() - start
     response['errors'] = errors
     if explain:
         response['explain'] = explain.getvalue()        
@@ -165,11 +206,217 @@ def getResults(query, model, bindvars=None, explain=None, debug=False,
     
     return response
 
-def buildAST(query, namemap=None):
+def _hashableKey(obj):
+    if isinstance(obj, dict):
+        return tuple(sorted([(k, _hashableKey(v)) for k, v in obj.items()]))
+    elif isinstance(obj, (list, tuple)):
+        return tuple([_hashableKey(v) for v in obj])
+    return obj
+
+class ASTCache(object):
+    '''
+    A bounded, thread-safe LRU cache of parsed queries, keyed by the query 
+    text and namemap. Cached ASTs are shared between callers so they must be 
+    treated as read-only: the query engine never modifies the AST during 
+    evaluation and bindvars are resolved through the `QueryContext`, so the 
+    same AST can be evaluated concurrently with different bindvars.
+    
+    `hits` and `misses` count cache lookups.
+    '''
+    
+    def __init__(self, capacity=500):
+        self.cache = MRUCache.MRUCache(capacity)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _parse(self, key, query, namemap):
+        from vesper.query import parse, engine
+        self.misses += 1
+        if namemap is not None:
+            #parse will update the namemap so give it a copy
+            namemap = namemap.copy()
+        return parse.parse(query, engine.SimpleQueryEngine.queryFunctions,
+                                                        False, namemap)
+    
+    def _isCacheable(self, key, value, *args):
+        if value[0] is None: #parse failed, don't cache errors
+            return MRUCache.NotCacheable
+        return value
+    
+    def getAST(self, query, namemap=None):
+        "parse a query or retrieve it from the cache, returning (ast, [error messages])"
+        key = (query, _hashableKey(namemap))
+        #the parser holds the GIL while it runs so there's little to gain by 
+        #parsing outside of the lock
+        self.lock.acquire()
+        try:
+            misses = self.misses
+            result = self.cache.getOrCalcValue(self._parse, key, query, namemap,
+                            hashCalc=lambda key, *args: key, 
+                            isValueCacheableCalc=self._isCacheable)
+            if misses == self.misses:
+                self.hits += 1
+            return result
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.cache.clear()
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
+
+#: process-wide cache used by `buildAST`
+astCache = ASTCache()
+
+def buildAST(query, namemap=None, useCache=True):
     "parse a query, returning (ast, [error messages])"
+    if useCache and astCache.cache.capacity:
+        return astCache.getAST(query, namemap)
     from vesper.query import parse, engine
     return parse.parse(query, engine.SimpleQueryEngine.queryFunctions, False, namemap)
 
+def getQueryDependencies(ast):
+    '''
+    Return the set of properties the results of the given query depend on, 
+    or None if the results might depend on any statement (e.g. the query 
+    uses `*`, a `depth` or a function that accesses the store).
+    '''
+    from vesper.query import jqlAST
+    dependencies = set()
+    for op in ast.depthfirst():
+        if isinstance(op, jqlAST.ResourceSetOp) and not op.args:
+            return None #matches every resource
+        elif isinstance(op, jqlAST.Select) and op.depth:
+            return None
+        elif isinstance(op, jqlAST.Project):
+            if op.name == '*' or len(op.fields) > 1:
+                return None
+        elif isinstance(op, jqlAST.AnyFuncOp):
+            if op.metadata.needsContext and not op.metadata.isAggregate:
+                return None
+        elif isinstance(op, jqlAST.Filter):
+            props = [pred for pred in op.args if isinstance(pred, jqlAST.Eq)
+                and isinstance(pred.left, jqlAST.Project) 
+                and pred.left.name == PROPERTY 
+                and isinstance(pred.right, jqlAST.Constant)]
+            props += [pred for pred in op.args if isinstance(pred, jqlAST.Eq)
+                and isinstance(pred.right, jqlAST.Project) 
+                and pred.right.name == PROPERTY 
+                and isinstance(pred.left, jqlAST.Constant)]
+            if not props:
+                return None
+            for pred in props:
+                for arg in pred.args:
+                    if isinstance(arg, jqlAST.Constant):
+                        dependencies.add(arg.value)
+    return dependencies
+
+class ResultCacheOwner(object):
+    '''
+    Identifies the entries a store adds to a `QueryResultCache`.
+    '''
+    #: incremented each time the owner's entries are invalidated
+    generation = 0
+    #: the revision of the store the owner's entries are valid for
+    revision = None
+
+class QueryResultCache(object):
+    '''
+    A bounded, thread-safe LRU cache of query results that can be shared 
+    across transactions and stores. Entries are evicted based on the 
+    number of result objects they hold.
+    
+    Each entry records its owner (a `ResultCacheOwner`) and the properties 
+    it depends on (see `getQueryDependencies`) so that a commit only needs 
+    to invalidate the entries that depend on the properties it changed. 
+    Results are copied when added and retrieved since callers are free to 
+    modify them.
+    
+    `hits` and `misses` count cache lookups.
+    '''
+    
+    def __init__(self, capacity=10000):
+        self.cache = MRUCache.MRUCache(capacity, 
+                            capacityCalc=lambda key, value: len(value[2])+1)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def getKey(self, owner, query, *args):
+        '''
+        Returns the key for the given owner, query (a string or AST) and 
+        arguments (e.g. bindvars) or None if they are not hashable.
+        '''
+        key = (owner, query) + _hashableKey(args)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        "Returns a copy of the cached results or None if `key` isn't found"
+        self.lock.acquire()
+        try:
+            if key not in self.cache.nodeDict:
+                self.misses += 1
+                return None
+            self.hits += 1
+            #this just updates the entry's position in the LRU list
+            value = self.cache.getOrCalcValue(None, key, 
+                                    hashCalc=lambda key: key)
+        finally:
+            self.lock.release()
+        return copy.deepcopy(value[2])
+
+    def put(self, key, owner, generation, dependencies, results):
+        '''
+        Add the results unless the owner's entries were invalidated since
+        `generation` was read (i.e. while the results were being computed).
+        '''
+        value = (owner, dependencies, copy.deepcopy(results))
+        self.lock.acquire()
+        try:
+            if owner.generation != generation:
+                return
+            self.cache.getOrCalcValue(lambda key: value, key, 
+                                    hashCalc=lambda key: key)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, owner, properties=None):
+        '''
+        Remove the entries belonging to `owner` that depend on any of the 
+        given properties, or all of the owner's entries if `properties` is None.
+        '''
+        self.lock.acquire()
+        try:
+            owner.generation += 1
+            for node in self.cache.nodeDict.values():
+                entryOwner, dependencies, results = node.value
+                if entryOwner is not owner:
+                    continue
+                if (properties is None or dependencies is None 
+                        or dependencies.intersection(properties)):
+                    self.cache.removeNode(node)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.cache.clear()
+            self.hits = self.misses = 0
+        finally:
+            self.lock.release()
+
+#: process-wide cache used by stores that enable query result caching
+resultCache = QueryResultCache()
+
 def _parsePjson(parseContext, v):
     #XXX handle pjson dicts
     if isinstance(v, (str, unicode)):
@@ -178,19 +425,29 @@ def _parsePjson(parseContext, v):
             return ResourceUri(ref)
     return v
 
+def makeSerializer(ast, useSerializer=True):
+    '''
+    Return the `pjson.Serializer` used to evaluate the given AST (or None 
+    if `useSerializer` is false). See `getResults` for `useSerializer`.
+    '''
+    if isinstance(useSerializer, pjson.Serializer):
+        return useSerializer
+    astNameMap = getattr(ast,'namemap', None)
+    if isinstance(useSerializer, dict):
+        if astNameMap is not None:
+            useSerializer = dict(useSerializer, nameMap=astNameMap)
+        return pjson.Serializer(**useSerializer)
+    elif useSerializer:
+        return pjson.Serializer(astNameMap)
+    else:
+        return None
+
 def evalAST(ast, model, bindvars=None, explain=None, debug=False, 
     forUpdate=False, contextShapes=None, useSerializer=True, queryCache=None):
     from vesper.query import engine
     
     astNameMap = getattr(ast,'namemap', None)
-    if isinstance(useSerializer, dict):        
-        if astNameMap is not None:
-            useSerializer['nameMap'] = astNameMap
-        serializer = pjson.Serializer(**useSerializer)
-    elif useSerializer:
-        serializer = pjson.Serializer(astNameMap)
-    else:
-        serializer = None
+    serializer = makeSerializer(ast, useSerializer)
     if bindvars:
         if serializer:
             parseContext = serializer.parseContext
@@ -221,6 +478,9 @@ class QueryContext(object):
     finalizedAggs = False
     groupby = None
     complexPredicateHack = False
+    subjectOrderHint = False
+    semijoinFilters = ()
+    joinedFilter = None
     
     def __init__(self, initModel, ast, explain=False, bindvars=None, debug=False,
             depth=0, forUpdate=False, shapes=None, serializer=None, cache=None):
@@ -8,14 +8,15 @@ Defines the evaluation engine, which, given an jql ast and a query context,
 returns a generator which yields the results of the query.
 """
 
-import operator, copy, sys, pprint, itertools
+import operator, copy, sys, pprint, itertools, heapq
 
 from vesper.query import jqlAST
 from vesper.data import base
 from vesper.utils import flattenSeq, flatten, debugp
 from vesper import pjson
 from vesper.query import *
-from vesper.query.operations import validateRowShape, SimpleTupleset, MutableTupleset, IterationJoin
+from vesper.query.operations import validateRowShape, SimpleTupleset, MutableTupleset, \
+                                IterationJoin, HashJoin, MergeJoin
 from vesper.backports import product
 
 #############################################################
@@ -187,27 +188,24 @@ def chooseColumns(groupby, columns, includekey=False):
         outputcolumns.append(groupbycol) #goes last
     return MutableTupleset(columns=outputcolumns)
 
-def groupbyOrdered(tupleset, groupby, debug=False):
+def groupbyOrdered(tupleset, groupby, debug=False, outerjoin=False, includekey=False):
     '''
     More efficient version of groupbyUnordered -- use if the tupleset is
-    ordered by column in the given pos
+    ordered by column in the given pos. Unlike groupbyUnordered this doesn't
+    need to read the whole tupleset before yielding the first group.
     '''
     previous = None
+    vals = None
     for row in tupleset:
-        cols = []
-        keycell = None
-        for i, cell in enumerate(row):
-            if i == groupby:
-                keycell = cell
-            else:
-                cols.append(cell)
-        assert keycell is not None
-        if keycell != previous:
-            yield [previous, vals]
-            vals = MutableTupleset()
-            previous = keycell
-        vals.append(cols)
-    if previous is not None:
+        if debug: validateRowShape(tupleset.columns, row)
+        for key, outputrow in getColumns(groupby, row, outerjoin=outerjoin, includekey=includekey):
+            if vals is None or key != previous:
+                if vals is not None:
+                    yield [previous, vals]
+                vals = MutableTupleset()
+                previous = key
+            vals.append(outputrow)
+    if vals is not None:
         yield [previous, vals]
 
 #############################################################
@@ -496,6 +494,46 @@ def _aggCount(context, x, y):
     else:
         return x
 
+class _DescendingKey(object):
+    '''
+    Wraps a sort key value so that it sorts in the reverse order.
+    '''
+    __slots__ = ('value',)
+    
+    def __init__(self, value):
+        self.value = value
+    
+    def __cmp__(self, other):
+        return cmp(other.value, self.value)
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return cmp(other.value, self.value) < 0
+
+    def __gt__(self, other):
+        return cmp(other.value, self.value) > 0
+
+    def __le__(self, other):
+        return cmp(other.value, self.value) <= 0
+
+    def __ge__(self, other):
+        return cmp(other.value, self.value) >= 0
+
+def _compare(op, lvalue, rvalue):
+    result = cmp(lvalue, rvalue)
+    if result == 0 and (op == '<=' or op == '>='):
+        return True
+    elif result < 0 and op[0] == '<':
+        return True
+    elif result > 0 and op[0] == '>':
+        return True        
+    return False
+
 class SimpleQueryEngine(object):
     
     queryFunctions = QueryFuncs() 
@@ -608,7 +646,15 @@ class SimpleQueryEngine(object):
                         [ColumnInfo('', object)], ([1],), op='constant')
         else: 
             if op.where:
+                #if nothing needs to see every row before construct applies
+                #the limit, ask the model to stream the rows in subject order
+                #so the scan stops once enough objects have been constructed
+                #(offset-only queries use it too so pages have a stable order)
+                context.subjectOrderHint = ((op.limit is not None 
+                    or op.offset is not None) and not op.groupby 
+                    and not op.orderby and not op.construct.hasAggFunc)
                 context.currentTupleset = op.where.evaluate(self, context)
+                context.subjectOrderHint = False
             if op.groupby:
                 context.currentTupleset = op.groupby.evaluate(self, context)
             if op.orderby:
@@ -984,8 +1030,7 @@ class SimpleQueryEngine(object):
 
     def evalOrderBy(self, op, context):
         #XXX only order by if orderby is different then current order of tupleset
-        tupleset = context.currentTupleset
-        tupleset = MutableTupleset(tupleset.columns, tupleset, hint=tupleset, op='order by')
+        source = context.currentTupleset
 
         assert all(isinstance(s.exp, jqlAST.Project) for s in op.args), 'only property name lists currently implemented'        
         #print 'c', tupleset.columns, [s.exp.name for s in op.args]
@@ -993,33 +1038,73 @@ class SimpleQueryEngine(object):
             if project.isPosition():
                 return (project.name,)
             else:
-                return tupleset.findColumnPos(project.name) 
+                return source.findColumnPos(project.name) 
         positions = [getpos(s.exp) for s in op.args]
 
         reverse = all(not s.asc for s in op.args) #all desc
-        if not reverse and not all(s.asc for s in op.args):
-            #mixed asc and desc
-            orders = [s.asc for s in op.args]
-            def orderbyCmp(row1, row2):
-                for pos, order in zip(positions, orders):
-                    v1 = flatten( (c[0] for c in getColumn(pos, row1)))
-                    v2 = flatten( (c[0] for c in getColumn(pos, row2)))
-                    c = cmp(v1,v2)
-                    if c == -1:
-                        return order and -1 or 1
-                    elif c == 1:
-                        return order and 1 or -1
-                return 0
-
-            tupleset.sort(cmp=orderbyCmp)
-        else:
+        if reverse or all(s.asc for s in op.args):
             def extractKey(row):
                 return [flatten( (c[0] for c in getColumn(pos, row))) for pos in positions]
-
+        else:
+            #mixed asc and desc: wrap the descending values so that one 
+            #ascending sort orders all of them
+            orders = zip(positions, [s.asc for s in op.args])
+            def extractKey(row):
+                key = []
+                for pos, asc in orders:
+                    v = flatten( (c[0] for c in getColumn(pos, row)))
+                    if asc:
+                        key.append(v)
+                    else:
+                        key.append(_DescendingKey(v))
+                return key
+
+        select = op.parent
+        if (select.limit is not None and not select.groupby 
+                                and not select.construct.hasAggFunc):
+            tupleset = SimpleTupleset(self._topRows(source, extractKey, reverse, 
+                    select.limit + (select.offset or 0)), columns=source.columns, 
+                    hint=source, op='order by (top %d)' % select.limit, 
+                    debug=context.debug)
+        else:
+            tupleset = MutableTupleset(source.columns, source, hint=source, op='order by')
             tupleset.sort(key=extractKey, reverse=reverse)
-
+        if op.args[0].asc and len(positions[0]) == 1:
+            tupleset.orderedBy = positions[0][0]
         return tupleset
 
+    def _topRows(self, tupleset, extractKey, reverse, k):
+        '''
+        Returns a function that yields the rows in the same order as sorting 
+        with the given key would but only keeps the first `k` rows in memory.
+        '''
+        def decorate():
+            #include the row index so ties keep the original order (like
+            #sort(), which is stable) and rows are never compared themselves
+            if reverse:
+                for i, row in enumerate(tupleset):
+                    yield (extractKey(row), -i, row)
+            else:
+                for i, row in enumerate(tupleset):
+                    yield (extractKey(row), i, row)
+
+        def topRows():
+            if reverse:
+                rows = heapq.nlargest(k, decorate())
+            else:
+                rows = heapq.nsmallest(k, decorate())
+            for key, i, row in rows:
+                yield row
+            if len(rows) < k:
+                return
+            #construct needs more than k rows (e.g. some rows didn't produce 
+            #an object) so fallback to sorting all of them
+            rows = list(decorate())
+            rows.sort(reverse=reverse)
+            for key, i, row in rows[k:]:
+                yield row
+        return topRows
+
     def evalGroupBy(self, op, context):
         tupleset = context.currentTupleset
         label = op.name
@@ -1044,7 +1129,6 @@ class SimpleQueryEngine(object):
         group the given tupleset by the column specified by given join condition
         and return a tupleset whose first column is the group by key.
         '''
-        #XXX use groupbyOrdered if we know tupleset is ordered by groupby key
         position = tupleset.findColumnPos(joincond.position)
         assert position is not None, 'cant find %r in %s %s' % (
                     joincond.position, tupleset, tupleset.columns)
@@ -1059,11 +1143,18 @@ class SimpleQueryEngine(object):
                                 chooseColumns(position,tupleset.columns, includekey) )
         ]
         outerjoin = joincond.join in ('r')
-        return SimpleTupleset(
-            lambda: groupbyUnordered(tupleset, position,
+        if tupleset.orderedBy is not None and (tupleset.orderedBy,) == position:
+            groupby = groupbyOrdered
+        else:
+            groupby = groupbyUnordered
+        grouped = SimpleTupleset(
+            lambda: groupby(tupleset, position,
                                     debug and columns, outerjoin, includekey),
             columns=columns,
             hint=tupleset, op=msg + repr((joincond.join, joincond.position)),  debug=debug)
+        if groupby is groupbyOrdered:
+            grouped.orderedBy = 0
+        return grouped
 
     def reorderWithListInfo(self, context, op, listval):
         if isinstance(op.name, int):
@@ -1148,13 +1239,19 @@ class SimpleQueryEngine(object):
             current = self._groupby(result, joincond,debug=context.debug)
 
     def _evalJoin(self, op, context):
+        #joins on a label depend on an earlier argument providing that column
+        #so only reorder by cost when every argument joins on the subject
+        costBased = not [arg for arg in op.args 
+            if not isinstance(arg.leftPosition, int) or arg.join != 'i'
+                or getattr(arg.op, 'complexPredicates', False)
+            ] and not self._hasOrderDependentProjections(op)
         args = sorted(op.args, key=lambda arg:
             #put non-inner joins and filters with complex predicates last
             #XXX: we should do semantic ordering earlier so it shows up in the ast
             #and maybe mark each group so we can do this cost-based ordering per group
             (getattr(arg.leftPosition, 'startswith', lambda s:False)('#@'),
             getattr(arg.op, 'complexPredicates', False), arg.join != 'i',
-                                                arg.op.cost(self, context)) )
+                                costBased and arg.op.cost(self, context) or 0) )
 
         tmpop = None
         if not args or args[0].join != 'i':
@@ -1173,12 +1270,17 @@ class SimpleQueryEngine(object):
         # use that as source of the filter
         # 2. estimate and compare cost of using the prior result so next filter
         # can use that as source (compare with cost of filtering with current source)
-        # 3.if we know results are ordered properly we can do a MergeJoin
-        #   (more efficient than IterationJoin):
-        #lslice = slice( joincond.position, joincond.position+1)
-        #rslice = slice( 0, 1) #curent tupleset
-        #current = MergeJoin(result, current, lslice,rslice)
+        #(see _chooseJoinAlgorithm for how the join operator is picked)
         previous = None
+        #estimated number of rows on the left side of the join
+        previousEstimate = None
+        hasStatistics = self._getStatistics(context) is not None
+        subjectOrderHint = context.subjectOrderHint
+        context.subjectOrderHint = False
+        semijoins = self._getSemijoinFilters(op, context)
+        joinedFilters = semijoins and self._evalJoinInModel(semijoins, context)
+        if joinedFilters:
+            semijoins = None
         #print 'evaljoin', args
         while args:
             joincond = args.pop(0)
@@ -1189,11 +1291,38 @@ class SimpleQueryEngine(object):
             if previous and isinstance(joincond.op, jqlAST.Filter) and joincond.op.complexPredicates:
                 fcontext = copy.copy(context)
                 fcontext.currentTupleset = previous
+            elif (subjectOrderHint and isinstance(joincond.op, jqlAST.Filter)
+                    and joincond.position == '#%d' % SUBJECT
+                    and ((not previous and joincond.join == 'i') 
+                        or (previous and previous.orderedBy == SUBJECT
+                            and joincond.leftPosition == SUBJECT
+                            and joincond.join != 'x'))):
+                #the left-most side of the join determines the order of 
+                #the results so only its rows need to be streamed, the filters
+                #joined to it on the subject are streamed in the same order
+                #so they can be merge joined
+                fcontext = copy.copy(context)
+                fcontext.subjectOrderHint = True
             else:
                 fcontext = context
 
+            if semijoins:
+                if fcontext is context:
+                    fcontext = copy.copy(context)
+                fcontext.semijoinFilters = [semijoin for arg, semijoin 
+                                        in semijoins if arg is not joincond]
+            elif joinedFilters:
+                if fcontext is context:
+                    fcontext = copy.copy(context)
+                fcontext.joinedFilter = [tupleset for arg, tupleset 
+                                    in joinedFilters if arg is joincond][0]
+
             result = joincond.op.evaluate(self, fcontext)
             assert isinstance(result, Tupleset), repr(result) + repr(joincond.op)
+            if hasStatistics:
+                estimate = joincond.op.cost(self, context)
+            else:
+                estimate = None
             #group by the join key so that it is first column in the result
             #(except when its a cross-join, which has no key).
             #note: this guarantees one row on each side.
@@ -1355,20 +1484,132 @@ class SimpleQueryEngine(object):
                         'l', previous, indexToLeft, nullrows, leftpos, previous),
                                     columns,joincond.name,debug=context.debug)
                 else:
-                    previous = IterationJoin(previous, current, bindjoinFunc(
+                    joinAlgorithm = self._chooseJoinAlgorithm(previous, current,
+                                leftpos, jointype, previousEstimate, estimate)
+                    #the join preserves the order of the left rows
+                    orderedBy = previous.orderedBy
+                    previous = joinAlgorithm(previous, current, bindjoinFunc(
                      joincond, current, indexToLeft, nullrows, leftpos, previous),
                                     columns,joincond.name,debug=context.debug)
+                    previous.orderedBy = orderedBy
+                    if jointype == 'i' and estimate is not None:
+                        #an inner join can't return more rows than either side
+                        previousEstimate = min(previousEstimate, estimate)
             else:
                 previous = current
+                previousEstimate = estimate
 
         return previous
 
+    def _hasOrderDependentProjections(self, op):
+        '''
+        Return True if the select whose where clause is `op` computes 
+        expressions over properties: the values of multi-valued (e.g. list)
+        properties are shaped differently depending on which side of the join 
+        they come from, so reordering the join would change the results.
+        '''
+        construct = getattr(op.parent, 'construct', None)
+        if construct is None:
+            return False
+        notSelect = lambda op: not isinstance(op, jqlAST.Select)
+        for prop in construct.args:
+            value = getattr(prop, 'value', None)
+            if value is None or isinstance(value, (jqlAST.Project, 
+                                        jqlAST.Select, jqlAST.Constant)):
+                continue
+            for child in value.depthfirst(notSelect):
+                if isinstance(child, jqlAST.Project) and not child.isPosition():
+                    return True
+        return False
+
+    def _chooseJoinAlgorithm(self, left, right, leftpos, jointype,
+                                    leftEstimate=None, rightEstimate=None):
+        '''
+        Return the Join class used to join `left` with `right`, where `right` 
+        has been grouped so that its first column is the join key. 
+        `leftEstimate` and `rightEstimate` are the estimated sizes of each side
+        (None if the model doesn't have statistics).
+        '''
+        if jointype == 'x':
+            #cross joins have no key so every left row has to visit every right row
+            return IterationJoin
+        if (isinstance(leftpos, int) and left.orderedBy == leftpos 
+                and right.orderedBy == 0):
+            #both sides are sorted on the key so we can walk them in step
+            #without building an index
+            return MergeJoin
+        if (leftEstimate is not None and rightEstimate is not None and
+                leftEstimate * rightEstimate <= leftEstimate + rightEstimate):
+            #one side is so small that scanning the right side for each left 
+            #row is cheaper than building a hash table on it
+            return IterationJoin
+        #otherwise build a hash table on the (grouped) right side
+        return HashJoin
+
+    def _getSimpleValue(self, proj, value, context):
+        '''
+        Return a position:value mapping that matches `value` at the position 
+        the given `Project` refers to.
+        '''
+        if proj.name == OBJECT:
+            #XXX if value is not a json value type, need a hook so there
+            #can be date-store specific objectType
+            #e.g. a date() query function could return a date object
+            #as it stands, pjson.getDataType will raise an error 
+            if context.serializer:
+                parseContext = context.serializer.parseContext
+            else:
+                parseContext = None
+            value, objectType = vesper.pjson.getDataType(value, parseContext)
+            return { OBJECT : value, OBJTYPE_POS : objectType }
+        return { proj.name : value }
+
+    def _findInProbes(self, pred, context):
+        '''
+        If `pred` is an `In` that tests a position against a list of constant 
+        values return the `Project` and the list of values, otherwise None.
+        '''
+        proj = pred.args[0]
+        if not isinstance(proj, jqlAST.Project) or not proj.isPosition():
+            return None
+        values = []
+        for arg in pred.args[1:]:
+            if not arg.isIndependent():
+                return None
+            value = arg.evaluate(self, context)
+            if isinstance(value, (list, tuple)):
+                values.extend(value)
+            else:
+                values.append(value)
+        for value in values:
+            if value is None or isinstance(value, (Tupleset, dict, list)):
+                return None
+            if proj.name == OBJECT and isinstance(value, (int, long, float)):
+                #numbers and booleans are equal across types (1 == 1.0 == true)
+                #but are stored with different object types, so compare them 
+                #row by row
+                return None
+        return proj, values
+
     def _findSimplePredicates(self, op, context):
-        simpleops = (jqlAST.Eq,) #only Eq supported for now
+        '''
+        Returns `(simplefilter, complexargs, probes)` where `simplefilter` is a 
+        position:value mapping built from the `Eq` predicates that can be 
+        looked up directly in the model, `complexargs` is the list of remaining 
+        predicates and `probes` is None or, if an `In` predicate tests a 
+        position against a list of values, a list of position:value mappings 
+        (one per distinct value) each of which must be looked up along with 
+        `simplefilter`.
+        '''
+        simpleops = (jqlAST.Eq,) 
         complexargs = []
         simplefilter = {}
+        inpreds = []
         for pred in op.args:
             complexargs.append(pred)
+            if isinstance(pred, jqlAST.In):
+                inpreds.append(pred)
+                continue
             if not isinstance(pred, simpleops):
                 continue
             if isinstance(pred.left, jqlAST.Project) and pred.right.isIndependent():
@@ -1385,26 +1626,91 @@ class SimpleQueryEngine(object):
                 #position already taken, treat as complex
                 continue
             value = other.evaluate(self, context)
-            if proj.name == OBJECT:
-                #XXX if value is not a json value type, need a hook so there
-                #can be date-store specific objectType
-                #e.g. a date() query function could return a date object
-                #as it stands, pjson.getDataType will raise an error 
-                if context.serializer:
-                    parseContext = context.serializer.parseContext
-                else:
-                    parseContext = None
-                value, objectType = vesper.pjson.getDataType(value, parseContext)
-                simplefilter[3] = objectType
-            simplefilter[proj.name] = value
+            simplefilter.update(self._getSimpleValue(proj, value, context))
             complexargs.pop()
-        return simplefilter, complexargs
+
+        #turn (at most) one IN predicate into a list of index probes
+        probes = None
+        for pred in inpreds:
+            found = self._findInProbes(pred, context)
+            if not found or found[0].name in simplefilter:
+                continue
+            proj, values = found
+            probes = []
+            seen = set()
+            for value in values:
+                probe = self._getSimpleValue(proj, value, context)
+                key = tuple(sorted(probe.items()))
+                if key not in seen: #distinct probes match distinct rows
+                    seen.add(key)
+                    probes.append(probe)
+            complexargs = [arg for arg in complexargs if arg is not pred]
+            break
+        return simplefilter, complexargs, probes
+
+    def _getFilterConditions(self, simplefilter, probes):
+        '''
+        Return the list of position:value mappings that the rows matching
+        the given results of `_findSimplePredicates` each match one of.
+        '''
+        if probes is None:
+            return [simplefilter]
+        conditions = []
+        for probe in probes:
+            condition = simplefilter.copy()
+            condition.update(probe)
+            conditions.append(condition)
+        return conditions
+
+    def _getSemijoinFilters(self, op, context):
+        '''
+        If the model can evaluate filters and every argument of the given 
+        `Join` is a filter on the model that is inner joined on the subject,
+        return a list of `(joincond, (filter, conditions))` pairs so the model 
+        can use the other filters to narrow down the rows of each filter.
+        Otherwise return None.
+        '''
+        model = context.initialModel
+        if (len(op.args) < 2 or context.currentTupleset is not model
+                or not getattr(model, 'canEvaluateFilter', False)):
+            return None
+        semijoins = []
+        for arg in op.args:
+            if (arg.join != 'i' or arg.position != '#%d' % SUBJECT
+                    or arg.leftPosition != SUBJECT
+                    or not isinstance(arg.op, jqlAST.Filter)
+                    or arg.op.complexPredicates
+                    or [a for a in arg.op.args if a.saveValue]):
+                return None
+            simplefilter, complexargs, probes = self._findSimplePredicates(
+                                                            arg.op, context)
+            semijoins.append( (arg, (arg.op, 
+                        self._getFilterConditions(simplefilter, probes))) )
+        return semijoins
+
+    def _evalJoinInModel(self, semijoins, context):
+        '''
+        If every filter returned by `_getSemijoinFilters` only has `Eq` and 
+        `In` predicates, have the model evaluate the join and return a list 
+        of `(joincond, tupleset)` pairs with the rows of each filter that 
+        are part of the join. Otherwise return None.
+        '''
+        for arg, (filterop, conditions) in semijoins:
+            simplefilter, complexargs, probes = self._findSimplePredicates(
+                                                        filterop, context)
+            if complexargs:
+                return None
+        tuplesets = context.initialModel.evaluateJoin(
+                [semijoin for arg, semijoin in semijoins], self, context)
+        if tuplesets is None:
+            return None
+        return zip([arg for arg, semijoin in semijoins], tuplesets)
 
     def evalFilter(self, op, context):
         '''
         Find slots
         '''
-        simplefilter, complexargs = self._findSimplePredicates(op, context)
+        simplefilter, complexargs, probes = self._findSimplePredicates(op, context)
 
         columns = []
         for label, pos in op.labels:
@@ -1420,15 +1726,62 @@ class SimpleQueryEngine(object):
 
         tupleset = context.currentTupleset        
         
+        if (context.subjectOrderHint and tupleset is context.initialModel
+                and tupleset.canStreamBySubject):
+            hints = { 'subjectorder' : True }
+        else:
+            hints = None
+
+        pushdown = None
+        source = tupleset
+        if context.joinedFilter is not None and tupleset is context.initialModel:
+            #the model already evaluated the join this filter is part of
+            pushdown = context.joinedFilter
+        elif (tupleset is context.initialModel and not saveValue
+                and getattr(tupleset, 'canEvaluateFilter', False)):
+            pushdown = tupleset.evaluateFilter(op, 
+                self._getFilterConditions(simplefilter, probes),
+                context.semijoinFilters, self, context, hints)
+
+        if pushdown is not None:
+            getRows = pushdown.filter
+            source = pushdown
+        elif probes is None:
+            getRows = lambda tupleset=tupleset: tupleset.filter(simplefilter, hints)
+        else:
+            if hints:
+                if probes and SUBJECT in probes[0]:
+                    #each probe returns one subject, so probing the subjects in 
+                    #order keeps the results in subject order
+                    probes.sort(key=lambda probe: 
+                                    getattr(probe[SUBJECT], 'uri', probe[SUBJECT]))
+                else:
+                    hints = None
+            def getRows(tupleset=tupleset):
+                #union the results of looking up each value, since each probe
+                #matches a different value they never return the same row
+                for probe in probes:
+                    conditions = simplefilter.copy()
+                    conditions.update(probe)
+                    for row in tupleset.filter(conditions, hints):
+                        yield row
+
         #first apply all the simple predicates that we assume are efficient
-        if simplefilter or not complexargs:
+        if (simplefilter or probes is not None or not complexargs or hints
+                or pushdown is not None):
             #XXX: optimization: if cost is better filter on initialmodel
             #and then find intersection of result and currentTupleset
-            tupleset = SimpleTupleset(
-                lambda tupleset=tupleset: tupleset.filter(simplefilter),
+            tupleset = SimpleTupleset(getRows,
                 columns = complexargs and tupleset.columns or columns,
                 colmap = not complexargs and colmap or None,
-                hint=tupleset, op='selectWithValue1', debug=context.debug)
+                hint=source, op='selectWithValue1', debug=context.debug)
+            if hints:
+                if complexargs:
+                    tupleset.orderedBy = SUBJECT
+                else:
+                    positions = [pos for label, pos in op.labels]
+                    if SUBJECT in positions:
+                        tupleset.orderedBy = positions.index(SUBJECT)
 
         if not complexargs:            
             return tupleset
@@ -1457,6 +1810,7 @@ class SimpleQueryEngine(object):
             #        arg.left.value = arg.left.evaluate(self, fcontext)
             
             alwaysmatch = saveValue and len(args) == 1
+            args = [(arg, self.compileOp(arg, fcontext)) for cost, i, arg in args]
 
             for row in tupleset:
                 value = None
@@ -1464,9 +1818,8 @@ class SimpleQueryEngine(object):
                     row = list(row)
                     row.append(value)
                 #print len(row), row
-                for cost, i, arg in args:
-                    fcontext.currentRow = row
-                    value = arg.evaluate(self, fcontext)
+                for arg, func in args:
+                    value = func(row)
                     if arg.saveValue:
                         row[-1] = value
                     elif not value:
@@ -1478,8 +1831,14 @@ class SimpleQueryEngine(object):
 
         opmsg = 'complexfilter:'+ str(complexargs)
         
-        return SimpleTupleset(filterRows, hint=tupleset,columns=columns,
+        result = SimpleTupleset(filterRows, hint=tupleset,columns=columns,
                 colmap=colmap, op=opmsg, debug=context.debug)
+        if hints and not saveValue:
+            #filtering doesn't change the order of the rows
+            positions = [pos for label, pos in op.labels]
+            if SUBJECT in positions:
+                result.orderedBy = positions.index(SUBJECT)
+        return result
 
     def buildObject(self, context, v, handleNil):
         if handleNil and v == NilResource:
@@ -1604,57 +1963,76 @@ class SimpleQueryEngine(object):
     def costLabel(self, op, context):
         return 1.0
 
-    def costFilter(self, op, context):
-        return 1.0 #XXX
+    #: selectivity assumed for predicates the statistics can't estimate
+    defaultSelectivity = 1/3.0
 
-        #simple cheaper than complex
-        #dependent cheaper then
-        #subject cheaper object cheaper than predicate
-        SIMPLECOST = [1, 4, 2]
-        #we have to evaluate each row
-        COMPLEXCOST = []
-        #we have to evaluate each row
-        DEPENDANTCOST = []
-
-        cost = 0 #no-op
-        for i, pred in enumerate(op.args):
-            if not pred:
-                continue
-            assert pred.getType() == BooleanType
-            assert pred.left
-            #XXX dont yet support something like: where customcompare(prop1, prop2)
-            assert pred.right is None, 'multi-prop compares not yet implemented'
-
-            if pred.left.isIndependent():
-                if isinstance(pred, jqlAST.Eq): #simple
-                    positioncost = SIMPLECOST
-                else:
-                    positioncost = COMPLEXCOST
-            else:
-                positioncost = DEPENDANTCOST
+    def _getStatistics(self, context):
+        getStatistics = getattr(context.initialModel, 'getStatistics', None)
+        return getStatistics and getStatistics() or None
 
-            cost += (pred.left.cost(self, context) * positioncost[i])
+    def _predicateSelectivity(self, pred, predicate, stats, context):
+        '''
+        Estimate the fraction of rows with the given `predicate` that 
+        satisfy a complex predicate on the object position.
+        '''
+        if predicate is None or not isinstance(pred, (jqlAST.Cmp, jqlAST.In)):
+            return self.defaultSelectivity
+        if isinstance(pred, jqlAST.In):
+            proj, others = pred.args[0], pred.args[1:]
+        else:
+            proj, others = pred.left, [pred.right]
+            if not isinstance(proj, jqlAST.Project):
+                proj, others = pred.right, [pred.left]
+        if not (isinstance(proj, jqlAST.Project) and proj.isPosition() 
+                and proj.name == OBJECT):
+            return self.defaultSelectivity
+        for other in others:
+            if not other.isIndependent():
+                return self.defaultSelectivity
+        values = [other.evaluate(self, context) for other in others]
+        if isinstance(pred, jqlAST.In):
+            test = lambda v: v in values
+        elif proj is pred.left:
+            test = lambda v: _compare(pred.op, v, values[0])
+        else:
+            test = lambda v: _compare(pred.op, values[0], v)
+        selectivity = stats.selectivity(predicate, test)
+        if selectivity is None:
+            return self.defaultSelectivity
+        return selectivity
 
+    def costFilter(self, op, context):
+        '''
+        Estimate the number of rows the filter will return using the 
+        cardinality statistics maintained by the model, if available.
+        '''
+        stats = self._getStatistics(context)
+        if stats is None:
+            return 1.0 #XXX
+
+        simplefilter, complexargs, probes = self._findSimplePredicates(op, context)
+        if probes is None:
+            probes = [{}]
+        cost = 0.0
+        for probe in probes:
+            conditions = simplefilter.copy()
+            conditions.update(probe)
+            cost += stats.estimate(conditions.get(SUBJECT), 
+                        conditions.get(PROPERTY), conditions.get(OBJECT), 
+                        conditions.get(OBJTYPE_POS))
+        for pred in complexargs:
+            cost *= self._predicateSelectivity(pred, 
+                                simplefilter.get(PROPERTY), stats, context)
         return cost
 
     def costJoin(self, op, context):
-        return 2.0 #XXX
-
-        args = list(flattenSeq(op.args))
-        #like costAndOp:
-        if args:                    
-            total = reduce(operator.add, [a.cost(self, context) for a in args], 0.0)
-            cost = total / len(args)
-        else:
-            cost = 1.0
-
-        if op.finalPosition == 1: #assume matching predicates are more expensive
-            cost += 5
-        if op.finalPosition == OBJTYPE_POS:
-            cost += 10
-        #if op.joinPosition < 0: #its absolute:
-        #    cost /= 10          #independent thus cheaper?
-        return cost 
+        if self._getStatistics(context) is None:
+            return 2.0 #XXX
+        #an inner join can't return more rows than its most selective argument
+        costs = [arg.op.cost(self, context) for arg in op.args if arg.join == 'i']
+        if not costs:
+            return 2.0
+        return min(costs)
 
     def evalConstant(self, op, context):
         return op.value
@@ -1701,14 +2079,7 @@ class SimpleQueryEngine(object):
             rvalue = op.right.evaluate(self, context)
         else:
             rvalue = context.currentValue
-        result = cmp(lvalue, rvalue)
-        if result == 0 and (op.op == '<=' or op.op == '>='):
-            return True
-        elif result < 0 and op.op[0] == '<':
-            return True
-        elif result > 0 and op.op[0] == '>':
-            return True        
-        return False
+        return _compare(op.op, lvalue, rvalue)
 
     def costCmp(self, op, context): #XXX
         assert len(op.args) == 2
@@ -1856,3 +2227,174 @@ class SimpleQueryEngine(object):
         return 1
         return reduce(operator.add, [a.cost(self, context) for a in op.args], 0.0)
 
+
+    ####################################################
+    ############ predicate compilation #################
+    ####################################################
+    def compileOp(self, op, context):
+        '''
+        Return a function that takes a row and returns the value `op` would 
+        evaluate to when that row is the context's current row. 
+        The function is built once so per-row evaluation avoids the AST 
+        dispatch. Ops that can't be compiled are evaluated through the AST.
+        '''
+        if isinstance(op, jqlAST.AnyFuncOp):
+            compile = self.compileAnyFuncOp
+        else:
+            compile = getattr(self, 'compile'+op._evalMethodName()[len('eval'):], None)
+        if compile is not None:
+            func = compile(op, context)
+            if func is not None:
+                return func
+
+        def evaluate(row):
+            context.currentRow = row
+            return op.evaluate(self, context)
+        return evaluate
+
+    def compileConstant(self, op, context):
+        value = op.value
+        return lambda row: value
+
+    def compileBindVar(self, op, context):
+        value = []
+        def bindvar(row):
+            #look up lazily so a missing bindvar only raises if it's needed
+            if not value:
+                value.append(self.evalBindVar(op, context))
+            return value[0]
+        return bindvar
+
+    def compileProject(self, op, context):
+        if context.projectValues or op.constructRefs:
+            return None
+        if isinstance(op.name, int):
+            pos = None
+            if op.name == SUBJECT and op.varref:
+                pos = context.currentTupleset.findColumnPos(op.varref)
+            if not pos:
+                pos = (op.name,)
+        else:
+            pos = context.currentTupleset.findColumnPos(op.name)
+            if not pos:
+                return None #evalProject will raise the error
+
+        if len(pos) == 1:
+            p = pos[0]
+            return lambda row: flatten(row[p])
+        else:
+            return lambda row: flatten( (c[0] for c in getColumn(pos, row)) )
+
+    def compileEq(self, op, context):
+        if not op.right:
+            return None #compares with context.currentValue
+        left = self.compileOp(op.left, context)
+        right = self.compileOp(op.right, context)
+        if not context.complexPredicateHack:
+            return lambda row: left(row) == right(row)
+
+        def eq(row):
+            lvalue = left(row)
+            rvalue = right(row)
+            #see evalEq
+            llist = isinstance(lvalue, (list,tuple))
+            rlist = isinstance(rvalue, (list,tuple))
+            if not llist and rlist:
+                return lvalue in rvalue
+            elif llist and not rlist:
+                return rvalue in lvalue
+            return lvalue == rvalue
+        return eq
+
+    def compileCmp(self, op, context):
+        if not op.right:
+            return None
+        left = self.compileOp(op.left, context)
+        right = self.compileOp(op.right, context)
+        cmpop = op.op
+        return lambda row: _compare(cmpop, left(row), right(row))
+
+    def compileNot(self, op, context):
+        arg = self.compileOp(op.args[0], context)
+        return lambda row: not arg(row)
+
+    def compileOr(self, op, context):
+        left = self.compileOp(op.args[0], context)
+        right = self.compileOp(op.args[1], context)
+        def or_(row):
+            lvalue = left(row)
+            if lvalue:
+                return lvalue
+            return right(row)
+        return or_
+
+    def compileAnd(self, op, context):
+        left = self.compileOp(op.args[0], context)
+        right = self.compileOp(op.args[1], context)
+        def and_(row):
+            #like evalAnd, both sides are always evaluated
+            lvalue = left(row)
+            rvalue = right(row)
+            if lvalue and rvalue:
+                return rvalue
+            else:
+                return False
+        return and_
+
+    def compileIn(self, op, context):
+        left = self.compileOp(op.args[0], context)
+        args = [self.compileOp(arg, context) for arg in op.args[1:]]
+        def in_(row):
+            #see evalIn
+            lvalue = left(row)
+            if not isinstance(lvalue, (list,tuple)):
+                llist = [lvalue]
+            else:
+                llist = list(lvalue)
+            for arg in args:
+                rvalue = arg(row)
+                for lvalue in llist:
+                    if isinstance(rvalue, Tupleset):
+                        for rrow in rvalue:
+                            if lvalue == rrow[0]:
+                                return True
+                        return False
+                    elif isinstance(rvalue, (list,tuple)):
+                        if lvalue in rvalue:
+                            return True
+                    elif rvalue == lvalue:
+                        return True
+            return False
+        return in_
+
+    def compileAnyFuncOp(self, op, context):
+        metadata = op.metadata
+        if metadata.isAggregate or metadata.lazy:
+            return None
+        args = list(enumerate([self.compileOp(arg, context) for arg in op.args]))
+        checknulls = metadata.checkForNulls
+        listHack = context.complexPredicateHack
+        needsContext = metadata.needsContext
+        def func(row):
+            #see evalAnyFuncOp
+            listvalues = []
+            values = []
+            for i, arg in args:
+                v = arg(row)
+                if checknulls > i and v is None:
+                    return None
+                if listHack and isinstance(v, (list,tuple)):
+                    listvalues.append( (i, v) )
+                values.append(v)
+            if needsContext:
+                context.currentRow = row
+            if len(listvalues) == 1:
+                index, listval = listvalues[0]
+                result = []
+                for v in listval:
+                    values[index] = v
+                    result.append( op.execFunc(context, *values))
+                return result
+            else:
+                return op.execFunc(context, *values)
+        return func
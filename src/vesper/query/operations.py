@@ -241,9 +241,15 @@ class IterationJoin(Join):
     Corresponds to an join of two tuplesets
     Can be a inner join or right outer join, depending on joinFunc
     '''
+
+    def _getRightTable(self):
+        '''
+        Returns the tupleset passed to joinFunc for each left row.
+        '''
+        return self.right
         
     def filter(self, conditions=None, hints=None):
-        for left, right in joinTuples(self.left, self.right, self.joinFunc):
+        for left, right in joinTuples(self.left, self._getRightTable(), self.joinFunc):
             row = left + right
             if conditions:
                 for key, value in conditions.iteritems():
@@ -255,47 +261,101 @@ class IterationJoin(Join):
             else:
                 yield row
 
-class MergeJoin(Join):
+class HashIndex(Tupleset):
+    '''
+    Wraps a tupleset with an in-memory hash table keyed on the given column.
+    The table is built on the first call to `filter`, so if it is never 
+    probed the underlying tupleset is never iterated.
+    '''
+
+    def __init__(self, tupleset, keypos=0):
+        self.tupleset = tupleset
+        self.keypos = keypos
+        self.columns = tupleset.columns
+        self.index = None
+
+    def filter(self, conditions=None, hints=None):
+        if not conditions:
+            return iter(self.tupleset)
+        assert len(conditions) == 1 and self.keypos in conditions, conditions
+        if self.index is None:
+            keypos = self.keypos
+            index = {}
+            for row in self.tupleset:
+                index.setdefault(row[keypos], []).append(row)
+            self.index = index
+        return iter(self.index.get(conditions[self.keypos], ()))
+
+class MergeCursor(Tupleset):
+    '''
+    Wraps a tupleset that is ordered by the given column and returns the 
+    matching rows for a sequence of (non-decreasing) key lookups in a single
+    pass through the tupleset.
+    '''
+
+    def __init__(self, tupleset, keypos=0):
+        self.tupleset = tupleset
+        self.keypos = keypos
+        self.columns = tupleset.columns
+        self.rows = None
+        self.nextRow = None
+        self.lastKey = None
+        self.matches = ()
+
+    def _advance(self):
+        try:
+            return self.rows.next()
+        except StopIteration:
+            return None
+
+    def filter(self, conditions=None, hints=None):
+        assert len(conditions) == 1 and self.keypos in conditions, conditions
+        key = conditions[self.keypos]
+        keypos = self.keypos
+        if self.rows is None:
+            self.rows = iter(self.tupleset)
+            self.nextRow = self._advance()
+        elif key == self.lastKey:
+            return iter(self.matches)
+        assert self.lastKey is None or not key < self.lastKey, (
+                            'merge join keys out of order: %r' % key)
+        self.lastKey = key
+        matches = []
+        row = self.nextRow
+        while row is not None and row[keypos] < key:
+            row = self._advance()
+        while row is not None and row[keypos] == key:
+            matches.append(row)
+            row = self._advance()
+        self.nextRow = row
+        self.matches = matches
+        return iter(matches)
+
+class HashJoin(IterationJoin):
+    '''
+    Build a hash table on the join key of the right tupleset (its first column)
+    and probe it with each row of the left tupleset. The table is built once
+    and reused each time the join is iterated.
+    '''
+    index = None
+
+    def _getRightTable(self):
+        if self.index is None:
+            self.index = HashIndex(self.right, 0)
+        return self.index
+
+    def getJoinType(self):
+        return 'hash join'
+
+class MergeJoin(IterationJoin):
     '''
     Assuming the left and right tables are ordered by the columns 
     used by the join condition, do synchronized walk through of each table.
+    The right table is joined on its first column.
     '''
-        
-    def __init__(self, left, right, lpos, rpos, msg=''):
-        self.left = left
-        self.right = right
-        self.leftJoinSlice = lpos
-        self.rightJoinSlice = rpos
-        self.msg = msg
-        
-    def _filter(self, conditions=None):
-        li = iter(self.left)
-        ri = iter(self.right)
-        lpos = self.leftJoinSlice 
-        rpos=self.rightJoinSlice
-        
-        l = li.next(); r = ri.next()
-        while 1:        
-            while l[lpos] < r[rpos]:
-                l = li.next() 
-            while r[rpos] < l[lpos]:
-                r = ri.next()        
-            if l[lpos] == r[rpos]:
-                #inner join 
-                if conditions:
-                    row = l + r
-                    for key, value in conditions.iteritems():
-                        if row[key] != value:
-                            break
-                    else:
-                        yield l, r
-                else:
-                    yield l, r
-                l = li.next();
-    
-    def filter(self, conditions=None, hints=None):
-        for left, right in self._filter(conditions):
-            yield left+right
+
+    def _getRightTable(self):
+        return MergeCursor(self.right, 0)
 
     def getJoinType(self):
         return 'ordered merge'
@@ -300,6 +300,57 @@ def patchList(base, patch):
         elif op[0] == 'i':
             base[op[1]:op[1]] = op[2]    
 
+def _isiterator(obj):
+    return (not isinstance(obj, (dict, list, tuple, basestring)) 
+                        and hasattr(obj, 'next') and hasattr(obj, '__iter__'))
+
+def _containsIterator(obj):
+    if isinstance(obj, dict):
+        obj = obj.itervalues()
+    elif not isinstance(obj, (list, tuple)):
+        return _isiterator(obj)
+    for item in obj:
+        if _containsIterator(item):
+            return True
+    return False
+
+def iterjson(obj, encoder=None):
+    '''
+    Serialize `obj` to JSON like `json.dumps` but return an iterator that
+    yields the JSON in chunks. Iterators (e.g. generators) found in `obj` are 
+    serialized as JSON arrays, one item at a time, so they are only consumed 
+    as the output is read.
+    
+    >>> ''.join(iterjson({'results' : (i for i in range(3)), 'errors' : []}))
+    '{"errors": [], "results": [0, 1, 2]}'
+    '''
+    if encoder is None:
+        from vesper.backports import json
+        encoder = json.JSONEncoder(sort_keys=True)
+    if not _containsIterator(obj):
+        yield encoder.encode(obj)
+    elif isinstance(obj, dict):
+        sep = '{'
+        items = obj.items()
+        if encoder.sort_keys:
+            items.sort()
+        for key, value in items:
+            yield sep + encoder.encode(key) + ': '
+            for chunk in iterjson(value, encoder):
+                yield chunk
+            sep = ', '
+        yield '}'
+    else:
+        sep = '['
+        for item in obj:
+            yield sep
+            for chunk in iterjson(item, encoder):
+                yield chunk
+            sep = ', '
+        if sep == '[': #empty
+            yield sep
+        yield ']'
+
 def removeDupsFromSortedList(aList):       
     def removeDups(x, y):
         if not x or x[-1] != y:
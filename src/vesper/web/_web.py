@@ -187,6 +187,9 @@ class HTTPRequestProcessor(RequestProcessor):
                 return environ['wsgi.file_wrapper'](response, block_size)
             else:
                 return iter(lambda: response.read(block_size), '')
+        elif hasattr(response, 'next'):
+            #an iterator (e.g. streaming json) so let the server send each chunk
+            return response
         else:
             return [response]
 
@@ -28,16 +28,61 @@ vesper.utils.defaultattrdict.UNDEFINED = mako.runtime.UNDEFINED
 import vesper.query
 vesper.query.QueryContext.defaultShapes = { dict : vesper.utils.defaultattrdict }
 
+def _streamResponses(responses):
+    '''
+    Serialize a batch of JSON-RPC responses as an iterator of JSON chunks, 
+    serializing the results of streamed queries one result object at a time.
+    If a result object can't be serialized the results end there and the 
+    error is added to the "errors" member of the response's result.
+    '''
+    sep = '['
+    for response in responses:
+        yield sep
+        sep = ', '
+        result = response.get('result')
+        if not hasattr(result, 'get') or not hasattr(
+                                        result.get('results'), 'next'):
+            yield json.dumps(response)
+            continue
+        errors = list(result['errors'])
+        yield '{"id": %s, "jsonrpc": "2.0", "result": {' % json.dumps(
+                                                                response['id'])
+        items = [(k, v) for (k, v) in result.items() 
+                                        if k not in ('errors', 'results')]
+        items.sort()
+        for key, value in items:
+            yield '%s: %s, ' % (json.dumps(key), json.dumps(value))
+        yield '"results": ['
+        resultsep = ''
+        for obj in result['results']:
+            try:
+                chunk = json.dumps(obj)
+            except Exception, e:
+                errors.append('error: result could not be serialized: %s' % e)
+                break
+            yield resultsep + chunk
+            resultsep = ', '
+        yield '], "errors": %s}}' % json.dumps(errors)
+    yield ']'
+
 @Route('datarequest', conditions=dict(method=["POST"]))
 @Route('{store:.*}/datarequest', conditions=dict(method=["POST"]))
 def datarequest(kw, retval):
     '''
     Accepts a JSON-RPC 2.0 (see http://groups.google.com/group/json-rpc/web/json-rpc-2-0)
     request (including a batch request).
+    
+    If a "query" request's params include ``"stream" : true`` the response 
+    is returned as an iterator that serializes the query results one at a 
+    time as they are sent. The results are still constructed inside the 
+    request's transaction, so the store isn't locked while the response is 
+    being sent. If a result can't be serialized the results end there and 
+    the error is reported in the "errors" member of the query's result.
     '''
     from vesper import pjson
 
     newresourcesCreated = {}
+    streaming = []
     
     def handleRequest(id=None, method=0, params=0, jsonrpc=None):
         requestid = id; action = method; data = params
@@ -71,7 +116,14 @@ def datarequest(kw, retval):
                 result = dataStore.query(data, captureErrors=True) 
             else:
                 data['captureErrors'] = True
+                #construct the results now, while the request's transaction 
+                #is active; only their serialization is streamed
+                stream = data.pop('stream', False)
                 result = dataStore.query(**data)
+                if stream and not result.errors:
+                    streaming.append(requestid)
+                    #copy since the result may be cached
+                    result = attrdict(result, results=iter(result['results']))
             if result.errors:
                 response['error'] = dict(code=0, message='query failed', 
                                                     data = result.errors)
@@ -120,6 +172,8 @@ def datarequest(kw, retval):
                             error=dict(code=-32600, message='Invalid Request'))
                                                                 for x in requests]
             log.debug('request: \n  %r\n response:\n   %r', requests, response)
+    if streaming:
+        return _streamResponses(response)
     return json.dumps(response, indent=4) 
 
 @Route('static/{file:.+}')
@@ -8,6 +8,7 @@ import subprocess, tempfile, os, signal, sys
 import string, random, shutil, time
 
 import modelTest 
+from vesper.data.base import Statement, OBJECT_TYPE_RESOURCE
 from vesper.data.store.bdb import BdbStore, TransactionBdbStore
 
 class BdbModelTestCase(modelTest.BasicModelTestCase):
@@ -22,6 +23,69 @@ class BdbModelTestCase(modelTest.BasicModelTestCase):
         model = TransactionBdbStore(self.tmpfilename)
         return self._getModel(model)
 
+    def testBuildMissingIndexes(self):
+        stmts = [Statement('s', 'p', 'o', OBJECT_TYPE_RESOURCE, 'c'),
+            Statement('s1', 'p', 'o', OBJECT_TYPE_RESOURCE, 'c1'),
+            Statement('s1', 'p1', 'o1', 'en', 'c')]
+        model = BdbStore(self.tmpfilename)
+        model.addStatements(stmts)
+        model.close()
+        #simulate a database created before the object and context indexes
+        os.remove(os.path.join(self.tmpfilename, 'obj_db'))
+        os.remove(os.path.join(self.tmpfilename, 'context_db'))
+
+        model = BdbStore(self.tmpfilename)
+        r = model.getStatements(object='o', objecttype=OBJECT_TYPE_RESOURCE)
+        self.assertEqual(r, stmts[:2])
+        r = model.getStatements(context='c')
+        self.assertEqual(r, [stmts[0], stmts[2]])
+        model.close()
+
+    def testScanInChunks(self):
+        "test lookups that are streamed in chunks"
+        model = BdbStore(self.tmpfilename)
+        model.scanSize = 2
+        stmts = [Statement('s%d' % (x % 3), 'p%d' % x, 'o', 'L', 'c%d' % (x % 2))
+                                                        for x in range(10)]
+        model.addStatements(stmts)
+        stmts.sort()
+        self.assertEqual(list(model.iterStatements()), stmts)
+        self.assertEqual(list(model.iterStatements(subject='s1')), 
+                                [s for s in stmts if s.subject == 's1'])
+        self.assertEqual(list(model.iterStatements(context='c1')), 
+                                [s for s in stmts if s.scope == 'c1'])
+        #changes made after the current chunk are seen
+        r = model.iterStatements()
+        self.assertEqual([r.next() for x in range(4)], stmts[:4])
+        #removing the last statement read means the scan has to continue 
+        #from the next key
+        model.removeStatements(stmts[3:6] + [stmts[-1]])
+        self.assertEqual(list(r), stmts[6:-1])
+        #abandon a scan part way and write
+        r = model.iterStatements(subject=stmts[4].subject)
+        r.next()
+        del r
+        model.addStatement(stmts[4])
+        self.assertEqual(model.getStatements(subject=stmts[4].subject), 
+                    [s for s in stmts[:-1] if s.subject == stmts[4].subject 
+                                                    and s != stmts[5]])
+        model.close()
+
+    def testWritesAreAtomic(self):
+        "test a call that fails doesn't write any of its statements"
+        model = BdbStore(self.tmpfilename)
+        stmts = [Statement('s', 'p', 'o%d' % x, 'L') for x in range(5)]
+        #\0 can't be saved
+        bad = Statement('s', 'p', 'bad\0', 'L')
+        self.assertRaises(RuntimeError, model.addStatements, stmts + [bad])
+        self.assertEqual(model.getStatements(), [])
+        model.addStatements(stmts)
+        self.assertRaises(RuntimeError, model.removeStatements, 
+                                                    stmts[:2] + [bad])
+        self.assertEqual(model.getStatements(), stmts)
+        self.assertEqual(model.getStatistics().estimate(), 5)
+        model.close()
+
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp(prefix="rhizometest")
         self.tmpfilename = os.path.join(self.tmpdir, 'test.bdb') 
@@ -6,10 +6,12 @@
 import unittest
 import subprocess, tempfile, os, sys, traceback
 import string, random, shutil, time
+from vesper.backports import json
 
 import modelTest 
 from vesper.data.base import Statement
 from vesper.data.store.basic import FileStore, TransactionFileStore, IncrementalNTriplesFileStore, IncrementalNTriplesFileStoreBase
+from vesper.data.store.basic import LogFileStore, TransactionLogFileStore
 
 class FileModelTestCase(modelTest.BasicModelTestCase):
     
@@ -238,5 +240,126 @@ class TransactionIncrementalFileModelTestCase(IncrementalFileModelTestCase):
         model = IncrementalNTriplesFileStore(self.tmpfilename)
         return model#self._getModel(model)
 
+class LogFileModelTestCase(FileModelTestCase):
+
+    storeClass = LogFileStore
+    
+    def getModel(self):
+        #compact on every commit to exercise it
+        model = LogFileStore(self.tmpfilename, minCompactionSize=0,
+                                        backgroundCompaction=False)
+        return model
+
+    def getTransactionModel(self):
+        model = self.storeClass(self.tmpfilename, minCompactionSize=0,
+                                        backgroundCompaction=False)
+        return model
+
+    def testCommitFailure(self):
+        model = self.getTransactionModel()
+        statements = [Statement("one", "equals", " one ")]
+        model.addStatements(statements)
+        model.commit() #writes the snapshot
+        snapshot = open(model.path).read()
+
+        more = [Statement('s', 'p1', 'o2', 'en-1', 'c1')]
+        model.addStatements(more)
+        #make compaction explode, the commit is in the log so it still succeeds
+        model.serializeOptions = dict(badOption=1)
+        model.commit()
+        self.assertEqual(snapshot, open(model.path).read())
+        self.assertTrue(os.path.getsize(model.logPath))
+
+        modelC = self.getTransactionModel()
+        self.assertEqual(set(statements+more), set(modelC.getStatements()))
+
+    def testCompaction(self):
+        model = self.storeClass(self.tmpfilename, compactionRatio=2)
+        stmts = [Statement('s%d' % i, 'p', 'o', 'L', 'c%d' % (i % 2)) 
+                                                    for i in range(10)]
+        model.addStatements(stmts)
+        model.commit()
+        snapshot = open(model.path).read()        
+        self.assertFalse(os.path.exists(model.logPath))
+        
+        model.removeStatement(stmts[0])
+        model.addStatement(Statement('_:b1', 'p', '_:b2', 'R'))
+        model.commit()
+        self.assertEqual(snapshot, open(model.path).read())
+        self.assertTrue(os.path.getsize(model.logPath))
+        expected = set(model.getStatements())
+        self.assertEqual(9+1, len(expected))
+        
+        #snapshot plus tail
+        self.assertEqual(expected, set(self.storeClass(self.tmpfilename).getStatements()))
+        
+        #a partially written transaction is ignored
+        logsize = os.path.getsize(model.logPath)
+        f = open(model.logPath, 'a')
+        f.write('#begin\n<s1> <p> "o" .\n')
+        f.close()
+        model = self.storeClass(self.tmpfilename, compactionRatio=0.1,
+                                                    minCompactionSize=0)
+        self.assertEqual(expected, set(model.getStatements()))
+        self.assertEqual(logsize, os.path.getsize(model.logPath))
+
+        model.addStatement(Statement('s10', 'p', 'o'))
+        expected.add(Statement('s10', 'p', 'o'))
+        model.commit()
+        model.waitForCompaction()
+        self.assertEqual(0, os.path.getsize(model.logPath))
+        self.assertNotEqual(snapshot, open(model.path).read())
+        self.assertEqual(expected, set(self.storeClass(self.tmpfilename).getStatements()))
+
+class TransactionLogFileModelTestCase(LogFileModelTestCase):
+
+    storeClass = TransactionLogFileStore
+
+class ParallelParseTestCase(unittest.TestCase):
+
+    def testNTriples(self):
+        from vesper.data.base import parseRDFFromString, parseRDFInParallel
+        lines = ['#!graph c%d\n<s%d> <p> "o %d" .\n<s%d> <p> _:b%d .' 
+                                % (i % 3, i, i, i, i % 5) for i in range(200)]
+        contents = '\n'.join(lines) + '\n'
+        expected = set(parseRDFFromString(contents, 'test:', 'ntriples'))
+        stmts = parseRDFInParallel(contents, 'test:', 'ntriples', 
+                                            processes=3, chunkSize=100)
+        self.assertEqual(expected, set(stmts))
+        self.assertEqual(None, parseRDFInParallel('#!remove\n'+contents, 
+                                                    'test:', 'ntriples'))
+        #a blank line ends the statements
+        stmts = parseRDFInParallel(lines[0] + '\n\n' + lines[1], 'test:',
+                                            'ntriples', processes=2)
+        self.assertEqual(2, len(stmts))
+
+    def testPjson(self):
+        from vesper.data.base import parseRDFFromString, parseRDFInParallel
+        from vesper.data.base import isBnode
+        objs = [{'id' : 'o%d' % i, 'list' : [1, 2, i], 'child' : {'n' : i}, 
+                                    'ref' : '@o%d' % (i // 2)} for i in range(50)]
+        contents = json.dumps({'pjson' : '0.9', 'data' : objs, 
+                                'namemap' : {'refpattern' : '@(URIREF)'}})
+        expected = parseRDFFromString(contents, 'test:', 'pjson')
+        stmts = parseRDFInParallel(contents, 'test:', 'pjson', processes=3)
+        self.assertEqual(len(expected), len(stmts))
+        #generated bnodes differ but must be unique across the chunks
+        unnamed = lambda stmts: set([tuple([isBnode(v) and 'b' or v for v in s])
+                                                            for s in stmts])
+        self.assertEqual(unnamed(expected), unnamed(stmts))
+        children = set([s[2] for s in stmts if s[1] == 'child'])
+        self.assertEqual(50, len(children))
+        
+        tmpdir = tempfile.mkdtemp(prefix="vespertest")
+        try:
+            path = os.path.join(tmpdir, 'test.json')
+            f = open(path, 'w')
+            f.write(contents)
+            f.close()
+            model = FileStore(path, parallelParse=True)
+            self.assertEqual(unnamed(expected), unnamed(model.getStatements()))
+        finally:
+            shutil.rmtree(tmpdir)
+
 if __name__ == '__main__':
     modelTest.main(FileModelTestCase)
@@ -0,0 +1,82 @@
+#:copyright: Copyright 2009-2011 by the Vesper team, see AUTHORS.
+#:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
+"""
+    Sharded model unit tests
+"""
+import unittest
+import tempfile, os, shutil
+
+import modelTest 
+from vesper.data.base import Statement
+from vesper.data.store.basic import MemStore, FileStore, TransactionMemStore
+from vesper.data.store.sharded import ShardedModel
+
+class ShardedModelTestCase(modelTest.BasicModelTestCase):
+    
+    def getModel(self):
+        model = ShardedModel(self.tmpfilename, shards=3)
+        return self._getModel(model)
+
+    def getTransactionModel(self):
+        model = ShardedModel(shards=3, shard_factory=TransactionMemStore)
+        self.persistentStore = False
+        return self._getModel(model)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="vespertest")
+        self.tmpfilename = os.path.join(self.tmpdir, 'test.json') 
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testSharding(self):
+        stmts = [Statement('s%d' % i, 'p%d' % (i % 3), 'o%d' % (i % 5))
+                                                        for i in range(30)]
+        model = ShardedModel(shards=4, defaultStatements=stmts)
+        memstore = MemStore(stmts)
+        self.assertEqual(memstore.getStatements(), model.getStatements())
+        for kw in [dict(subject='s1'), dict(predicate='p2'), 
+                dict(object='o3'), dict(predicate='p1', object='o2'),
+                dict(object='o0', hints=dict(limit=2, offset=1))]:
+            self.assertEqual(memstore.getStatements(**kw), 
+                            model.getStatements(**kw), kw)
+        #each subject is in one shard
+        for stmt in stmts:
+            self.assertEqual(model.getShard(stmt[0]).getStatements(stmt[0]),
+                                                                    [stmt])
+        self.assert_(min([len(s.getStatements()) for s in model.stores]) > 0)
+        self.assertEqual(model.getStatistics().estimate(predicate='p1'), 10)
+
+    def testClose(self):
+        stmts = [Statement('s%d' % i, 'p', 'o') for i in range(10)]
+        model = ShardedModel(shards=3, defaultStatements=stmts)
+        threads = model.threadPool.threads
+        self.assertEqual(len(threads), 3)
+        self.assertEqual(len(model.getStatements(predicate='p')), 10)
+        model.close()
+        #the pool's threads have exited
+        self.assertEqual([t for t in threads if t.isAlive()], [])
+        self.assert_(model.threadPool is None)
+
+    def testCommitFailure(self):
+        class FailingStore(MemStore):
+            def commit(self, **kw):
+                raise RuntimeError('commit failed')
+        shards = []
+        def factory(**kw):
+            #the last shard fails to commit
+            if len(shards) == 2:
+                store = FailingStore(**kw)
+            else:
+                store = MemStore(**kw)
+            shards.append(store)
+            return store
+        model = ShardedModel(shards=3, shard_factory=factory, threads=0)
+        stmts = [Statement('s%d' % i, 'p', 'o') for i in range(20)]
+        model.addStatements(stmts)
+        self.assertRaises(RuntimeError, model.commit)
+        #the shards that committed have had their changes undone
+        self.assertEqual(model.getStatements(), [])
+
+if __name__ == '__main__':
+    modelTest.main(ShardedModelTestCase)
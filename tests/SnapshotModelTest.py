@@ -0,0 +1,73 @@
+#:copyright: Copyright 2009-2011 by the Vesper team, see AUTHORS.
+#:license: Dual licenced under the GPL or Apache2 licences, see LICENSE.
+"""
+    Snapshot model unit tests
+"""
+import unittest
+import tempfile, os, shutil
+
+import modelTest 
+from vesper.data.base import Statement, OBJECT_TYPE_RESOURCE
+from vesper.data.store.basic import MemStore
+from vesper.data.store.snapshot import SnapshotStore, writeSnapshot
+
+class SnapshotModelTestCase(modelTest.BasicModelTestCase):
+    
+    def getModel(self):
+        model = SnapshotStore(self.tmpfilename)
+        return self._getModel(model)
+
+    def getTransactionModel(self):
+        return self.getModel()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="vespertest")
+        self.tmpfilename = os.path.join(self.tmpdir, 'test.snapshot') 
+        
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def testWriteSnapshot(self):
+        stmts = [Statement('s%d' % (i % 7), 'p%d' % (i % 3), 
+                    u'\xe9 %d' % (i % 5), (i % 4) and 'L' or OBJECT_TYPE_RESOURCE,
+                    'c%d' % (i % 2)) for i in range(50)]
+        memstore = MemStore(stmts)
+        writeSnapshot(memstore, self.tmpfilename)
+        model = SnapshotStore(self.tmpfilename)
+        self.assertEqual(memstore.getStatements(), model.getStatements())
+        for kw in [dict(subject='s1'), dict(predicate='p2'), 
+                dict(object=u'\xe9 3'), dict(context='c1'),
+                dict(predicate='p1', object=u'\xe9 2', objecttype='L'),
+                dict(subject='s3', context='c0', asQuad=False),
+                dict(object=u'\xe9 0', hints=dict(limit=2, offset=1)),
+                dict(subject='missing')]:
+            self.assertEqual(memstore.getStatements(**kw), 
+                            model.getStatements(**kw), kw)
+        
+        #uncommitted changes are merged with the snapshot
+        model.removeStatement(stmts[1])
+        model.addStatement(Statement('s1', 'p0', 'new'))
+        memstore.removeStatement(stmts[1])
+        memstore.addStatement(Statement('s1', 'p0', 'new'))
+        self.assertEqual(memstore.getStatements(subject='s1'), 
+                            model.getStatements(subject='s1'))
+        model.commit()
+        model = SnapshotStore(self.tmpfilename)
+        self.assertEqual(memstore.getStatements(), model.getStatements())
+
+    def testStringCacheIsBounded(self):
+        stmts = [Statement('s%d' % i, 'p%d' % (i % 3), 'o%d' % i) 
+                                                        for i in range(100)]
+        writeSnapshot(stmts, self.tmpfilename)
+        model = SnapshotStore(self.tmpfilename)
+        model.stringCacheSize = 20
+        cached = len(model._strings)
+        #a scan of every statement doesn't cache the strings
+        self.assertEqual(model.getStatements(), sorted(stmts))
+        self.assertEqual(len(model._strings), cached)
+        for stmt in stmts:
+            self.assertEqual(model.getStatements(subject=stmt[0]), [stmt])
+            self.failUnless(len(model._strings) <= 20)
+
+if __name__ == '__main__':
+    modelTest.main(SnapshotModelTestCase)
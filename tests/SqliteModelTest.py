@@ -13,7 +13,7 @@ from vesper.data.store.sqlite import SqliteStore, TransactionSqliteStore
 class SqliteModelTestCase(modelTest.BasicModelTestCase):
     
     def getModel(self):
-        model = SqliteStore(None)
+        model = SqliteStore(self.tmpfilename)
         return self._getModel(model)
 
     def getTransactionModel(self):
@@ -28,5 +28,47 @@ class SqliteModelTestCase(modelTest.BasicModelTestCase):
         #print 'tear down removing', self.tmpdir
         shutil.rmtree(self.tmpdir)
 
+    def testFilterPushdown(self):
+        from vesper import app
+        data = [{'id': 'a', 'type': 'post', 'rating': 5, 'tag': 'x'},
+            {'id': 'b', 'type': 'post', 'rating': 2.5, 'tag': 'y'},
+            {'id': 'c', 'type': 'post', 'rating': 'high', 'tag': 'x'},
+            {'id': 'd', 'type': 'comment', 'rating': 10, 'parent': '@a'},
+            {'id': 'e', 'type': 'comment', 'rating': -1, 'parent': '@b'},
+            {'id': 'f', 'type': 'comment', 'parent': '@a'}]
+        queries = [
+            "{ id where (type = 'post') }",
+            "{ id where (type = 'post' and tag = 'x') }",
+            "{ id where (tag in ('y', 'z')) }",
+            "{ id where (rating > 2) }",
+            "{ id where (2 >= rating) }",
+            "{ id where (rating < 'z' and type = 'post') }",
+            "{ id where (type in ('comment', 'post') and rating <= 5) }",
+            "{ id where (parent = @a and rating > 0) }",
+            "{ id, rating where (type = 'comment') }",
+            "{ id where (type = 'post' and rating > 100) }",
+            "{ id where (type = 'post' and tag in ('x', 'y') and rating = 5) }",
+            "{ id where (type in ('post', 'comment') and parent = @b) }",
+            ]
+        memstore = app.createStore(data)
+        sqlstore = app.createStore(data, 
+                                storage_url='sqlite://' + self.tmpfilename)
+        for query in queries:
+            expected = memstore.query(query)
+            results = sqlstore.query(query)
+            key = lambda obj: obj['id']
+            self.assertEquals(sorted(expected, key=key), 
+                sorted(results, key=key), query)
+
+        #a join of Eq and In filters is evaluated with one query
+        explain = sqlstore.query("{ id where (type = 'post' and tag = 'x') }",
+                                                            explain=True)
+        self.assert_('sqlite join' in str(explain), explain)
+        self.assert_('EXISTS' not in str(explain), explain)
+        #otherwise each filter is narrowed down by the others
+        explain = sqlstore.query("{ id where (type = 'post' and rating > 2) }",
+                                                            explain=True)
+        self.assert_('EXISTS' in str(explain), explain)
+
 if __name__ == '__main__':
     modelTest.main(SqliteModelTestCase)
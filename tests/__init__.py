@@ -4,7 +4,15 @@ import sys, unittest, docTest
 
 __all__ = ['glockTest', 'appTest', 'MRUCacheTest', 
  'transactionsTest', 'utilsTest', 'RDFDomTest', 'htmlfilterTest',
-  'pjsonTest', 'jqlTest', 'jsonqlDocTest', 'jsonqlTutorialTest', 'modelTest', 'FileModelTest']
+  'pjsonTest', 'jqlTest', 'jsonqlDocTest', 'jsonqlTutorialTest', 'modelTest', 'FileModelTest', 'SnapshotModelTest',
+  'ShardedModelTest']
+
+try:
+    import vesper.data.store.sqlite
+except ImportError:
+    print "skipping Sqlite tests"
+else:
+    __all__.append('SqliteModelTest')
 
 if sys.version_info[:2] >= (2,5):
     __all__.append('python25Test')
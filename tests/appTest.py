@@ -253,6 +253,166 @@ class AppTestCase(unittest.TestCase):
             }])            
         self.assertEquals(store.query('{*}'), [{'id': '@hello', 'tags': ['@tag1']}])
 
+    def testPreparedQuery(self):
+        store = vesper.app.createStore([
+          {"id": "a", "prop": 1},
+          {"id": "b", "prop": 2}
+        ])
+        prepared = store.prepare('{* where (prop = :v)}')
+        self.assertEquals(prepared.execute(dict(v=1)), [{'id': '@a', 'prop': 1}])
+        self.assertEquals(prepared.execute(dict(v=2)), [{'id': '@b', 'prop': 2}])
+        self.assertEquals(prepared.execute(dict(v=3)), [])
+        
+        #the serializer is reused until the serialization options change
+        serializer = prepared.getSerializer()
+        self.failUnless(prepared.getSerializer() is serializer)
+        store.model_options['serializeOptions'] = dict(pjson=dict(serializeIdAsRefs=False))
+        self.failIf(prepared.getSerializer() is serializer)
+        self.assertEquals(prepared.execute(dict(v=1)), [{'id': 'a', 'prop': 1}])
+
+        #changing the schema prepares the query again
+        from vesper.data.base.schema import RDFSSchema
+        serializer = prepared.getSerializer()
+        ast = prepared.ast
+        store.schema = RDFSSchema(store.model)
+        store.model = store.schema
+        self.failIf(prepared.getSerializer() is serializer)
+        self.failIf(prepared.ast is ast)
+        self.assertEquals(prepared.execute(dict(v=2)), [{'id': 'b', 'prop': 2}])
+        serializer = prepared.getSerializer()
+        self.failUnless(prepared.getSerializer() is serializer)
+        
+        from vesper.query import QueryException
+        self.assertRaises(QueryException, store.prepare, '{* where (}')
+
+    def testBulkLoad(self):
+        import tempfile, shutil
+        from vesper.backports import json
+        from vesper.data.DataStore import DataStoreError
+        store = vesper.app.createStore([{"id": "a", "prop": 1}], 
+                                                        save_history=True)
+        data = [{"id": "o%d" % i, "prop": i, "child" : {"n" : i}} 
+                                                        for i in range(25)]
+        data.append(base.Statement('s', 'p', 'o'))
+        self.assertEquals(store.bulkLoad(data, batchSize=10), 76)
+        #one revision for the whole load
+        other = vesper.app.createStore([{"id": "a", "prop": 1}], 
+                                                        save_history=True)
+        other.add(data[:1])
+        self.assertEquals(store.getRevision(), other.getRevision())
+        self.assertEquals(store.query("{ child where (id = @o7) }"), 
+                                                    [{'child': {'n': 7}}])
+        self.assertEquals(len(store.query("{ id where (prop > 3) }")), 21)
+
+        #queries run earlier in the same transaction see the loaded data
+        store = vesper.app.createStore([{"id": "a", "prop": 1}])
+        def loadInTxn():
+            before = store.query("{ id where (prop > 3) }")
+            store.bulkLoad(data, batchSize=10)
+            return before, store.query("{ id where (prop > 3) }")
+        before, after = store.requestProcessor.executeTransaction(loadInTxn)
+        self.assertEquals((len(before), len(after)), (0, 21))
+
+        tmpdir = tempfile.mkdtemp(prefix="vespertest")
+        try:
+            path = os.path.join(tmpdir, 'data.json')
+            f = open(path, 'w')
+            f.write(json.dumps(data[:-1]))
+            f.close()
+            store = vesper.app.createStore(
+                storage_url='sqlite://' + os.path.join(tmpdir, 'test.sqlite'))
+            self.assertEquals(store.bulkLoad(path), 75)
+            self.assertEquals(len(store.query("{ id where (prop > 3) }")), 21)
+            self.assertRaises(DataStoreError, store.bulkLoad, path + 'x')
+
+            #a pjson header applies to the objects in its data
+            path = os.path.join(tmpdir, 'header.json')
+            f = open(path, 'w')
+            f.write(json.dumps({"pjson" : "0.9", "namemap" : {"refs" : 
+                "@(URIREF)"}, "data" : [{"id" : "h%d" % i, "ref" : "@o%d" % i}
+                                                        for i in range(15)]}))
+            f.close()
+            store = vesper.app.createStore()
+            self.assertEquals(store.bulkLoad(path, batchSize=10), 15)
+            self.assertEquals(store.query("{ ref where (id = @h3) }"), 
+                                                    [{'ref': '@o3'}])
+
+            #NTriples are streamed from the file
+            path = os.path.join(tmpdir, 'data.nt')
+            f = open(path, 'w')
+            for i in range(25):
+                f.write('<s%d> <prop> "%d" .\n' % (i, i))
+            f.close()
+            store = vesper.app.createStore()
+            self.assertEquals(store.bulkLoad(path, batchSize=10), 25)
+            self.assertEquals(len(store.model.getStatements(predicate='prop')), 25)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        #the added statements aren't recorded for actions
+        store = vesper.app.createStore(actions={'after-commit' : [lambda kw, retVal: retVal]})
+        self.assertRaises(DataStoreError, store.bulkLoad, data)
+        self.assertEquals(store.query("{ id where (prop > 3) }"), [])
+
+    def testQueryResultCache(self):
+        from vesper.query import resultCache
+        resultCache.clear()
+        store = vesper.app.createStore([
+          {"id": "a", "prop": 1, "other" : "x"},
+          {"id": "b", "prop": 2}
+        ], query_result_cache=True)
+        query = '{ id, prop where (prop > :v)}'
+        self.assertEquals(store.query(query, dict(v=0)), 
+                    [{'id': '@a', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        self.assertEquals(resultCache.misses, 1)
+        results = store.query(query, dict(v=0))
+        self.assertEquals(resultCache.hits, 1)
+        self.assertEquals(results, 
+                    [{'id': '@a', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        results[0]['prop'] = 3 #modifying results doesn't modify the cache
+        self.assertEquals(store.query(query, dict(v=0)), 
+                    [{'id': '@a', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        self.assertEquals(store.query(query, dict(v=1)), 
+                    [{'id': '@b', 'prop': 2}])
+        self.assertEquals(resultCache.misses, 2)
+        self.assertEquals(store.query('{*}'), 
+          [{'id': '@a', 'other': 'x', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        
+        #only the queries that depend on "other" are invalidated
+        store.update({"id": "a", "other" : "y"})
+        self.assertEquals(store.query(query, dict(v=1)), 
+                    [{'id': '@b', 'prop': 2}])
+        self.assertEquals(resultCache.misses, 3)
+        self.assertEquals(store.query('{*}'), 
+          [{'id': '@a', 'other': 'y', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        self.assertEquals(resultCache.misses, 4)
+        
+        store.update({"id": "b", "prop" : 3})
+        self.assertEquals(store.query(query, dict(v=1)), 
+                    [{'id': '@b', 'prop': 3}])
+        self.assertEquals(resultCache.misses, 5)
+        
+        #changes not made through the store are detected by the revision
+        store.model.model.addStatement(('c', 'prop', '4', 
+                            'http://www.w3.org/2001/XMLSchema#integer', ''))
+        self.assertEquals(store.query(query, dict(v=1)), 
+                    [{'id': '@b', 'prop': 3}])
+        store.writeCount += 1
+        self.assertEquals(store.query(query, dict(v=1)), 
+                [{'id': '@c', 'prop': 4}, {'id': '@b', 'prop': 3}])
+        
+        #queries inside a transaction that modified the store aren't cached
+        store.requestProcessor.txnSvc.begin()
+        try:
+            store.update({"id": "a", "prop" : 5})
+            self.assertEquals(store.query(query, dict(v=3)), 
+                    [{'id': '@a', 'prop': 5}, {'id': '@c', 'prop': 4}])
+        finally:
+            store.requestProcessor.txnSvc.abort()
+        self.assertEquals(store.query(query, dict(v=3)), 
+                    [{'id': '@c', 'prop': 4}])
+        resultCache.clear()
+
     def XXXtestUpdate2(self):
         #XXX bug: update needs to replace the embedded object,
         #not just update the given properties in the embedded object
@@ -878,7 +1038,138 @@ class AppTestCase(unittest.TestCase):
             self.fail('should have raised an error')
         self.assertEquals(root.stores.config.query("{*}"), cdata)
         self.assertEquals(root.defaultStore.query("{*}"), ddata)
+
+    def _loadBaseApp(self, **config):
+        #importing baseapp changes defaultattrdict's default value, restore it
+        undefined = utils.defaultattrdict.UNDEFINED
+        try:
+            app = vesper.app.createApp(baseapp='vesper.web.baseapp', model_uri='test:',
+                storage_template='[{"id":"@a","prop":1},{"id":"@b","prop":2}]',
+                **config)
+            root = app.load()
+        finally:
+            utils.defaultattrdict.UNDEFINED = undefined
+        
+        def datarequest(requests):
+            import StringIO
+            from vesper.backports import json
+            body = json.dumps(requests)
+            environ = dict(PATH_INFO='/datarequest', REQUEST_METHOD='POST',
+                CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(body)),
+                SERVER_NAME='localhost', SERVER_PORT='80')
+            environ['wsgi.input'] = StringIO.StringIO(body)
+            environ['wsgi.url_scheme'] = 'http'
+            return root.wsgi_app(environ, lambda status, headers: None)
+        return root, datarequest
+
+    def testDatarequestResultCache(self):
+        from vesper.backports import json
+        from vesper.query import resultCache
+        resultCache.clear()
+        root, datarequest = self._loadBaseApp(query_result_cache=True)
+        query = dict(id=1, jsonrpc='2.0', method='query', 
+                    params=dict(query='{ id, prop where (prop > :v)}', 
+                                                    bindvars=dict(v=1)))
+        expected = [{'id': '@b', 'prop': 2}]
+        response = json.loads(''.join(datarequest([query])))
+        self.assertEquals(response[0]['result']['results'], expected)
+        self.assertEquals((resultCache.hits, resultCache.misses), (0, 1))
+        response = json.loads(''.join(datarequest([query])))
+        self.assertEquals(response[0]['result']['results'], expected)
+        self.assertEquals(response[0]['result']['errors'], [])
+        self.assertEquals((resultCache.hits, resultCache.misses), (1, 1))
+        
+        #failed queries aren't cached
+        bad = dict(id=2, jsonrpc='2.0', method='query', params='{ id, prop ')
+        for i in range(2):
+            response = json.loads(''.join(datarequest([bad])))
+            self.failUnless(response[0]['error'])
+        self.assertEquals(resultCache.hits, 1)
+        resultCache.clear()
+
+    def testStreamingQuery(self):
+        from vesper.backports import json
+        root, datarequest = self._loadBaseApp()
+        
+        results = root.defaultStore.query("{*}", stream=True)
+        self.failIf(isinstance(results, list))
+        self.assertEquals(list(results), 
+                    [{'id': '@a', 'prop': 1}, {'id': '@b', 'prop': 2}])
         
+        query = dict(id=1, jsonrpc='2.0', method='query', 
+                                    params=dict(query='{*}', stream=True))
+        response = datarequest([query])
+        self.failIf(isinstance(response, list)) #not buffered 
+        response = json.loads(''.join(response))
+        self.assertEquals(response[0]['result']['results'], 
+                    [{'id': '@a', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        
+        #the results are constructed in the request's transaction so batches
+        #that modify the store can be streamed too
+        update = dict(id=2, jsonrpc='2.0', method='update', 
+                                    params=dict(id='@a', prop=3))
+        response = datarequest([query, update, query])
+        self.failIf(isinstance(response, list))
+        response = json.loads(''.join(response))
+        self.assertEquals(response[0]['result']['results'], 
+                    [{'id': '@a', 'prop': 1}, {'id': '@b', 'prop': 2}])
+        self.assertEquals(response[2]['result']['results'], 
+                    [{'id': '@a', 'prop': 3}, {'id': '@b', 'prop': 2}])
+        
+        #writers aren't locked out while the response is being sent
+        import threading
+        lockfile = root.getLockFile()
+        def canLock():
+            locked = []
+            def attempt():
+                locked.append(lockfile.attempt())
+                if locked[0]:
+                    lockfile.release()
+            thread = threading.Thread(target=attempt)
+            thread.start()
+            thread.join()
+            return locked[0]
+        response = datarequest([query])
+        response.next()
+        self.failUnless(canLock())
+
+        from vesper.query import _query
+        evalAST = _query.evalAST
+        #errors while constructing the results are reported like any other 
+        #query error
+        def failingEvalAST(*args, **kw):
+            results = evalAST(*args, **kw)
+            yield results.next()
+            raise _query.QueryException('construct failed')
+        _query.evalAST = failingEvalAST
+        try:
+            response = datarequest([query])
+            response = json.loads(''.join(response))
+        finally:
+            _query.evalAST = evalAST
+        self.failIf('result' in response[0])
+        self.assertEquals(response[0]['error']['data'], 
+                                                ['error: construct failed'])
+
+        #errors while serializing the results end them and are reported in 
+        #the result's errors
+        def unserializableEvalAST(*args, **kw):
+            results = evalAST(*args, **kw)
+            yield results.next()
+            yield object()
+        _query.evalAST = unserializableEvalAST
+        try:
+            response = datarequest([query])
+            response = json.loads(''.join(response))
+        finally:
+            _query.evalAST = evalAST
+        self.failIf('error' in response[0])
+        self.assertEquals(response[0]['result']['results'], 
+                                                    [{'id': '@a', 'prop': 3}])
+        errors = response[0]['result']['errors']
+        self.assertEquals(len(errors), 1)
+        self.failUnless(errors[0].startswith('error: result could not be'))
+
 if __name__ == '__main__':
     import sys    
     try:
@@ -186,20 +186,29 @@ res = [{'child': '3', 'id': '_:1', 'parent': '1'},
 t('''{ * order by child desc, id }''', res)
 t('''{ * order by child desc, id asc }''', res)
 
+#with a limit only the top rows are kept
+t('''{ * order by child desc, id limit 3 }''', res[:3])
+t('''{ * order by child desc, id offset 1 limit 2 }''', res[1:3])
+t('''{ * order by id desc limit 2 }''',
+[{'child': '2', 'id': '_:2', 'parent': '1'},
+ {'child': '3', 'id': '_:1', 'parent': '1'}]
+)
+
 t.group = 'limit'
 
+#without an order by, limit and offset return objects in id order
 t('''{ * limit 2}''',
-[{'foo': 'bar', 'id': '3'},
- {'foo': 'bar', 'id': '2'}]
+[{'foo': 'bar', 'id': '2'},
+ {'foo': 'bar', 'id': '3'}]
 )
 
 t('''{ * offset 2}''',
-[{'child': '2', 'id': '_:2', 'parent': '1'},
-{'child': '3', 'id': '_:1', 'parent': '1'}]
+[{'child': '3', 'id': '_:1', 'parent': '1'},
+{'child': '2', 'id': '_:2', 'parent': '1'}]
 )
 
 t('''{ * offset 2 limit 1}''',
-[{'child': '2', 'id': '_:2', 'parent': '1'}]
+[{'child': '3', 'id': '_:1', 'parent': '1'}]
 )
 
 t.group = 'parse'
@@ -765,6 +774,44 @@ where (id not in (@foo, @commons) and subsumedby)
  {'id': 'todo'},
  {'id': 'rhizome'}])
 
+#an IN with a list of values is evaluated by looking up each value
+t('''
+{ id
+where (id in (@todo, @commons, @todo, @nosuchtag))
+}''',
+[{'id': 'todo'},
+ {'id': 'commons'}])
+
+t('''
+{ id
+where (subsumedby in :parents)
+}''',
+[{'id': '@rhizome'},
+ {'id': '@todo'},
+ {'id': '@toread'},
+ {'id': '@commons'}],
+bindvars={'parents' : ['@actions', '@projects']}, useSerializer=True)
+
+t('''
+{ id
+where (id in (@todo, @commons, @rhizome) and subsumedby = @projects)
+}''',
+[{'id': 'commons'},
+ {'id': 'rhizome'}])
+
+#numbers and booleans match values of other types that are equal to them
+t('''
+{ id
+where (p in (1, 9))
+}''',
+[{'id': '@a'},
+ {'id': '@b'},
+ {'id': '@c'},
+ {'id': '@e'}],
+model=modelFromJson([{'id' : 'a', 'p' : 1}, {'id' : 'b', 'p' : 1.0}, 
+    {'id' : 'c', 'p' : True}, {'id' : 'd', 'p' : '1'}, {'id' : 'e', 'p' : 9}]),
+useSerializer=True, unordered=True)
+
 #XXX * not handle properly, matching property named '*', should match any value 
 skip('''{ 
 where (subsumedby = *)
@@ -2678,6 +2725,150 @@ class JQLTestCase(unittest.TestCase):
         finally:
             jql.QueryContext.defaultShapes = save
     
+    def testASTCache(self):
+        cache = jql.ASTCache(2)
+        query = "{ * where (foo = :foo) }"
+        ast, errs = cache.getAST(query)
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+        self.failUnless(cache.getAST(query)[0] is ast)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        #namemap is part of the key
+        self.failUnless(cache.getAST(query, {'foo': 'bar'})[0] is not ast)
+        self.assertEquals(cache.misses, 2)
+
+        #evaluating the shared ast with different bindvars doesn't change it
+        astRepr = repr(ast)
+        model = modelFromJson([{'id' : '1', 'foo' : 1}, {'id' : '2', 'foo' : 2}])
+        for value, expected in [(1, '1'), (2, '2')]:
+            results = list(jql.evalAST(ast, model, {'foo': value},
+                                                    useSerializer=False))
+            self.assertEquals([r['id'] for r in results], [expected])
+        self.assertEquals(repr(ast), astRepr)
+
+        #parse errors aren't cached
+        ast, errs = cache.getAST("{ bad ")
+        self.failUnless(ast is None and errs)
+        self.assertEquals(len(cache.cache.nodeDict), 2)
+
+    def testJoinAlgorithms(self):
+        from vesper.query.operations import (MutableTupleset, IterationJoin,
+                                                        HashJoin, MergeJoin)
+        left = MutableTupleset(None, [['a', 1], ['b', 2], ['b', 3], ['d', 4]])
+        right = MutableTupleset(None, [['a', 'x'], ['b', 'y'], ['c', 'z']])
+        def innerJoin(leftRow, rightTable, lastRow):
+            for row in rightTable.filter({0 : leftRow[0]}, {'makeindex' : 0}):
+                yield row[1:]
+        expected = [['a', 1, 'x'], ['b', 2, 'y'], ['b', 3, 'y']]
+        for joinClass in (IterationJoin, HashJoin, MergeJoin):
+            rows = list(joinClass(left, right, innerJoin))
+            self.assertEquals(rows, expected, joinClass)
+
+        engine = jql.engine.SimpleQueryEngine()
+        self.failUnless(engine._chooseJoinAlgorithm(left, right, 0, 'i') is HashJoin)
+        self.failUnless(engine._chooseJoinAlgorithm(left, right, 0, 'x') is IterationJoin)
+        #estimated sizes
+        self.failUnless(engine._chooseJoinAlgorithm(left, right, 0, 'i', 
+                                                    1.0, 100.0) is IterationJoin)
+        self.failUnless(engine._chooseJoinAlgorithm(left, right, 0, 'i', 
+                                                    50.0, 100.0) is HashJoin)
+        left.orderedBy = right.orderedBy = 0
+        self.failUnless(engine._chooseJoinAlgorithm(left, right, 0, 'i') is MergeJoin)
+
+        #the hash table is only built once
+        scans = []
+        def rightRows():
+            scans.append(1)
+            return iter(right)
+        join = HashJoin(left, jql.engine.SimpleTupleset(rightRows), innerJoin)
+        self.assertEquals(list(join), expected)
+        self.assertEquals(list(join), expected)
+        self.assertEquals(len(scans), 1)
+
+        #queries with a limit stream both sides of the join in subject order
+        model = modelFromJson([{'id' : str(i), 'foo' : i % 3, 'bar' : i} 
+                                                        for i in range(10)])
+        query = '{ foo, bar limit 3 }'
+        results = jql.getResults(query, model, explain=True)
+        self.failUnless('MergeJoin' in results.explain, results.explain)
+        all = jql.getResults('{ foo, bar }', model, explain=True)
+        self.failUnless('HashJoin' in all.explain, all.explain)
+        self.assertEquals(results.results, [{'foo' : 0, 'bar' : 0}, 
+                            {'foo' : 1, 'bar' : 1}, {'foo' : 2, 'bar' : 2}])
+        for row in results.results:
+            self.failUnless(row in all.results, row)
+
+    def testJoinOrderWithoutStatistics(self):
+        '''
+        the results of a query don't depend on whether the model has 
+        statistics to reorder the joins with
+        '''
+        model = modelFromJson([
+         { 'id' : '1', 'listprop' : [ 'b', 'a', [[]] ],
+           'listprop2' : [-1, 0, 1, 2, 3, 4, 5, 6, 7] },
+         { 'id' : '2', 'listprop' : [ 'b', [-1, 0, 1], [], 'a', 1],
+           'listprop2' : [ [ ['double nested'] ]] },
+        ])
+        queries = ['{ "listpropX2" : listprop * 2, '
+                        '"listprop2X2" : [listprop2 * 2] }',
+                   '{ listprop, listprop2 }',
+                   '{ id where listprop2 = 1 and listprop = "a" }']
+        withStats = [jql.getResults(query, model).results for query in queries]
+        model.getStatistics = lambda: None
+        withoutStats = [jql.getResults(query, model).results 
+                                                    for query in queries]
+        self.assertEquals(withStats, withoutStats)
+
+    def testCompileOp(self):
+        from vesper.query.jqlAST import (Project, Constant, BindVar, Eq, Cmp,
+                                            Or, And, Not, In, QueryOp)
+        from vesper.query.operations import MutableTupleset
+        engine = jql.engine.SimpleQueryEngine()
+        tupleset = MutableTupleset([jql.ColumnInfo('a', object), 
+            jql.ColumnInfo('b', object)], [[1, 'x'], [2, 'y'], [3, ['x', 'z']]])
+        context = jql.QueryContext(tupleset, None, bindvars={'v' : 2})
+        mul = QueryOp.functions.getOp((None, 'mul'), Project(0), Constant(2))
+        ops = [Cmp('>', Project(0), Constant(1)),
+               Or(Eq(Project(1), Constant('x')), Not(Eq(Project(0), BindVar('v')))),
+               And(Cmp('<=', Project(0), BindVar('v')), Project(1)),
+               In(Project(0), Constant(1), Constant(3)),
+               Eq(mul, Constant(4)),
+               Project('b')]
+        for op in ops:
+            func = engine.compileOp(op, context)
+            for row in tupleset:
+                context.currentRow = row
+                self.assertEquals(func(row), op.evaluate(engine, context), op)
+        
+        context.complexPredicateHack = True
+        func = engine.compileOp(ops[1], context)
+        self.assertEquals([bool(func(row)) for row in tupleset], [True, False, True])
+
+    def testInProbes(self):
+        from vesper.query.jqlAST import Project, Constant, BindVar, In, Eq, Filter
+        from vesper.data.store.basic import MemStore
+        model = MemStore([('a', 'p', 'x', 'L', ''), ('b', 'p', 'y', 'L', ''), 
+                          ('c', 'p', 'z', 'L', ''), ('c', 'q', 'x', 'L', '')])
+        lookups = []
+        iterStatements = model.iterStatements
+        def recordLookups(*args, **kw):
+            lookups.append(kw)
+            return iterStatements(*args, **kw)
+        model.iterStatements = recordLookups
+        
+        engine = jql.engine.SimpleQueryEngine()
+        context = jql.QueryContext(model, None, bindvars={'v' : ['z', 'x']})
+        op = Filter(Eq(Project(1), Constant('p')), 
+                    In(Project(2), BindVar('v'), Constant('z')), subjectlabel='s')
+        simplefilter, complexargs, probes = engine._findSimplePredicates(op, 
+                                                                    context)
+        self.assertEquals(simplefilter, {1 : 'p'})
+        self.assertEquals(complexargs, [])
+        self.assertEquals(probes, [{2: 'z', 3 : 'L'}, {2: 'x', 3 : 'L'}])
+        
+        rows = list(op.evaluate(engine, context))
+        self.assertEquals([row[0].uri for row in rows], ['c', 'a'])
+        self.assertEquals([kw['object'] for kw in lookups], ['z', 'x'])
+
     def testPygmentsLexer(self):
         try:
             import pygments
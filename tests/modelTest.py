@@ -141,6 +141,22 @@ class BasicModelTestCase(unittest.TestCase):
         r = model.getStatements(predicate='p1', object='o2', objecttype='en-1')
         self.assertEqual(set(r), set( (more[0], more[-1]) ) )
 
+    def testLiteralObjectLookup(self):
+        "looking up an object without an object type matches any literal"
+        model = self.getModel()
+        XSD_INTEGER = 'http://www.w3.org/2001/XMLSchema#integer'
+        stmts = [Statement('s1', 'p', '1', XSD_INTEGER, ''),
+                 Statement('s2', 'p', '1', OBJECT_TYPE_LITERAL, ''),
+                 Statement('s3', 'p', '1', OBJECT_TYPE_RESOURCE, '')]
+        model.addStatements(stmts)
+        self.assertEqual(set(model.getStatements(object='1')), set(stmts[:2]))
+        self.assertEqual(set(model.getStatements(predicate='p', object='1')), 
+                                                            set(stmts[:2]))
+        self.assertEqual(model.getStatements(object='1', 
+                                        objecttype=XSD_INTEGER), stmts[:1])
+        self.assertEqual(model.getStatements(object=ResourceUri('1')), 
+                                                                stmts[2:])
+
     def testRemove(self):
         "basic removal test"
         model = self.getModel()
@@ -203,6 +219,90 @@ class BasicModelTestCase(unittest.TestCase):
         r5 = model.getStatements()
         self.assertEqual(set(r5), set([s1,s2,s3]))
 
+    def testRemoveShared(self):
+        "test removing statements that share a predicate, object or context"
+        model = self.getModel()
+        stmts = [Statement("s%02d" % (x % 10), "p", "o", "L", "c%d" % (x % 2)) 
+                for x in range(20)] + [Statement("s01", "p%02d" % x, "o") 
+                                                        for x in range(20)]
+        model.addStatements(stmts)
+        model.commit()
+        removed = stmts[::3]
+        model.removeStatements(removed)
+        model.commit()
+        #removing again is a no-op
+        model.removeStatements(removed[:2])
+        model.commit()
+        remaining = [s for s in stmts if s not in removed]
+
+        self.assertEqual(set(model.getStatements()), set(remaining))
+        self.assertEqual(set(model.getStatements(predicate="p")),
+                        set([s for s in remaining if s.predicate == "p"]))
+        self.assertEqual(set(model.getStatements(object="o")), set(remaining))
+        self.assertEqual(set(model.getStatements(subject="s01")),
+                        set([s for s in remaining if s.subject == "s01"]))
+        self.assertEqual(set(model.getStatements(context="c1")),
+                        set([s for s in remaining if s.scope == "c1"]))
+        self.assertEqual(set(model.getStatements(subject="s03", context="c1")),
+            set([s for s in remaining if s.subject == "s03" and s.scope == "c1"]))
+
+        model.addStatements(removed)
+        self.assertEqual(set(model.getStatements()), set(stmts))
+
+    def testLargeBuckets(self):
+        "test changing statements that share a subject, predicate or object"
+        model = self.getModel()
+        stmts = [Statement("s%03d" % x, "p", "o%d" % (x % 2)) 
+                    for x in range(300)] + [Statement("s007", "p%03d" % x, 
+                                                "o1") for x in range(300)]
+        shuffled = stmts[:]
+        random.Random(1).shuffle(shuffled)
+        model.addStatements(shuffled[:500])
+        model.commit()
+        current = set(shuffled[:500])
+        def check():
+            for kw in [dict(predicate="p"), dict(object="o1"), 
+                        dict(subject="s007"), dict(object="o0"), {}]:
+                stmts = model.getStatements(**kw)
+                expected = [s for s in current 
+                    if s == Statement(kw.get("subject", s[0]), 
+                        kw.get("predicate", s[1]), kw.get("object", s[2]))]
+                self.assertEqual(set(stmts), set(expected), kw)
+                if isinstance(model, MemStore):
+                    self.assertEqual(stmts, sorted(expected), kw)
+        check()
+        #iterators aren't affected by later changes
+        it = model.iterStatements(predicate="p")
+        before = [s for s in current if s.predicate == "p"]
+        for stmt in shuffled[:300:2]:
+            model.removeStatement(stmt)
+            current.discard(stmt)
+            if len(current) % 10 == 0:
+                #read while changes are pending
+                check()
+        for stmt in shuffled[500:] + shuffled[:100:2]:
+            model.addStatement(stmt)
+            current.add(stmt)
+        model.commit()
+        check()
+        if isinstance(model, MemStore):
+            self.assertEqual(list(it), sorted(before))
+
+    def testIterStatements(self):
+        "test iterStatements yields the same statements as getStatements"
+        model = self.getModel()
+        stmts = [Statement("s%02d" % (x % 7), "p%d" % (x % 3), "o%d" % (x % 4),
+                        "L", "c%d" % (x % 2)) for x in range(40, 0, -1)]
+        model.addStatements(stmts)
+        model.commit()
+        for kw in [{}, dict(subject="s03"), dict(predicate="p1"), 
+                dict(object="o2"), dict(context="c1"), dict(asQuad=False),
+                dict(predicate="p2", asQuad=False, hints={'limit':3,'offset':2})]:
+            iterator = model.iterStatements(**kw)
+            self.assert_(not isinstance(iterator, list))
+            self.assertEqual(list(iterator), list(model.getStatements(**kw)))
+        self.assertEqual(list(model.iterStatements()), sorted(set(stmts)))
+
     def testQuads(self):
         "test (somewhat confusing) quad behavior"
         model = self.getModel()
@@ -242,6 +342,161 @@ class BasicModelTestCase(unittest.TestCase):
         r3 = model.getStatements(hints={'limit':2, 'offset':12})
         self.assertEqual(set(r3), set([Statement("%02d" % x, "obj", "pred") for x in range(13,15)]))
 
+    def testSubjectOrderHint(self):
+        "test statements are streamed in subject order"
+        model = self.getModel()
+        if not model.canStreamBySubject:
+            return
+        stmts = [Statement("%02d" % x, "pred", "obj%d" % (x % 2)) for x in range(20,0,-1)]
+        model.addStatements(stmts)
+        model.addStatement(Statement("05", "pred2", "obj1"))
+        model.commit()
+        stmts.append(Statement("05", "pred2", "obj1"))
+        stmts.sort()
+        
+        r1 = model.getStatements(hints={'subjectorder':True})
+        self.assertEqual(list(r1), stmts)
+        r2 = model.getStatements(object="obj1", hints={'subjectorder':True, 
+                                                    'limit':3, 'offset':1})
+        self.assertEqual(list(r2), [s for s in stmts if s.object == "obj1"][1:4])
+
+        #subjects added and removed after the subjects were ordered
+        added = [Statement("00", "pred", "obj0"), 
+                Statement("10a", "pred", "obj0", scope="ctx")]
+        model.addStatements(added)
+        model.removeStatement(Statement("07", "pred", "obj1"))
+        model.commit()
+        expected = sorted(added + [s for s in stmts if s[0] != "07"])
+        r3 = model.getStatements(hints={'subjectorder':True})
+        self.assertEqual(list(r3), expected)
+        r4 = model.getStatements(context="", hints={'subjectorder':True})
+        self.assertEqual(list(r4), [s for s in expected if s.scope == ""])
+        r5 = model.getStatements(context="ctx", hints={'subjectorder':True})
+        self.assertEqual(list(r5), [added[1]])
+
+    def testStatistics(self):
+        "test the cardinality statistics are kept up-to-date"
+        model = self.getModel()
+        stats = model.getStatistics()
+        if stats is None:
+            return #model doesn't maintain statistics
+        self.assertEqual(stats.estimate(), 0)
+        
+        model.addStatements([Statement("%02d" % x, "type", "post", OBJECT_TYPE_RESOURCE)
+                                                    for x in range(1,11)])
+        model.addStatements([Statement("%02d" % x, "rating", str(x % 3), 
+                                'http://www.w3.org/2001/XMLSchema#integer')
+                                                    for x in range(1,11)])
+        #statistics reflect the committed state of the store
+        model.commit()
+        stats = model.getStatistics()
+        self.assertEqual(stats.estimate(), 20)
+        self.assertEqual(stats.estimate(predicate='type'), 10)
+        self.assertEqual(stats.estimate(predicate='type', object='post', 
+                                    objecttype=OBJECT_TYPE_RESOURCE), 10)
+        self.assertEqual(stats.estimate(predicate='type', 
+                                        object=ResourceUri('post')), 10)
+        self.assertEqual(stats.estimate(subject='01'), 2)
+        self.assertEqual(stats.estimate(subject='01', predicate='type'), 1)
+        self.assertEqual(stats.estimate(predicate='missing'), 0)
+        self.assertEqual(stats.distinctSubjects('rating'), 10)
+        self.assertEqual(stats.distinctObjects('rating'), 3)
+        self.assertEqual(stats.selectivity('rating', lambda v: v > 0), 0.7)
+
+        model.removeStatement(Statement("01", "type", "post", OBJECT_TYPE_RESOURCE))
+        model.commit()
+        stats = model.getStatistics()
+        self.assertEqual(stats.estimate(predicate='type'), 9)
+        self.assertEqual(stats.estimate(subject='01'), 1)
+        #removing a statement that doesn't exist doesn't change the counts
+        model.removeStatement(Statement("01", "type", "post", OBJECT_TYPE_RESOURCE))
+        model.commit()
+        self.assertEqual(model.getStatistics().estimate(), 19)
+
+    def testStatisticsSize(self):
+        "test the statistics of a large model are bounded estimates"
+        model = self.getModel()
+        if model.getStatistics() is None:
+            return #model doesn't maintain statistics
+        integer = 'http://www.w3.org/2001/XMLSchema#integer'
+        stmts = [Statement("s%04d" % x, "rating", str(x % 100), integer)
+                                                    for x in range(2000)]
+        stmts += [Statement("s%04d" % x, "rating", "hot", OBJECT_TYPE_LITERAL)
+                                                    for x in range(500)]
+        model.addStatements(stmts)
+        model.commit()
+        stats = model.getStatistics()
+        if isinstance(stats, ModelStatistics):
+            predstats = stats.getPredicateStatistics('rating')
+            self.assertEqual(predstats.count, 2500)
+            maxSample = base._base._MAX_SAMPLE
+            self.failUnless(len(predstats.subjects.counts) <= maxSample)
+            self.failUnless(len(predstats.objects.counts) <= maxSample)
+        self.failUnless(1400 <= stats.distinctSubjects('rating') <= 2600,
+                                            stats.distinctSubjects('rating'))
+        self.failUnless(70 <= stats.distinctObjects('rating') <= 130,
+                                            stats.distinctObjects('rating'))
+        #frequent values stand out from the rest
+        self.failUnless(stats.estimate(predicate='rating', object='hot',
+            objecttype=OBJECT_TYPE_LITERAL) > 250)
+        #no value that's in the model is estimated to have no matches
+        for x in range(100):
+            self.failUnless(stats.estimate(predicate='rating', object=str(x),
+                                                    objecttype=integer) > 0)
+        self.failUnless(stats.estimate(subject="s0001", predicate='rating') > 0)
+        #the actual selectivity is 0.4 
+        selectivity = stats.selectivity('rating', lambda v: v < 50)
+        self.failUnless(0.2 < selectivity < 0.6, selectivity)
+
+    def testTransactionIterStatements(self):
+        "test uncommitted changes are merged into the streamed statements"
+        model = self.getTransactionModel()
+        stmts = [Statement("s%d" % (x % 5), "p", "o%d" % (x % 3), "L", 
+                                        "c%d" % (x % 2)) for x in range(10)]
+        model.addStatements(stmts)
+        model.commit()
+
+        added = [Statement("s2", "p", "o2", "L", "c9"), 
+                 Statement("s0", "p", "new")]
+        removed = [stmts[0], stmts[7]]
+        model.addStatements(added)
+        model.removeStatements(removed)
+        expected = sorted([s for s in stmts if s not in removed] + added)
+        self.assertEqual(list(model.iterStatements()), expected)
+        self.assertEqual(model.getStatements(), expected)
+        self.assertEqual(list(model.iterStatements(subject="s2")),
+                                [s for s in expected if s.subject == "s2"])
+        #the statement added to c9 is a duplicate of the one in c0
+        self.assertEqual(list(model.iterStatements(subject="s2", asQuad=False)),
+                                                    [stmts[2]])
+        self.assertEqual(list(model.iterStatements(hints={'offset':2,'limit':3})),
+                                                    expected[2:5])
+        model.rollback()
+        self.assertEqual(list(model.iterStatements()), sorted(stmts))
+
+    def testTransactionCancelledChanges(self):
+        "test that uncommitted adds and removes cancel each other out"
+        model = self.getTransactionModel()
+        stmts = [Statement("s%d" % x, "p%d" % (x % 2), "o", "L") 
+                                                        for x in range(4)]
+        model.addStatements(stmts[:2])
+        model.commit()
+
+        new = Statement("s9", "p1", "o")
+        model.addStatement(new)
+        model.removeStatement(new)
+        model.removeStatement(stmts[0])
+        model.addStatement(stmts[0])
+        model.removeStatement(stmts[1])
+        model.addStatements(stmts[2:])
+        model.addStatement(stmts[3])
+        expected = [stmts[0]] + stmts[2:]
+        self.assertEqual(model.getStatements(), expected)
+        self.assertEqual(model.getStatements(predicate="p1"), [stmts[3]])
+        self.assertEqual(model.getStatements(object="o"), expected)
+        model.commit()
+        self.assertEqual(model.getStatements(), expected)
+
     def testTransactionCommitAndRollback(self):
         "test simple commit and rollback on a single model instance"
         model = self.getTransactionModel()
@@ -385,6 +640,97 @@ class SplitGraphModelTestCase(BasicModelTestCase):
         revmodel = TransactionMemStore()
         return graphManagerClass(model, revmodel, modelUri)
     
+class MultiModelTestCase(BasicModelTestCase):
+
+    def _getModel(self, model):
+        return MultiModel(model, MemStore())
+
+    def testMerge(self):
+        stmts = [Statement("s%d" % x, "p", "o%d" % x) for x in range(6)]
+        queried = []
+        class ReadOnlyStore(MemStore):
+            def iterStatements(self, *args, **kw):
+                queried.append(args)
+                return MemStore.iterStatements(self, *args, **kw)
+        readonly = ReadOnlyStore(stmts[::2] + [Statement("s9", "p2", "o")])
+        model = MultiModel(MemStore(stmts[1::2] + stmts[:1]), readonly)
+
+        self.assertEqual(model.getStatements(predicate="p"), stmts)
+        self.assertEqual(model.getStatements(predicate="p", 
+                                    hints=dict(offset=1, limit=3)), stmts[1:4])
+        self.assertEqual(model.getStatements(object="o"), 
+                                            [Statement("s9", "p2", "o")])
+        #the read-only model's statistics show it doesn't have "s1"
+        queried[:] = []
+        self.assertEqual(model.getStatements(subject="s1"), stmts[1:2])
+        self.assertEqual(queried, [])
+
+        model = MultiModel(MemStore(stmts[:2]), MemStore(stmts[1:4]), 
+                                                        MemStore(stmts[3:]))
+        self.assertEqual(model.getStatements(), stmts)
+        self.assertEqual(model.getStatements(hints=dict(limit=2)), stmts[:2])
+
+class CachingModelTestCase(BasicModelTestCase):
+
+    def _getModel(self, model):
+        return CachingModel(model)
+
+    def testCaching(self):
+        stmts = [Statement("s%d" % (x % 3), "p%d" % (x % 2), "o%d" % x) 
+                                                        for x in range(6)]
+        lookups = []
+        class CountingStore(MemStore):
+            def getStatements(self, *args, **kw):
+                lookups.append(args)
+                return MemStore.getStatements(self, *args, **kw)
+        model = CachingModel(CountingStore(stmts))
+
+        self.assertEqual(model.getStatements("s1"), [stmts[4], stmts[1]])
+        self.assertEqual(model.getStatements("s1"), [stmts[4], stmts[1]])
+        self.assertEqual(model.getStatements(predicate="p0"), 
+                                                        sorted(stmts[::2]))
+        self.assertEqual(model.getStatements(object="o3"), [stmts[3]])
+        self.assertEqual(len(lookups), 3)
+        self.assertEqual((model.hits, model.misses), (1, 3))
+
+        #only the lookups that could match the new statement are invalidated
+        new = Statement("s1", "p1", "new")
+        model.addStatement(new)
+        model.getStatements("s1")
+        model.getStatements(predicate="p0")
+        model.getStatements(object="o3")
+        self.assertEqual(len(lookups), 4)
+        self.assertEqual(model.getStatements("s1"), [stmts[4], new, stmts[1]])
+
+        model.removeStatement(stmts[3])
+        self.assertEqual(model.getStatements(object="o3"), [])
+        self.assertEqual(model.getStatements(predicate="p0"), 
+                                                        sorted(stmts[::2]))
+        self.assertEqual(len(lookups), 5)
+
+    def testCapabilities(self):
+        import vesper.query
+        from vesper.data.store.sqlite import SqliteStore
+        model = CachingModel(MemStore())
+        self.failUnless(model.canStreamBySubject)
+        self.failIf(model.canEvaluateFilter)
+
+        tmpdir = tempfile.mkdtemp(prefix="rhizometest")
+        try:
+            store = SqliteStore(os.path.join(tmpdir, 'test.sqlite'),
+                    [Statement("s1", "p", "a"), Statement("s2", "p", "b")])
+            model = CachingModel(store)
+            self.failIf(model.canStreamBySubject)
+            self.failUnless(model.canEvaluateFilter)
+            query = "{ id where (p = 'b') }"
+            self.assertEqual(vesper.query.getResults(query, model).results,
+                                                            [{'id': '@s2'}])
+            explain = vesper.query.getResults(query, model, explain=True)
+            self.failUnless('sqlite filter' in str(explain.explain))
+            store.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
 BIG = 100 #10000
 def main(testCaseClass):
     if '-b' in sys.argv: